@@ -0,0 +1,63 @@
+import os
+import sqlite3
+
+from metrics import get_metrics
+
+
+class AuthorCache:
+    """
+    Persistent SQLite cache of author resolutions, i.e. the Workday person or lab ID found for an author and
+    the method that found it.
+
+    Entries are keyed by the author name and the ORCID taken from the author's ORCID URL.  Names are kept
+    exactly as given, because the team and name lookups compare them exactly.  The cache is tagged with a
+    context fingerprint covering the Pure persons feed and the author team files, and is emptied when the
+    fingerprint changes.  All entries are read into memory when the cache is opened; new entries are written
+    back when it is closed.
+    """
+    def __init__(self, cache_file, context_fingerprint):
+        cache_dir = os.path.dirname(os.path.abspath(cache_file))
+        os.makedirs(cache_dir, exist_ok=True)
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS authors '
+                                '(name TEXT, orcid TEXT, author_id TEXT, method TEXT, PRIMARY KEY (name, orcid))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS context (fingerprint TEXT)')
+        row = self.connection.execute('SELECT fingerprint FROM context').fetchone()
+        if row is None or row[0] != context_fingerprint:
+            self.connection.execute('DELETE FROM authors')
+            self.connection.execute('DELETE FROM context')
+            self.connection.execute('INSERT INTO context VALUES (?)', (context_fingerprint,))
+            self.connection.commit()
+        self.entries = {(name, orcid): (author_id, method)
+                        for name, orcid, author_id, method in self.connection.execute('SELECT * FROM authors')}
+        self.added = {}
+
+    def get(self, name, orcid_id):
+        """ Return the cached (author_id, method) for an author, or None if the author is not cached. """
+        entry = self.entries.get((name, orcid_id or ''))
+        get_metrics().count('author_cache_lookups', result='hit' if entry is not None else 'miss')
+        return entry
+
+    def put(self, name, orcid_id, author_id, method):
+        key = (name, orcid_id or '')
+        self.entries[key] = self.added[key] = (author_id, method)
+
+    def drain(self):
+        """
+        Return the entries added since the last call, and forget them.  Used to send the resolutions made in
+        a worker process to the parent, which writes them to the cache.
+        """
+        added, self.added = self.added, {}
+        return added
+
+    def merge(self, added):
+        """ Add entries returned by drain() in another process. """
+        for (name, orcid), (author_id, method) in added.items():
+            self.put(name, orcid, author_id, method)
+
+    def close(self):
+        self.connection.executemany('INSERT OR REPLACE INTO authors VALUES (?, ?, ?, ?)',
+                                    [key + value for key, value in self.added.items()])
+        self.added = {}
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,44 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ckan_api import package_search, iter_package_pages
+from pure_parse import open_pure_feed
+
+
+def record_packages(ckan_url, num_datasets, output_file):
+    """ Save the first num_datasets CKAN packages as JSON Lines, one package dictionary per line. """
+    package_search_query = ckan_url + '/api/3/action/package_search?fq=resource-type:dataset'
+    num_datasets = min(num_datasets, package_search(package_search_query + '&rows=0')['count'])
+    with open(output_file, 'w', encoding='utf-8') as f:
+        for packages in iter_package_pages(package_search_query, 0, num_datasets, 500, fetch_workers=4):
+            for pkg_dict in packages:
+                f.write(json.dumps(pkg_dict) + '\n')
+    return num_datasets
+
+
+def record_pure_feed(feed_name, output_file):
+    """ Save a Pure feed, using the credentials in ".auth_tokens". """
+    with open_pure_feed(feed_name) as feed, open(output_file, 'wb') as f:
+        shutil.copyfileobj(feed, f, 1024 * 1024)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record CKAN packages and Pure feeds for the benchmark stand-in '
+                                                 'server.  Run from the directory holding ".auth_tokens".')
+    parser.add_argument('--ckan-url', nargs=1, default=['https://data.ucar.edu'], help='CKAN base URL')
+    parser.add_argument('--datasets', nargs=1, type=int, default=[1000], help='Number of datasets to record')
+    parser.add_argument('--output-dir', nargs=1, required=True, help='Directory for the recorded data')
+    args = parser.parse_args()
+
+    output_dir = args.output_dir[0]
+    os.makedirs(output_dir, exist_ok=True)
+    count = record_packages(args.ckan_url[0], args.datasets[0], os.path.join(output_dir, 'packages.jsonl'))
+    print(f"Recorded {count} packages", file=sys.stderr)
+    for feed_name in ('persons', 'costcenters'):
+        record_pure_feed(feed_name, os.path.join(output_dir, feed_name + '.xml'))
+        print(f"Recorded the Pure {feed_name} feed", file=sys.stderr)
@@ -0,0 +1,431 @@
+import argparse
+import copy
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import re
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import pure_parse
+from ckan_api import package_search, iter_package_pages
+from http_client import configure_http_client
+from package_record import PackageRecord, PROJECTED_FIELDS
+from standin_server import (StandinServer, SyntheticRepository, RecordedRepository, project_package,
+                            write_auth_tokens)
+from utils import render_package, xml_init, write_xml
+
+PROGRAM_DESCRIPTION = '''
+
+Benchmarks for ckan2pure.py, run against a local stand-in for the CKAN and Pure servers so that no network
+access is needed and every run sees the same data.
+
+Example usage:
+
+       python benchmarks/run_benchmarks.py --scale small medium --output results.json
+       python benchmarks/run_benchmarks.py --scale small --compare results.json
+
+Benchmarks:
+
+       pipeline             The complete ckan2pure.py run, in a separate process
+       fetch_pages          CKAN package_search requests, 500 datasets per page
+       load_persons         Parsing the Pure persons feed into the author lookup tables
+       render_package       Rendering one dataset
+       get_pure_author_id   Looking up one author
+       get_organization_id  Looking up one publisher organization
+       write_xml            Serializing the complete <datasets> tree
+
+Each benchmark runs in a fresh process, and reports its wall time per repetition, throughput, latency per
+call and the peak resident set size of that process.  For the pipeline, the stage timings and counters from
+ckan2pure.py --metrics and the time the stand-in server spent on each kind of request are reported as well.
+Before the pipeline is timed, it is checked to write the same feed and --diff-manifest serially, with
+--render-workers and with datasets from the --fragment-cache, and to leave the feed unchanged in an --incremental
+run that finds no changes.
+
+Scales (datasets, persons):
+
+       small    1,000 datasets,  10,000 persons
+       medium   10,000 datasets,  50,000 persons
+       large    100,000 datasets, 500,000 persons
+'''
+
+SCALES = {'small': (1000, 10000), 'medium': (10000, 50000), 'large': (100000, 500000)}
+BENCHMARKS = ['pipeline', 'fetch_pages', 'load_persons', 'render_package', 'get_pure_author_id',
+              'get_organization_id', 'write_xml']
+CKAN2PURE = os.path.join(REPO_DIR, 'ckan2pure.py')
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+
+def peak_rss_mb():
+    """ Return the peak resident set size of this process in MB, or None where it is not available. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def latency_summary(latencies):
+    """ Summarize per-call latencies, in milliseconds. """
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    return {'calls': len(ordered),
+            'mean_ms': statistics.mean(ordered) * 1000,
+            'p50_ms': ordered[len(ordered) // 2] * 1000,
+            'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+            'max_ms': ordered[-1] * 1000}
+
+
+def summarize(seconds, items, latencies=None):
+    median_seconds = statistics.median(seconds)
+    return {'seconds': seconds,
+            'median_seconds': median_seconds,
+            'items': items,
+            'items_per_second': items / median_seconds if median_seconds else None,
+            'latency': latency_summary(latencies)}
+
+
+def timed_calls(function, arguments, repeat, reset=None):
+    """
+    Call function once for each argument, repeat times over.  Returns the wall time of each repetition and
+    the latency of every call.
+    """
+    seconds = []
+    latencies = []
+    for _ in range(repeat):
+        if reset:
+            reset()
+        started = time.perf_counter()
+        for argument in arguments:
+            call_started = time.perf_counter()
+            function(argument)
+            latencies.append(time.perf_counter() - call_started)
+        seconds.append(time.perf_counter() - started)
+    return seconds, latencies
+
+
+def search_query(server_url):
+    return server_url + '/api/3/action/package_search?fq=resource-type:dataset'
+
+
+def sample_packages(server_url, datasets, sample):
+    """ Fetch the package dictionaries of the first sample datasets. """
+    count = min(datasets, sample)
+    pkg_dicts = []
+    for packages in iter_package_pages(search_query(server_url), 0, count, 500, fetch_workers=4):
+        pkg_dicts.extend(packages)
+    return pkg_dicts[:count]
+
+
+def bench_fetch_pages(server_url, datasets, sample, repeat):
+    offsets = range(0, datasets, 500)
+    query = search_query(server_url)
+    seconds, latencies = timed_calls(lambda offset: package_search(query + f'&start={offset}&rows=500'),
+                                     offsets, repeat)
+    return summarize(seconds, datasets, latencies)
+
+
+def bench_load_persons(server_url, datasets, sample, repeat):
+    seconds, latencies = timed_calls(lambda _: pure_parse.load_persons_feed(), [None], repeat)
+    return summarize(seconds, len(pure_parse.PERSONS_BY_NAME), latencies)
+
+
+def check_projected_rendering(pkg_dicts):
+    """
+    Check that packages projected to PROJECTED_FIELDS, as with --project-fields, render the same as the complete
+    package dictionaries, also where Solr leaves out empty fields.
+    """
+    for pkg_dict in pkg_dicts:
+        full = render_package(PackageRecord(pkg_dict), None, True)
+        projected = render_package(PackageRecord(project_package(pkg_dict, PROJECTED_FIELDS)), None, True)
+        if (etree.tostring(full) if full is not None else None) != \
+                (etree.tostring(projected) if projected is not None else None):
+            raise RuntimeError(f"Package {pkg_dict['id']} renders differently with --project-fields")
+
+
+def bench_render_package(server_url, datasets, sample, repeat):
+    pkg_dicts = sample_packages(server_url, datasets, sample)
+    pure_parse.load_pure_lookups()
+    check_projected_rendering(pkg_dicts)
+    seconds, latencies = timed_calls(lambda pkg_dict: render_package(PackageRecord(pkg_dict), None, True),
+                                     pkg_dicts, repeat)
+    return summarize(seconds, len(pkg_dicts), latencies)
+
+
+def bench_get_pure_author_id(server_url, datasets, sample, repeat):
+    authors = []
+    for pkg_dict in sample_packages(server_url, datasets, sample):
+        authors.extend(PackageRecord(pkg_dict).authors or [])
+    pure_parse.load_pure_lookups()
+    seconds, latencies = timed_calls(pure_parse.get_pure_author_id, authors, repeat)
+    return summarize(seconds, len(authors), latencies)
+
+
+def bench_get_organization_id(server_url, datasets, sample, repeat):
+    org_strings = []
+    for pkg_dict in sample_packages(server_url, datasets, sample):
+        org_strings.extend(PackageRecord(pkg_dict).publishers_standard)
+    pure_parse.load_workday_mapping()
+
+    def reset():
+        # Start each repetition with an empty lookup memo.
+        pure_parse.ORGANIZATION_RESOLVER = None
+
+    seconds, latencies = timed_calls(pure_parse.get_organization_id, org_strings, repeat, reset)
+    return summarize(seconds, len(org_strings), latencies)
+
+
+def bench_write_xml(server_url, datasets, sample, repeat):
+    pure_parse.load_pure_lookups()
+    rendered = [render_package(PackageRecord(pkg_dict), None, True)
+                for pkg_dict in sample_packages(server_url, datasets, sample)]
+    rendered = [dataset for dataset in rendered if dataset is not None]
+    # Fill the tree up to the full number of datasets with copies of the sample.
+    root = xml_init(False)
+    for index in range(datasets if rendered else 0):
+        root.append(copy.deepcopy(rendered[index % len(rendered)]))
+    output_file = os.path.join(os.getcwd(), 'write_xml.xml')
+    seconds, latencies = timed_calls(lambda _: write_xml(root, XML_HEADER, output_file), [None], repeat)
+    os.remove(output_file)
+    return summarize(seconds, len(root), latencies)
+
+
+def run_in_process(name, server_url, workdir, datasets, sample, repeat):
+    """ Run one of the in-process benchmarks; called in a fresh process. """
+    os.chdir(workdir)
+    # render_package reports every filtered dataset on stderr.
+    sys.stderr = open(os.devnull, 'w')
+    configure_http_client()
+    result = globals()['bench_' + name](server_url, datasets, sample, repeat)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+# Options of the ckan2pure.py runs that check_render_paths() compares, in the order they run.  The runs share a
+# feed cache directory, so the second --fragment-cache run takes every dataset from the cache.
+RENDER_PATHS = [('serial', []), ('--render-workers 2', ['--render-workers', '2']),
+                ('--fragment-cache', ['--fragment-cache']), ('--fragment-cache hits', ['--fragment-cache'])]
+
+
+def run_check(server_url, workdir, cache_dir, output_file, arguments):
+    """ Run ckan2pure.py for one of the output checks, and return the feed it wrote. """
+    command = [sys.executable, CKAN2PURE, '--ckan-url', server_url, '--add-extra', '--output', output_file,
+               '--feed-cache-dir', cache_dir] + arguments
+    subprocess.run(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    with open(output_file, 'rb') as f:
+        return f.read()
+
+
+def check_render_paths(server_url, workdir):
+    """
+    Check that ckan2pure.py writes the same feed and --diff-manifest byte for byte whichever way it renders the
+    datasets, see RENDER_PATHS.
+    """
+    cache_dir = tempfile.mkdtemp(prefix='feed-cache-', dir=workdir)
+    output_file = os.path.join(workdir, 'check.xml')
+    manifest_file = os.path.join(workdir, 'check-manifest.json')
+    expected = None
+    try:
+        for name, arguments in RENDER_PATHS:
+            # Without a previous manifest, every dataset is written and recorded in a new one.
+            if os.path.exists(manifest_file):
+                os.remove(manifest_file)
+            outputs = {'feed': run_check(server_url, workdir, cache_dir, output_file,
+                                         ['--diff-manifest', manifest_file, '--removed-ids',
+                                          os.path.join(workdir, 'check-removed-ids.txt')] + arguments)}
+            with open(manifest_file, 'rb') as f:
+                outputs['manifest'] = f.read()
+            if expected is None:
+                expected = outputs
+            for kind in outputs:
+                if outputs[kind] != expected[kind]:
+                    raise RuntimeError(f"ckan2pure.py writes a different {kind} with {name} than serially")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def check_unchanged_merge(server_url, workdir):
+    """
+    Check that an --incremental run that finds no changed datasets leaves the feed of the previous run byte for
+    byte the same.
+    """
+    cache_dir = tempfile.mkdtemp(prefix='feed-cache-', dir=workdir)
+    output_file = os.path.join(workdir, 'check-incremental.xml')
+    arguments = ['--incremental', '--state-file', os.path.join(workdir, 'check-state.json')]
+    try:
+        # The first run has no state yet and harvests everything.
+        expected = run_check(server_url, workdir, cache_dir, output_file, arguments)
+        if run_check(server_url, workdir, cache_dir, output_file, arguments) != expected:
+            raise RuntimeError("ckan2pure.py --incremental rewrites the feed differently when nothing changed")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def run_pipeline(server, workdir, repeat, pipeline_args):
+    """ Run ckan2pure.py against the stand-in server, repeat times, each with an empty feed cache. """
+    seconds = []
+    peak_rss = []
+    server_stats = []
+    datasets_written = None
+    output_file = os.path.join(workdir, 'pure.xml')
+    log_file = os.path.join(workdir, 'ckan2pure.log')
+    metrics_file = os.path.join(workdir, 'metrics.json')
+    for _ in range(repeat):
+        cache_dir = tempfile.mkdtemp(prefix='feed-cache-', dir=workdir)
+        command = [sys.executable, CKAN2PURE, '--ckan-url', server.url, '--output', output_file,
+                   '--feed-cache-dir', cache_dir, '--metrics', metrics_file] + pipeline_args
+        server.reset_stats()
+        with open(log_file, 'w') as log:
+            started = time.perf_counter()
+            process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=log)
+            # os.wait4 gives the resource usage of this child alone.
+            _, status, rusage = os.wait4(process.pid, 0)
+            seconds.append(time.perf_counter() - started)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        if process.returncode != 0:
+            with open(log_file) as log:
+                tail = log.readlines()[-20:]
+            raise RuntimeError(f"ckan2pure.py failed with status {process.returncode}:\n{''.join(tail)}")
+        peak_rss.append(rusage.ru_maxrss / (1024 * 1024) if sys.platform == 'darwin' else rusage.ru_maxrss / 1024)
+        server_stats.append(server.reset_stats())
+        with open(output_file, 'rb') as f:
+            datasets_written = len(re.findall(rb'<(?:\w+:)?dataset ', f.read()))
+
+    result = summarize(seconds, server.repository.count)
+    result['peak_rss_mb'] = max(peak_rss)
+    result['datasets_written'] = datasets_written
+    result['arguments'] = pipeline_args
+    # Stage timings and counters reported by ckan2pure.py, and server-side time per endpoint, from the last
+    # repetition.
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    result['stages'] = metrics['stages']
+    result['counters'] = metrics['counters']
+    result['server'] = {endpoint: dict(stats, mean_ms=stats['seconds'] * 1000 / stats['requests'])
+                        for endpoint, stats in sorted(server_stats[-1].items())}
+    return result
+
+
+def prepare_workdir(server_url):
+    """ Create a working directory with the files ckan2pure.py reads from its current directory. """
+    workdir = tempfile.mkdtemp(prefix='ckan2pure-bench-run-')
+    write_auth_tokens(workdir, server_url)
+    for name in ('author_orgs.yaml', 'author_org_ids.yaml'):
+        shutil.copy(os.path.join(REPO_DIR, name), workdir)
+    return workdir
+
+
+def run_scale(scale, datasets, persons, args):
+    if args.fixtures[0]:
+        repository = RecordedRepository(args.fixtures[0], datasets)
+        persons = None
+    else:
+        repository = SyntheticRepository(datasets, persons)
+    server = StandinServer(repository, latency=args.latency[0]).start()
+    workdir = prepare_workdir(server.url)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    try:
+        for name in args.benchmarks:
+            print(f"{scale}: {name} ...", file=sys.stderr)
+            if name == 'pipeline':
+                check_render_paths(server.url, workdir)
+                check_unchanged_merge(server.url, workdir)
+                result = run_pipeline(server, workdir, args.repeat[0], shlex.split(args.pipeline_args[0]))
+            else:
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_in_process, (name, server.url, workdir, datasets, args.sample[0],
+                                                         args.repeat[0]))
+            result = dict({'benchmark': name, 'scale': scale, 'datasets': datasets, 'persons': persons}, **result)
+            print(f"    {result['median_seconds']:.3f} s, {result['items_per_second'] or 0:,.0f} items/s, "
+                  f"peak RSS {result['peak_rss_mb'] or 0:.0f} MB", file=sys.stderr)
+            results.append(result)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def environment():
+    """ Describe the code and machine the benchmarks ran on. """
+    version = subprocess.run([sys.executable, CKAN2PURE, '--version'], cwd=REPO_DIR,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return {'ckan2pure_version': version.stdout.strip(),
+            'git_commit': commit.stdout.strip() or None,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'started': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')}
+
+
+def compare_results(previous, current):
+    """ Print the change in median time and peak RSS for each benchmark found in both result sets. """
+    previous_results = {(r['benchmark'], r['scale'], r['datasets'], r['persons']): r for r in previous['results']}
+    print(f"\nCompared with {previous['environment'].get('ckan2pure_version')} "
+          f"({previous['environment'].get('git_commit')}):", file=sys.stderr)
+    for result in current['results']:
+        old = previous_results.get((result['benchmark'], result['scale'], result['datasets'], result['persons']))
+        if old is None:
+            continue
+        ratio = result['median_seconds'] / old['median_seconds'] if old['median_seconds'] else float('nan')
+        rss = ''
+        if result['peak_rss_mb'] and old['peak_rss_mb']:
+            rss = f"; peak RSS {old['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB"
+        print(f"    {result['scale']:>7} {result['benchmark']:<20} {old['median_seconds']:.3f} -> "
+              f"{result['median_seconds']:.3f} s ({ratio:.2f}x){rss}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--scale', nargs='+', choices=list(SCALES), default=['small'], help='Data sizes to run')
+    parser.add_argument('--datasets', nargs=1, type=int, default=[None],
+                        help='Run a custom scale with this number of datasets')
+    parser.add_argument('--persons', nargs=1, type=int, default=[10000],
+                        help='Number of persons for the custom scale')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='Benchmarks to run')
+    parser.add_argument('--repeat', nargs=1, type=int, default=[3], help='Repetitions of each benchmark')
+    parser.add_argument('--sample', nargs=1, type=int, default=[2000],
+                        help='Number of datasets used by the per-call benchmarks')
+    parser.add_argument('--fixtures', nargs=1, default=[None],
+                        help='Serve data recorded by record_fixtures.py instead of synthetic data')
+    parser.add_argument('--latency', nargs=1, type=float, default=[0.0],
+                        help='Seconds added to each package_search request by the stand-in server')
+    parser.add_argument('--pipeline-args', nargs=1, default=['--add-extra'],
+                        help='Extra ckan2pure.py arguments for the pipeline benchmark')
+    parser.add_argument('--output', nargs=1, default=['benchmark_results.json'], help='JSON results file')
+    parser.add_argument('--compare', nargs=1, default=[None], help='Earlier JSON results file to compare with')
+    args = parser.parse_args()
+
+    scales = [(scale, *SCALES[scale]) for scale in args.scale]
+    if args.datasets[0]:
+        scales = [('custom', args.datasets[0], args.persons[0])]
+
+    results = {'environment': environment(), 'results': []}
+    for scale, datasets, persons in scales:
+        results['results'].extend(run_scale(scale, datasets, persons, args))
+
+    with open(args.output[0], 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output[0]}", file=sys.stderr)
+
+    if args.compare[0]:
+        with open(args.compare[0]) as f:
+            compare_results(json.load(f), results)
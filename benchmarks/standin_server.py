@@ -0,0 +1,337 @@
+import argparse
+import base64
+import fnmatch
+import gzip
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+FIRST_NAMES = ['John', 'Jane', 'Ana', 'José', 'Li', 'Mary', 'Karl', 'Olga', 'Ravi', 'Sam',
+               'Wei', 'Fatima', 'Pierre', 'Aiko', 'Björn', 'Chen', 'Maria', 'David', 'Priya', 'Tomás']
+LAST_NAMES = ['Doe', 'Smith', 'García', 'Nguyen', 'Müller', 'Brown', "O'Neil", 'Lee', 'Kim', 'Stone-Hill',
+              'Johnson', 'Zhang', 'Rossi', 'Tanaka', 'Kowalski', 'Silva', 'Ivanova', 'Dubois', 'Patel', 'Cohen']
+
+# Organisations in the costcenters feed; populate_workday_mapping() requires all of these.
+LABS = ['ACOM', 'CGD', 'CISL', 'ISD', 'EOL', 'HAO', 'NCARLIB', 'RAL', 'UCP', 'NCAR', 'MMM']
+
+PUBLISHERS = ['NSF NCAR Atmospheric Chemistry Observations & Modeling (ACOM)', 'UCAR/NCAR - CGD',
+              'UCAR/NCAR - CISL', 'UCAR/NCAR - Research Data Archive (RDA)', 'NCAR GDEX', 'UCAR/NCAR - EOL',
+              'UCAR/NCAR - HAO', 'UCAR/NCAR - Library', 'UCAR/NCAR - RAL', 'UCAR/UCP', 'NCAR',
+              'Some University']
+
+# Author names that are NCAR teams in author_orgs.yaml.
+TEAMS = ['NSF NCAR/EOL Integrated Sounding System Team', 'Community Earth System Model developers and affiliates',
+         'NCAR Atmospheric Chemistry Division (ACD)']
+
+PERSON_NAMESPACE = 'v1.unified-person-sync.pure.atira.dk'
+ORG_NAMESPACE = 'v1.organisation-sync.pure.atira.dk'
+COMMONS_NAMESPACE = 'v3.commons.pure.atira.dk'
+
+
+class SyntheticRepository:
+    """
+    Deterministic synthetic CKAN packages and Pure feeds at any scale.
+
+    Each package is generated from its index alone, so pages can be served for 100k datasets without
+    holding them in memory, and every run sees the same data.  Package authors are drawn from the persons
+    feed, by ORCID and by name, so the author lookups find realistic hit rates.
+    """
+    def __init__(self, num_datasets, num_persons, seed=1):
+        self.count = num_datasets
+        self.num_persons = num_persons
+        self.seed = seed
+        self.feed_dir = None
+
+    def person(self, index):
+        """ Return (person_id, first_name, last_name, orcid) for a person in the persons feed. """
+        first_name = FIRST_NAMES[index % len(FIRST_NAMES)]
+        last_name = LAST_NAMES[(index // len(FIRST_NAMES)) % len(LAST_NAMES)]
+        generation = index // (len(FIRST_NAMES) * len(LAST_NAMES))
+        if generation:
+            last_name += str(generation)
+        orcid = '0000-000%d-%04d-%04d' % (self.seed % 10, index // 10000, index % 10000) if index % 3 == 0 else None
+        return str(100000 + index), first_name, last_name, orcid
+
+    def author(self, rnd):
+        draw = rnd.random()
+        if draw < 0.3:
+            _, first_name, last_name, orcid = self.person(rnd.randrange(self.num_persons))
+            return {'name': f'{last_name}, {first_name}', 'orcid_url': f'https://orcid.org/{orcid}' if orcid else ''}
+        if draw < 0.6:
+            _, first_name, last_name, _ = self.person(rnd.randrange(self.num_persons))
+            return {'name': f'{first_name} Q. {last_name}', 'orcid_url': ''}
+        if draw < 0.65:
+            return {'name': rnd.choice(TEAMS), 'orcid_url': ''}
+        orcid_url = 'https://orcid.org/9999-0000-0000-%04d' % rnd.randrange(10000) if rnd.random() < 0.3 else None
+        return {'name': f'{rnd.choice(FIRST_NAMES)} Ext{rnd.randrange(1000)}', 'orcid_url': orcid_url}
+
+    def package(self, index):
+        """ Return the CKAN package dictionary at a position in the search results. """
+        rnd = random.Random(self.seed * 1000003 + index)
+        authors = [self.author(rnd) for _ in range(rnd.randint(0, 6))]
+        publisher = rnd.choice(PUBLISHERS)
+        extras = [
+            {'key': 'guid', 'value': 'bench-%07d' % index},
+            {'key': 'publisher', 'value': json.dumps([publisher])},
+            {'key': 'publisher-standard', 'value': json.dumps([publisher])},
+            {'key': 'publication_date', 'value': rnd.choice(['2020', '2019-05', '2021-03-04T00:00:00'])},
+            {'key': 'resource-url', 'value': rnd.choice(['https://doi.org/10.5065/D6%06d' % index,
+                                                         'https://rda.ucar.edu/datasets/d%06d' % index])},
+            {'key': 'extent_range', 'value': rnd.choice(['[1992-11-01 TO 1993-02-28]', '[2001-01-01 TO *]', ''])},
+        ]
+        if authors:
+            extras.append({'key': 'harvest-author-with-url', 'value': json.dumps(authors)})
+        day = 1 + index % 28
+        return {'id': 'bench-id-%d' % index, 'name': 'bench-dataset-%d' % index, 'type': 'dataset',
+                'state': 'active', 'title': 'Benchmark dataset %d' % index,
+                'notes': '<p>Observations for dataset %d, &amp; derived products.</p>' % index * rnd.randint(1, 8)
+                if index % 25 else '',
+                'metadata_modified': '2024-01-%02dT00:00:00.000000' % day, 'extras': extras,
+                'resources': [{'url': 'https://example.org/data/%d/%d' % (index, j), 'description': 'File %d' % j}
+                              for j in range(rnd.randint(1, 5))],
+                'tags': [{'name': 'keyword%d' % rnd.randrange(200)} for _ in range(rnd.randint(0, 8))]}
+
+    def write_persons_feed(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<persons xmlns="{PERSON_NAMESPACE}" xmlns:v3="{COMMONS_NAMESPACE}">\n')
+            for index in range(self.num_persons):
+                person_id, first_name, last_name, orcid = self.person(index)
+                f.write(f'<person id="{person_id}"><name><v3:firstname>{escape(first_name)}</v3:firstname>'
+                        f'<v3:lastname>{escape(last_name)}</v3:lastname></name>')
+                if orcid:
+                    f.write(f'<orcId>{orcid}</orcId>')
+                f.write('<employeeStartDate>2000-01-01</employeeStartDate></person>\n')
+            f.write('</persons>\n')
+
+    def write_costcenters_feed(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<organisations xmlns="{ORG_NAMESPACE}" xmlns:v3="{COMMONS_NAMESPACE}">\n')
+            for index, lab in enumerate(LABS):
+                f.write(f'<organisation><organisationId> bench-org-{index} </organisationId><type>lab</type>'
+                        '<nameVariants><nameVariant><type>name</type>'
+                        f'<name><v3:text lang="en">{lab}</v3:text></name></nameVariant></nameVariants>'
+                        '</organisation>\n')
+            f.write('</organisations>\n')
+
+    def feed_path(self, feed_name):
+        """ Return the path of a generated Pure feed file, writing the feeds on first use. """
+        if self.feed_dir is None:
+            self.feed_dir = tempfile.mkdtemp(prefix='ckan2pure-bench-')
+            self.write_persons_feed(os.path.join(self.feed_dir, 'persons'))
+            self.write_costcenters_feed(os.path.join(self.feed_dir, 'costcenters'))
+        return os.path.join(self.feed_dir, feed_name)
+
+    def close(self):
+        if self.feed_dir is not None:
+            shutil.rmtree(self.feed_dir, ignore_errors=True)
+            self.feed_dir = None
+
+
+class RecordedRepository:
+    """
+    CKAN packages and Pure feeds recorded by record_fixtures.py.
+
+    The recorded packages are repeated, with distinct IDs and GUIDs, when more datasets are requested than
+    were recorded.  The Pure feeds are served as recorded.
+    """
+    def __init__(self, fixture_dir, num_datasets=None):
+        self.fixture_dir = fixture_dir
+        with open(os.path.join(fixture_dir, 'packages.jsonl'), encoding='utf-8') as f:
+            self.packages = [json.loads(line) for line in f if line.strip()]
+        self.count = num_datasets if num_datasets is not None else len(self.packages)
+
+    def package(self, index):
+        copy, position = divmod(index, len(self.packages))
+        if copy == 0:
+            return self.packages[position]
+        pkg_dict = json.loads(json.dumps(self.packages[position]))
+        pkg_dict['id'] += f'-copy{copy}'
+        pkg_dict['title'] += f' (copy {copy})'
+        for extra in pkg_dict['extras']:
+            if extra['key'] == 'guid':
+                extra['value'] += f'-copy{copy}'
+        return pkg_dict
+
+    def feed_path(self, feed_name):
+        return os.path.join(self.fixture_dir, feed_name + '.xml')
+
+    def close(self):
+        pass
+
+
+def project_package(pkg_dict, fields):
+    """
+    Return the fields of a package selected by a package_search 'fl' list, as CKAN's Solr index returns them:
+    the type as 'dataset_type', extras as 'extras_<key>' fields, wildcards in field names expanded and empty
+    fields left out.
+    """
+    document = {key: value for key, value in pkg_dict.items() if key not in ('type', 'extras')}
+    document['dataset_type'] = pkg_dict['type']
+    document.update(('extras_' + extra['key'], extra['value']) for extra in pkg_dict['extras'])
+    return {key: value for key, value in document.items()
+            if value != '' and any(fnmatch.fnmatchcase(key, field) for field in fields)}
+
+
+class StandinRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type, headers=None):
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        started = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path == '/api/3/action/package_search':
+            endpoint = 'package_search'
+            self.package_search(parse_qs(url.query))
+        elif url.path.startswith('/pure/'):
+            endpoint = 'pure_' + url.path[len('/pure/'):]
+            self.pure_feed(url.path[len('/pure/'):])
+        else:
+            endpoint = 'not_found'
+            self.send_empty(404)
+        self.server.record_request(endpoint, time.perf_counter() - started)
+
+    def package_search(self, query):
+        """ Serve a page of package_search results.  Filters in fq are not applied. """
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        repository = self.server.repository
+        start = int(query.get('start', ['0'])[0])
+        rows = min(int(query.get('rows', ['10'])[0]), 1000)
+        packages = [repository.package(index) for index in range(start, min(start + rows, repository.count))]
+        if 'fl' in query:
+            fields = query['fl'][0].split(',')
+            packages = [project_package(pkg_dict, fields) for pkg_dict in packages]
+        body = json.dumps({'success': True, 'result': {'count': repository.count, 'results': packages}})
+        self.send_body(body.encode('utf-8'), 'application/json')
+
+    def pure_feed(self, feed_name):
+        """ Serve a Pure feed file, with an ETag so that the feed cache can revalidate it. """
+        authorization = self.headers.get('Authorization') or ''
+        if not authorization.startswith('Basic ') or not base64.b64decode(authorization[6:]):
+            self.send_empty(401, {'WWW-Authenticate': 'Basic realm="pure"'})
+            return
+        path = self.server.repository.feed_path(feed_name)
+        if not os.path.exists(path):
+            self.send_empty(404)
+            return
+        stat = os.stat(path)
+        etag = '"%s"' % hashlib.sha1(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_empty(304, {'ETag': etag})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(stat.st_size))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+
+class StandinServer(ThreadingHTTPServer):
+    """
+    Local HTTP stand-in for the CKAN package_search API and the Pure support server feeds.
+
+    CKAN is served at the root URL and the Pure feeds under /pure/, which is the URL to put in ".auth_tokens";
+    any credentials are accepted.  The number of requests and the time spent serving each endpoint are
+    recorded in request_stats.
+    """
+    daemon_threads = True
+
+    def __init__(self, repository, port=0, latency=0.0):
+        super().__init__(('127.0.0.1', port), StandinRequestHandler)
+        self.repository = repository
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.request_stats = {}
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def record_request(self, endpoint, seconds):
+        with self.lock:
+            stats = self.request_stats.setdefault(endpoint, {'requests': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+
+    def reset_stats(self):
+        with self.lock:
+            stats, self.request_stats = self.request_stats, {}
+        return stats
+
+    def start(self):
+        """ Serve requests in a background thread. """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.repository.close()
+
+
+def write_auth_tokens(directory, server_url):
+    """ Write an ".auth_tokens" file pointing ckan2pure.py at the stand-in Pure feeds. """
+    with open(os.path.join(directory, '.auth_tokens'), 'w') as f:
+        f.write(f'{server_url}/pure/\nbenchmark\nbenchmark\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic or recorded CKAN and Pure data for benchmarks')
+    parser.add_argument('--port', nargs=1, type=int, default=[8765], help='Port to listen on')
+    parser.add_argument('--datasets', nargs=1, type=int, default=[1000], help='Number of CKAN datasets')
+    parser.add_argument('--persons', nargs=1, type=int, default=[10000], help='Number of persons in the Pure feed')
+    parser.add_argument('--fixtures', nargs=1, default=[None],
+                        help='Directory with data recorded by record_fixtures.py, instead of synthetic data')
+    parser.add_argument('--latency', nargs=1, type=float, default=[0.0],
+                        help='Seconds added to each package_search request')
+    args = parser.parse_args()
+
+    if args.fixtures[0]:
+        repository = RecordedRepository(args.fixtures[0], args.datasets[0])
+    else:
+        repository = SyntheticRepository(args.datasets[0], args.persons[0])
+    server = StandinServer(repository, args.port[0], args.latency[0])
+    print(f"Serving {repository.count} datasets at {server.url}; Pure feeds at {server.url}/pure/", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        repository.close()
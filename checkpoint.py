@@ -0,0 +1,131 @@
+import json
+import os
+import tempfile
+
+from lxml import etree
+
+# Order of the search results of a checkpointed harvest.  Offsets into CKAN's default order, by relevance and
+# modification time, shift when packages are modified between the runs; in order of creation, only packages
+# deleted before the resume point move the rest, and new packages come last.
+SEARCH_ORDER = 'metadata_created asc,id asc'
+
+
+class HarvestCheckpoint:
+    """
+    Checkpoints of a harvest in progress, so that an interrupted run can be resumed.
+
+    The work directory holds the rendered <dataset> fragments and the other outputs produced so far, such as
+    the ORCID/DOI CSV rows, all appended as the harvest runs, and a checkpoint file.  At each checkpoint the data
+    files are flushed to disk and then the checkpoint file is replaced atomically with the offset of the next
+    CKAN package and the sizes of the data files at that point.  On resume, anything written after the last
+    checkpoint is truncated, the saved fragments are replayed and the harvest continues from the saved offset,
+    so the final output is the same as that of an uninterrupted run.
+
+    Each fragment record is a line of JSON with the record kind ('dataset' or 'quarantine'), the fragment
+    size and, for quarantined datasets, the schema errors, followed by the serialized element.  Replayed
+    elements are written out again as freshly rendered ones are; they serialize the same bytes because
+    build_dataset() leaves no empty text, which parsing would turn into self-closing tags.
+    """
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.checkpoint_file = os.path.join(work_dir, 'checkpoint.json')
+        self.fragments_file = os.path.join(work_dir, 'datasets.fragments')
+        self.state = None
+        self.fragments = None
+        # Open work files of the other outputs, by name.
+        self.outputs = {}
+
+    def load(self):
+        """ Return the saved checkpoint, or None if there is none. """
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        with open(self.checkpoint_file) as file:
+            return json.load(file)
+
+    def start(self, settings, state=None):
+        """
+        Open the work files for a harvest described by settings, a JSON-serializable dictionary.  To resume,
+        pass the checkpoint returned by load(); otherwise any previous checkpoint is discarded.
+        """
+        os.makedirs(self.work_dir, exist_ok=True)
+        if state is None:
+            state = {'settings': settings, 'next_offset': None, 'num_datasets': None, 'fragments_size': 0,
+                     'output_sizes': {}}
+            if os.path.exists(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
+        self.state = state
+        self.fragments = self.open_truncated(self.fragments_file, state['fragments_size'], binary=True)
+
+    def open_truncated(self, path, size, binary=False):
+        """ Open a work file for appending, after dropping anything written since the last checkpoint. """
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        file = open(path, 'r+b') if binary else open(path, 'r+', newline='')
+        file.seek(size)
+        file.truncate()
+        return file
+
+    def output_path(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def open_output(self, name):
+        """
+        Return the text file an output, e.g. 'orcid-doi.csv', is written to while the harvest runs.  The output is
+        moved into place by finish().
+        """
+        self.outputs[name] = self.open_truncated(self.output_path(name), self.state['output_sizes'].get(name, 0))
+        return self.outputs[name]
+
+    def write_record(self, dataset, kind, comment=None):
+        fragment = etree.tostring(dataset, with_tail=False)
+        header = {'kind': kind, 'size': len(fragment)}
+        if comment is not None:
+            header['comment'] = comment
+        self.fragments.write(json.dumps(header).encode('utf-8') + b'\n')
+        self.fragments.write(fragment)
+
+    def add_dataset(self, dataset):
+        self.write_record(dataset, 'dataset')
+
+    def add_quarantined(self, dataset, comment):
+        self.write_record(dataset, 'quarantine', comment)
+
+    def replay(self):
+        """
+        Yield a (kind, dataset, comment) tuple for each fragment saved up to the last checkpoint, in the order
+        they were added.
+        """
+        with open(self.fragments_file, 'rb') as file:
+            while file.tell() < self.state['fragments_size']:
+                header = json.loads(file.readline())
+                yield header['kind'], etree.fromstring(file.read(header['size'])), header.get('comment')
+
+    def save(self, next_offset, num_datasets):
+        """ Record that all packages before next_offset, of num_datasets in the search results, are done. """
+        for file in [self.fragments] + list(self.outputs.values()):
+            file.flush()
+            os.fsync(file.fileno())
+        self.state['next_offset'] = next_offset
+        self.state['num_datasets'] = num_datasets
+        self.state['fragments_size'] = self.fragments.tell()
+        self.state['output_sizes'] = {name: file.tell() for name, file in self.outputs.items()}
+        with tempfile.NamedTemporaryFile('w', dir=self.work_dir, delete=False) as file:
+            json.dump(self.state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file.name, self.checkpoint_file)
+
+    def finish(self, destinations=None):
+        """
+        Remove the work files after a successful harvest, moving each output to its path in destinations, a
+        dictionary by output name.
+        """
+        self.fragments.close()
+        for name, file in self.outputs.items():
+            file.close()
+            if destinations and destinations.get(name):
+                os.replace(self.output_path(name), destinations[name])
+        paths = [self.checkpoint_file, self.fragments_file] + [self.output_path(name) for name in self.outputs]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
@@ -1,12 +1,12 @@
 import argparse
+import os
 import sys
-from urllib.request import urlopen
-import json
 import time
-import csv
+from collections import namedtuple
+from urllib.parse import quote
 
-from pure_parse import urlopen_with_basic_auth
-from utils import render_package, xml_init, write_xml, validate_xml, print_stderr
+# The harvest modules, and lxml, yaml and urllib3 with them, are imported by the functions below when they are
+# first needed, so that importing this module and running --help or --version stay fast.
 
 __version_info__ = ('2026', '04', '27')
 __version__ = '-'.join(__version_info__)
@@ -27,12 +27,89 @@ Required authentication method:   a two-line file named ".auth_tokens" with cred
 
 Optional arguments:
 
-       --ckan-url         Base URL for CKAN repository; default is "https://data.ucar.edu"
+       --ckan-url         Base URL for CKAN repository; default is "https://data.ucar.edu".  Several repositories
+                          can be given; they are harvested concurrently into one feed, and per-repository
+                          throughput is reported.  A URL may end in "?fq=FILTER" to select the repository's
+                          datasets with its own package_search filter instead of "resource-type:dataset".
+       --duplicate-precedence  Which package goes into the feed when several have the same guid: "first" (the
+                          default) takes it from the repository listed first, "newest" the most recently
+                          modified one.  Applies to harvests of several repositories.
        --test             Generate output for the first ten datasets only
        --use-namespaces   Use qualified namespaces.  Should be selected if --validate is selected.
        --validate         Perform XSD schema validation on the XML output
        --add-extra        Add extra concepts from the Pure Schema to XML output
        --orcid-doi-map    Write CSV file with ORCIDs and DOIs
+       --json-lines       Also write a JSON line per CKAN package to the given file, with its dataset ID, title,
+                          authors and how each was resolved in Pure, and whether it is in the feed or why not
+       --extract-only     Write only the --orcid-doi-map and --json-lines outputs, without building XML.  The CSV
+                          then lists the authors of all datasets, also those left out of the feed, and without
+                          --json-lines no Pure lookups are made.
+       --fetch-workers    Number of CKAN result pages to download concurrently; default is 4
+       --page-size        Number of packages per CKAN result page.  By default the page size adapts to the response
+                          sizes and latency of the CKAN server, between 50 and 1000 packages.
+       --project-fields   Request only the package fields used to render datasets from CKAN, with the package_search
+                          "fl" parameter (CKAN 2.9 or later), instead of the complete package dictionaries
+       --stream           Write each dataset as soon as it is rendered instead of building the full XML tree
+       --output           Write the XML output to the given file instead of standard output
+       --feed-cache-dir   Directory for local copies of the Pure feeds; default is ".pure_cache"
+       --feed-ttl         Seconds a cached Pure feed is used before it is revalidated; default is 0
+       --offline          Use only the cached Pure feeds, without contacting the Pure servers
+       --pure-snapshot    Look up Pure persons and organisations in the given snapshot file, an indexed SQLite
+                          database made with --build-snapshot, instead of downloading and parsing the Pure feeds
+       --build-snapshot   Build the --pure-snapshot file from the current Pure feeds and exit.  Rebuild it to pick
+                          up changes in Pure; the file is replaced atomically, also while harvests are using it.
+       --incremental      Re-render only datasets modified since the last harvest and merge them into the
+                          feed given with --output.  The first run with this flag does a full harvest.
+       --state-file       File recording the last harvest for --incremental; default is "harvest_state.json"
+       --fragment-cache   Reuse rendered datasets from previous runs when neither the dataset nor the Pure feeds
+                          and author team files have changed.  The cache is kept in the feed cache directory.
+       --fragment-cache-size  Maximum size of the rendered dataset cache in MB; default is 512
+       --author-cache     Remember the Pure IDs found for authors, across datasets and runs, until the Pure persons
+                          feed or the author team files change.  The cache is kept in the feed cache directory.
+       --fuzzy-names      Match author names that are not found exactly in the Pure persons feed approximately,
+                          ignoring accents and punctuation and accepting initials, short first names and parts of
+                          hyphenated last names.  Each match and its confidence (0 to 1) is reported on stderr.
+       --fuzzy-threshold  Lowest confidence accepted for a --fuzzy-names match; default is 0.9
+       --fuzzy-margin     Reject a --fuzzy-names match if another person's confidence is within this margin of
+                          it; default is 0.05
+       --http-timeout     Seconds to wait for a CKAN or Pure server to respond; default is 60
+       --http-retries     Number of times a failed or rate-limited request is retried; default is 5
+       --render-workers   Number of processes rendering datasets in parallel; default is 1
+       --validate-each    Validate each dataset against the XSD schema as it is rendered.  Invalid datasets are
+                          left out of the feed and written to the --quarantine file with their schema errors.
+       --quarantine       File for datasets that fail --validate-each; default is "quarantine.xml"
+       --metrics          Write stage timings and counters (pages fetched, bytes received, datasets rendered or
+                          filtered out, author matches) to the given file
+       --metrics-format   Format of the --metrics file: "json" (the default) or "prometheus"
+       --profile          Profile the run with cProfile and save the statistics to the given file.  The most
+                          expensive functions are also printed.  Rendering workers are not profiled.
+       --checkpoint       Save the progress of the harvest in --work-dir every 500 datasets, or every --page-size
+                          datasets, so an interrupted run can be continued with --resume.  Datasets are harvested
+                          in order of creation, so that datasets modified meanwhile keep their place.
+       --resume           Continue an interrupted harvest from its last checkpoint, with the same options.  The
+                          output is the same as that of an uninterrupted run.  Datasets created meanwhile are
+                          harvested at the end; if datasets were deleted, the harvest must start anew.
+       --work-dir         Directory for harvest checkpoints; default is ".harvest_work"
+       --shard-dir        Write the feed as a directory of shards, each a complete <datasets> document, instead of
+                          a single document.  A manifest.json lists the checksums and dataset IDs of the shards.
+       --shard-size       Maximum number of datasets in a shard; default is 1000
+       --shard-max-mb     Maximum size of a shard in MB, before compression
+       --compress         Compress the shards with "gzip" or "zstd" (requires the zstandard package)
+       --diff-manifest    Write only the datasets that are new or changed since the run that saved the given
+                          manifest file.  The manifest records a digest of each dataset and is updated by the run.
+       --removed-ids      Output file for the ids of datasets removed since the --diff-manifest run, one per line;
+                          default is "removed-ids.txt"
+       --serve            Run as a service that keeps the Pure lookups in memory and maintains the --output feed.
+                          The feed is regenerated at startup and on request, and the datasets of single CKAN
+                          packages can be refreshed in seconds, over HTTP:
+                              POST /regenerate               regenerate the full feed in the background
+                              POST /regenerate?id=ID&id=...  re-render the given packages (IDs or names) now
+                              GET  /status                   state of the lookups and the last regenerations
+                              GET  /metrics                  stage timings and counters, in Prometheus format
+       --serve-address    Address the service listens on; default is 127.0.0.1
+       --serve-port       Port the service listens on; default is 8080
+       --refresh-interval Seconds between checks of the Pure feeds and author team files for changes, which
+                          reload the lookups of the service; default is 3600
        
        --version          Print the program version and exit.
        -h, --help         Show this help message and exit
@@ -40,6 +117,23 @@ Optional arguments:
 
 Program Version: '''
 
+DEFAULT_CKAN_URL = 'https://data.ucar.edu'
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+# package_search filter for the datasets of a repository, unless --ckan-url gives another.
+DEFAULT_FILTER_QUERY = 'resource-type:dataset'
+
+# File written by --orcid-doi-map.
+ORCID_DOI_FILE = 'orcid-doi.csv'
+
+# A dataset yielded by iter_datasets(): the ID of its CKAN package, its Pure dataset ID, and its <dataset> element
+# as XML text, exactly as it appears in the feed.
+RenderedDataset = namedtuple('RenderedDataset', ['package_id', 'dataset_id', 'xml'])
+
+
+class OptionError(ValueError):
+    """ Raised by convert() and iter_datasets() for options that are invalid or cannot be combined. """
+
+
 class PrintHelpOnErrorParser(argparse.ArgumentParser):
     def error(self, message):
         sys.stderr.write('error: %s\n' % message)
@@ -47,94 +141,659 @@ class PrintHelpOnErrorParser(argparse.ArgumentParser):
         sys.exit(2)
 
 
-#
-#  Parse the command line options.
-#
-programHelp = PROGRAM_DESCRIPTION + __version__
-#parser = argparse.ArgumentParser(description=programHelp)
-parser = PrintHelpOnErrorParser(description=programHelp, formatter_class=argparse.RawTextHelpFormatter)
-
-#parser.add_argument("--username", nargs=1, required=True, help="Username for Pure support servers")
-#parser.add_argument("--password", nargs=1, required=True, help="Password for Pure support servers")
-
-parser.add_argument("--ckan-url", nargs=1, help="CKAN base URL", default=['https://data.ucar.edu'])
-parser.add_argument("--test", help="Produce output for at most ten datasets", action='store_const', const=True)
-parser.add_argument("--use-namespaces", help="Add qualified namespaces to elements", action='store_const', const=True)
-parser.add_argument("--validate", help="Perform XSD validation; use with --use-namespaces.",
-                    action='store_const', const=True)
-parser.add_argument("--add-extra", help="Add extra Pure concepts", action='store_const', const=True)
-parser.add_argument("--orcid-doi-map", help="Write CSV file with ORCIDs and DOIs", action='store_const', const=True)
-parser.add_argument('--version', action='version', version="%(prog)s (" + __version__ + ")")
-
-args = parser.parse_args()
-
-CKAN_URL = args.ckan_url[0]
-TEST_OUTPUT = args.test
-USE_NAMESPACES = args.use_namespaces
-VALIDATE_XML = args.validate
-ADD_EXTRA_CONCEPTS = args.add_extra
-ORCID_DOI_MAP = args.orcid_doi_map
-
-# Time the program's run length
-start_time = time.time()
-
-csvfile=None
-csv_writer = None
-if ORCID_DOI_MAP:
-    fields = ['DOI', 'dataset_id', 'ORCID', 'name']
-    csvfile = open('orcid-doi.csv', 'w', newline='')
-    csv_writer = csv.DictWriter(csvfile, fieldnames=fields)
-
-
-# URL for getting the list of package names
-package_search_query = CKAN_URL + '/api/3/action/package_search?fq=resource-type:dataset'
-
-with urlopen(package_search_query) as url:
-    response = url.read()
-
-json_data = json.loads(response.decode('utf-8'))
-
-num_datasets = json_data['result']['count']
-#datasets = json_data['result']['results']  # extract all the packages from the response
-print_stderr(num_datasets)
-
-max_rows = 500
-if TEST_OUTPUT:
-    start = num_datasets - 10
-else:
-    start = 0
-    # num_datasets = min(10, len(datasets))
-    # datasets = datasets[:num_datasets]
-
-root = xml_init(USE_NAMESPACES)
-
-while start < num_datasets:
-    query = package_search_query + f'&start={start}&rows={max_rows}'
-    with urlopen(query) as url:
-        response = url.read()
-    json_data = json.loads(response.decode('utf-8'))
-    datasets = json_data['result']['results']  # extract all the packages from the response
-    for pkg_dict in datasets:
-        # package_get = CKAN_URL + '/api/3/action/package_show?id=' + dataset_name
-        # with urlopen(package_get) as url:
-        #     response = url.read()
-        # json_data = json.loads(response.decode('utf-8'))
-        # pkg_dict = json_data['result']
-        print_stderr(pkg_dict['title'])
-        render_package(root, pkg_dict, csv_writer, ADD_EXTRA_CONCEPTS)
-    start = start + max_rows
-
-if ORCID_DOI_MAP:
-    csvfile.close()
-
-xml_header = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
-write_xml(root, xml_header)
-
-if VALIDATE_XML:
-    validate_xml(root)
-    print_stderr("\n\n  VALIDATION PASSED\n\n")
-
-# Print out the running time.
-running_time_secs = (time.time() - start_time)
-print_stderr("--- %s seconds ---" % running_time_secs)
-print_stderr("--- %s minutes ---" % (running_time_secs / 60))
+def get_package_search_query(ckan_url):
+    """
+    Return the package_search URL for the datasets of a CKAN repository.  The base URL may be followed by the
+    repository's own filter query, e.g. 'https://data.example.org?fq=organization:ncar'; by default it is
+    'resource-type:dataset'.
+    """
+    base_url, _, filter_query = ckan_url.partition('?fq=')
+    return base_url + '/api/3/action/package_search?fq=' + quote(filter_query or DEFAULT_FILTER_QUERY, safe=':')
+
+
+def check_harvest_options(page_size, fuzzy_threshold, fuzzy_margin):
+    if not 0 <= fuzzy_threshold <= 1 or not 0 <= fuzzy_margin <= 1:
+        raise OptionError("--fuzzy-threshold and --fuzzy-margin must be between 0 and 1")
+    if page_size is not None and page_size < 1:
+        raise OptionError("--page-size must be at least 1")
+
+
+def start_harvest(fetch_workers, feed_cache_dir, feed_ttl, offline, fuzzy_matching, http_timeout, http_retries,
+                  pure_snapshot=None):
+    """
+    Configure the HTTP client, the Pure feed cache or snapshot and author name matching for a harvest.
+    Lookups, caches and measurements left by an earlier harvest in the same process are discarded.
+    """
+    from http_client import configure_http_client
+    from metrics import get_metrics
+    from pure_parse import configure_feed_cache, configure_fuzzy_matching, configure_pure_snapshot, \
+        reset_pure_lookups
+
+    get_metrics().drain()
+    reset_pure_lookups()
+    configure_http_client(http_timeout, http_retries, max_connections=max(10, fetch_workers))
+    configure_feed_cache(feed_cache_dir, feed_ttl, offline)
+    if fuzzy_matching:
+        configure_fuzzy_matching(**fuzzy_matching)
+    if pure_snapshot:
+        configure_pure_snapshot(pure_snapshot)
+
+
+def iter_datasets(ckan_url=DEFAULT_CKAN_URL, *, use_namespaces=False, add_extra=False, csv_writer=None,
+                  test=False, fetch_workers=4, page_size=None, project_fields=False, feed_cache_dir='.pure_cache',
+                  feed_ttl=0, offline=False, fuzzy_names=False, fuzzy_threshold=0.9, fuzzy_margin=0.05,
+                  http_timeout=60, http_retries=5, pure_snapshot=None):
+    """
+    Harvest a CKAN repository and yield a RenderedDataset for each dataset of the Pure feed, in feed order, as
+    soon as it has been rendered.  Packages left out of the feed are skipped.  The ORCID/DOI rows of the
+    datasets are written to csv_writer, e.g. a csv.DictWriter, if one is given.  Datasets are rendered in the
+    calling process; the other options are those of convert().
+    """
+    check_harvest_options(page_size, fuzzy_threshold, fuzzy_margin)
+    from ckan_api import package_search, iter_package_pages, PageSizer
+    from metrics import get_metrics
+    from package_record import PackageRecord, PROJECTED_FIELDS
+    from utils import render_package, DatasetSerializer
+
+    start_harvest(fetch_workers, feed_cache_dir, feed_ttl, offline,
+                  {'threshold': fuzzy_threshold, 'margin': fuzzy_margin} if fuzzy_names else None,
+                  http_timeout, http_retries, pure_snapshot)
+    metrics = get_metrics()
+    package_search_query = get_package_search_query(ckan_url)
+    num_datasets = package_search(package_search_query + '&rows=0')['count']
+    start = num_datasets - 10 if test else 0
+    page_query = package_search_query
+    if project_fields:
+        page_query += '&fl=' + ','.join(PROJECTED_FIELDS)
+    serializer = DatasetSerializer(use_namespaces)
+    for packages in iter_package_pages(page_query, start, num_datasets, page_size or 500, fetch_workers,
+                                       PageSizer() if page_size is None else None):
+        for pkg_dict in packages:
+            package = PackageRecord(pkg_dict)
+            with metrics.stage('render'):
+                dataset = render_package(package, csv_writer, add_extra)
+            if dataset is not None:
+                yield RenderedDataset(package.id, dataset.get('id'), serializer.serialize(dataset))
+
+
+def convert(ckan_url=DEFAULT_CKAN_URL, output_file=None, *, test=False, use_namespaces=False, validate=False,
+            add_extra=False, orcid_doi_file=None, json_lines_file=None, extract_only=False, sinks=None,
+            fetch_workers=4, page_size=None, project_fields=False, stream=False, feed_cache_dir='.pure_cache',
+            feed_ttl=0, offline=False, incremental=False, state_file='harvest_state.json', fragment_cache=False,
+            fragment_cache_size=512, author_cache=False, fuzzy_names=False, fuzzy_threshold=0.9, fuzzy_margin=0.05,
+            http_timeout=60, http_retries=5, render_workers=1, validate_each=False, quarantine_file='quarantine.xml',
+            metrics_file=None, metrics_format='json', checkpoint=False, resume=False, work_dir='.harvest_work',
+            shard_dir=None, shard_size=1000, shard_max_mb=None, compress=None, diff_manifest=None,
+            removed_ids_file='removed-ids.txt', pure_snapshot=None, duplicate_precedence='first'):
+    """
+    Harvest a CKAN repository into a Pure XML feed, written to output_file or to standard output.  ckan_url may
+    also be a list of repositories, which are harvested concurrently into one feed, see MultiRepositoryHarvest.
+
+    The options are those of the command line, see PROGRAM_DESCRIPTION, except that orcid_doi_file,
+    json_lines_file, quarantine_file, metrics_file and removed_ids_file name the files written for
+    --orcid-doi-map, --json-lines, --quarantine, --metrics and --removed-ids.  sinks is a list of additional
+    sinks.Sink objects, which are fed every package of the same pass; they are not restored when a harvest is
+    resumed.  Progress is reported on standard error.  Returns the stage timings and counters of the run, as
+    written by --metrics in JSON format.  Raises OptionError if options are invalid or cannot be combined.
+    """
+    if stream and validate:
+        raise OptionError("--validate needs the complete XML tree and cannot be combined with --stream; "
+                          "use --validate-each")
+    if incremental and not output_file:
+        raise OptionError("--incremental needs the previous feed; use it with --output")
+    if incremental and validate:
+        raise OptionError("--validate needs the complete XML tree and cannot be combined with --incremental; "
+                          "use --validate-each")
+    if shard_dir and (output_file or incremental):
+        raise OptionError("--shard-dir cannot be combined with --output or --incremental")
+    if shard_dir and validate:
+        raise OptionError("--validate needs the complete XML tree and cannot be combined with --shard-dir; "
+                          "use --validate-each")
+    if compress and not shard_dir:
+        raise OptionError("--compress applies to the shards written with --shard-dir")
+    if compress:
+        from sharded_output import get_compressor
+        try:
+            get_compressor(compress)
+        except RuntimeError as e:
+            raise OptionError(str(e))
+    check_harvest_options(page_size, fuzzy_threshold, fuzzy_margin)
+    if (checkpoint or resume) and incremental:
+        raise OptionError("--checkpoint and --resume cannot be combined with --incremental")
+    if extract_only and not (orcid_doi_file or json_lines_file or sinks):
+        raise OptionError("--extract-only needs --orcid-doi-map or --json-lines")
+    if extract_only and (output_file or stream or validate or validate_each or shard_dir or incremental or
+                         fragment_cache):
+        raise OptionError("--extract-only builds no XML and cannot be combined with --output, --stream, "
+                          "--validate, --validate-each, --shard-dir, --incremental or --fragment-cache")
+    repositories = [ckan_url] if isinstance(ckan_url, str) else list(ckan_url)
+    multi_repository = len(repositories) > 1
+    if not multi_repository:
+        ckan_url = repositories[0]
+    if multi_repository and (incremental or checkpoint or resume):
+        raise OptionError("--incremental, --checkpoint and --resume cannot be used with several --ckan-url "
+                          "repositories")
+    from multi_harvest import MultiRepositoryHarvest, DUPLICATE_PRECEDENCE_RULES
+    if duplicate_precedence not in DUPLICATE_PRECEDENCE_RULES:
+        raise OptionError(f"--duplicate-precedence must be one of {', '.join(DUPLICATE_PRECEDENCE_RULES)}")
+    if diff_manifest and (incremental or extract_only or checkpoint or resume):
+        raise OptionError("--diff-manifest cannot be combined with --incremental, --extract-only, --checkpoint "
+                          "or --resume")
+
+    from checkpoint import HarvestCheckpoint, SEARCH_ORDER
+    from ckan_api import package_search, iter_package_pages, list_package_ids, PageSizer
+    from feed_diff import DatasetManifest, DiffSink
+    from fragment_cache import FragmentCache, file_fingerprint, rendering_code_fingerprint
+    from incremental import HarvestState, merge_feed, utc_timestamp, CLOCK_SKEW_MARGIN
+    from metrics import get_metrics
+    from package_record import PackageRecord, PROJECTED_FIELDS
+    from parallel_render import ParallelRenderer
+    from pure_parse import configure_author_cache, get_author_cache, pure_feed_fingerprint, refresh_pure_feeds
+    from sharded_output import ShardedWriter
+    from sinks import XMLSink, ORCIDDOISink, JSONLinesSink
+    from utils import render_record, validate_xml, print_stderr, XMLStreamWriter, XMLTreeWriter, \
+        get_dataset_validation_error, report_cached_dataset
+
+    fuzzy_matching = {'threshold': fuzzy_threshold, 'margin': fuzzy_margin} if fuzzy_names else None
+    shard_max_bytes = int(shard_max_mb * 1024 * 1024) if shard_max_mb else None
+    # Shards are always written as the datasets stream in.
+    stream = stream or bool(shard_dir)
+    # Without XML, the authors are looked up in Pure only for outputs that report the lookups; the ORCID/DOI
+    # CSV needs just the ORCID iDs from CKAN.
+    extract = None
+    if extract_only:
+        extract = 'resolve' if json_lines_file or sinks else 'orcids'
+
+    # Time the program's run length
+    start_time = time.time()
+    start_cpu_time = time.process_time()
+    start_harvest(fetch_workers, feed_cache_dir, feed_ttl, offline, fuzzy_matching, http_timeout, http_retries,
+                  pure_snapshot)
+    metrics = get_metrics()
+
+    # URL for getting the list of package names
+    package_search_query = None if multi_repository else get_package_search_query(ckan_url)
+
+    harvest_checkpoint = None
+    resume_state = None
+    if checkpoint or resume:
+        package_search_query += '&sort=' + quote(SEARCH_ORDER)
+        harvest_checkpoint = HarvestCheckpoint(work_dir)
+        # A checkpoint can only be resumed by a run that would produce the same output.
+        harvest_settings = {'version': __version__, 'ckan_url': ckan_url, 'test': bool(test),
+                            'use_namespaces': bool(use_namespaces), 'add_extra': bool(add_extra),
+                            'orcid_doi_map': bool(orcid_doi_file), 'json_lines': bool(json_lines_file),
+                            'extract_only': bool(extract_only), 'validate_each': bool(validate_each),
+                            'fuzzy_matching': fuzzy_matching, 'sort': SEARCH_ORDER}
+        if resume:
+            resume_state = harvest_checkpoint.load()
+            if resume_state is None:
+                print_stderr(f"No checkpoint found in {work_dir}, starting a new harvest")
+            elif resume_state['settings'] != harvest_settings:
+                raise OptionError(f"the checkpoint in {work_dir} was made with different options: "
+                                  f"{resume_state['settings']}")
+            else:
+                print_stderr(f"Resuming the harvest at dataset {resume_state['next_offset']}")
+        harvest_checkpoint.start(harvest_settings, resume_state)
+
+    def open_output(name, path):
+        """ Open an output file, or its work file in the checkpoint, which is moved into place at the end. """
+        if harvest_checkpoint:
+            return harvest_checkpoint.open_output(name)
+        return open(path, 'w', newline='')
+
+    # Every package is passed to each sink in turn, so all outputs are produced in a single pass.
+    output_sinks = []
+    if orcid_doi_file:
+        output_sinks.append(ORCIDDOISink(open_output('orcid-doi.csv', orcid_doi_file)))
+    if json_lines_file:
+        output_sinks.append(JSONLinesSink(open_output('datasets.jsonl', json_lines_file)))
+    output_sinks.extend(sinks or [])
+
+    # Fuzzy name matching finds authors that exact matching does not, so cached results depend on its settings.
+    name_matching_fingerprint = []
+    if fuzzy_matching:
+        name_matching_fingerprint = ['fuzzy:{threshold}:{margin}'.format(**fuzzy_matching)]
+
+    dataset_cache = None
+    if fragment_cache:
+        # Any change to the program, the Pure feeds or the author team files invalidates all cached datasets.
+        context_fingerprint = '|'.join([__version__, rendering_code_fingerprint(),
+                                        pure_feed_fingerprint('persons'),
+                                        pure_feed_fingerprint('costcenters'),
+                                        file_fingerprint('author_orgs.yaml'),
+                                        file_fingerprint('author_org_ids.yaml')] + name_matching_fingerprint)
+        dataset_cache = FragmentCache(os.path.join(feed_cache_dir, 'fragments.sqlite'),
+                                      fragment_cache_size * 1024 * 1024, context_fingerprint)
+
+    author_cache_config = None
+    if author_cache and extract != 'orcids':
+        # Resolutions depend on the persons feed and the author team files, so a change to them empties the cache.
+        author_cache_config = (os.path.join(feed_cache_dir, 'authors.sqlite'),
+                               '|'.join([__version__,
+                                         pure_feed_fingerprint('persons'),
+                                         file_fingerprint('author_orgs.yaml'),
+                                         file_fingerprint('author_org_ids.yaml')] + name_matching_fingerprint))
+        configure_author_cache(*author_cache_config)
+
+    def render_dataset(package):
+        """
+        Render a PackageRecord with render_record, or reuse the cached result if none of its inputs have changed.
+        Returns the <dataset> element and the resolution.
+        """
+        if dataset_cache is None:
+            with metrics.stage('render'):
+                return render_record(package, add_extra, extract)
+        key = dataset_cache.key(package, add_extra)
+        found, dataset, resolution = dataset_cache.get(key)
+        if found:
+            report_cached_dataset(package, dataset, resolution)
+            return dataset, resolution
+        with metrics.stage('render'):
+            dataset, resolution = render_record(package, add_extra)
+        dataset_cache.put(key, dataset, resolution)
+        return dataset, resolution
+
+    harvest_state = None
+    delta_harvest = False
+    if incremental:
+        harvest_state = HarvestState.load(state_file)
+        harvest_started = utc_timestamp(CLOCK_SKEW_MARGIN)
+        # Datasets left unchanged in CKAN render differently when the Pure feeds or author team files change.
+        harvest_context = '|'.join([__version__, pure_feed_fingerprint('persons'),
+                                    pure_feed_fingerprint('costcenters'), file_fingerprint('author_orgs.yaml'),
+                                    file_fingerprint('author_org_ids.yaml'), f'add_extra:{bool(add_extra)}'] +
+                                   name_matching_fingerprint)
+        delta_harvest = harvest_state.last_harvest is not None and os.path.exists(output_file)
+        if delta_harvest and harvest_state.context != harvest_context:
+            print_stderr("The Pure feeds, author team files or options changed since the last harvest; "
+                         "harvesting all datasets")
+            harvest_state = HarvestState()
+            delta_harvest = False
+        harvest_state.context = harvest_context
+
+    removed_ids = set()
+    if delta_harvest:
+        # Datasets that disappeared from CKAN since the last harvest are removed from the feed.
+        current_package_ids = list_package_ids(package_search_query, fetch_workers)
+        for package_id in list(harvest_state.datasets):
+            if package_id not in current_package_ids:
+                if harvest_state.guid(package_id) is not None:
+                    removed_ids.add(harvest_state.guid(package_id))
+                del harvest_state.datasets[package_id]
+        print_stderr(f"{len(removed_ids)} datasets removed since {harvest_state.last_harvest}")
+        package_search_query += quote(f' AND metadata_modified:[{harvest_state.last_harvest} TO *]')
+
+    # Pages start at max_rows packages, and change size with the page sizer unless a page size is given.
+    # Progress is checkpointed every max_rows packages.
+    max_rows = page_size or 500
+    page_sizer = PageSizer(max_rows) if page_size is None else None
+    fields_parameter = '&fl=' + ','.join(PROJECTED_FIELDS) if project_fields else ''
+    page_query = package_search_query and package_search_query + fields_parameter
+    if multi_repository:
+        # Each repository's thread finds its own range of search results.
+        start = 0
+        repository_harvest = MultiRepositoryHarvest([(url, get_package_search_query(url)) for url in repositories],
+                                                    fetch_workers, page_size, fields_parameter, test,
+                                                    duplicate_precedence)
+    elif resume_state:
+        # Continue with the range of search results of the interrupted run, which may have grown since.
+        num_datasets = package_search(package_search_query + '&rows=0')['count']
+        start = resume_state['next_offset']
+        if num_datasets < resume_state['num_datasets']:
+            raise OptionError(f"CKAN has {num_datasets} datasets, {resume_state['num_datasets'] - num_datasets} "
+                              f"fewer than when the checkpoint in {work_dir} was saved, so the datasets after the "
+                              f"checkpoint may have moved; start a new harvest without --resume")
+        if num_datasets > resume_state['num_datasets']:
+            print_stderr(f"CKAN has {num_datasets - resume_state['num_datasets']} more datasets than when the "
+                         f"checkpoint was saved; they are harvested at the end")
+    else:
+        num_datasets = package_search(package_search_query + '&rows=0')['count']
+        print_stderr(num_datasets)
+
+        if test:
+            start = num_datasets - 10
+        else:
+            start = 0
+
+    writer = None
+    if delta_harvest:
+        # Changed datasets are collected here and merged into the previous feed once the harvest is complete.
+        replacements = {}
+        additions = []
+    elif extract_only:
+        pass
+    elif shard_dir:
+        writer = ShardedWriter(use_namespaces, XML_HEADER, shard_dir, shard_size, shard_max_bytes, compress)
+    elif stream:
+        writer = XMLStreamWriter(use_namespaces, XML_HEADER, output_file)
+    else:
+        writer = XMLTreeWriter(use_namespaces, XML_HEADER, output_file)
+    manifest = None
+    if diff_manifest:
+        # Only new and changed datasets go into the feed, and the ids of removed ones into removed_ids_file.
+        manifest = DatasetManifest.load(diff_manifest, {'ckan_url': ckan_url, 'test': bool(test)})
+        output_sinks.insert(0, DiffSink(writer, manifest, removed_ids_file))
+    elif writer:
+        output_sinks.insert(0, XMLSink(writer, harvest_checkpoint))
+
+    quarantine = None
+    if validate_each:
+        quarantine = XMLStreamWriter(use_namespaces, XML_HEADER, quarantine_file)
+        quarantined_count = 0
+
+    if resume_state:
+        # Restore the datasets completed before the interruption.
+        for kind, dataset, comment in harvest_checkpoint.replay():
+            if kind == 'quarantine':
+                quarantine.write(dataset, comment=comment)
+                quarantined_count += 1
+            else:
+                writer.write(dataset)
+
+    def iter_packages():
+        """
+        Yield a PackageRecord for each CKAN package to be rendered, in search result order.
+        """
+        if multi_repository:
+            packages = iter(repository_harvest)
+        else:
+            # Pages are prefetched concurrently but delivered in order, so the output order is unchanged.
+            packages = (PackageRecord(pkg_dict) for datasets in
+                        iter_package_pages(page_query, start, num_datasets, max_rows, fetch_workers, page_sizer)
+                        for pkg_dict in datasets)
+        for package in packages:
+            if delta_harvest and harvest_state.is_unchanged(package):
+                continue
+            print_stderr(package.title)
+            yield package
+
+    renderer = None
+    if render_workers > 1 and extract != 'orcids':
+        # Workers read the Pure feeds from the cache, unless they use a snapshot, so bring it up to date first.
+        refresh_pure_feeds()
+        renderer = ParallelRenderer(render_workers, feed_cache_dir, add_extra, dataset_cache,
+                                    author_cache=author_cache_config, fuzzy_matching=fuzzy_matching,
+                                    extract=extract, pure_snapshot=pure_snapshot)
+        rendered_packages = renderer.render(iter_packages())
+    else:
+        rendered_packages = ((package, *render_dataset(package)) for package in iter_packages())
+
+    try:
+        for position, (package, dataset, resolution) in enumerate(rendered_packages, start + 1):
+            if dataset is not None and quarantine is not None:
+                with metrics.stage('validate'):
+                    validation_error = get_dataset_validation_error(dataset, use_namespaces)
+                if validation_error:
+                    metrics.count('datasets_quarantined')
+                    print_stderr(f"#### Quarantining invalid dataset '{package.title}': {validation_error}")
+                    quarantine.write(dataset, comment=validation_error)
+                    quarantined_count += 1
+                    if harvest_checkpoint:
+                        harvest_checkpoint.add_quarantined(dataset, validation_error)
+                    dataset = None
+                    resolution['status'] = 'quarantined'
+                    resolution['reason'] = validation_error
+            if incremental:
+                previous_id = harvest_state.guid(package.id)
+                harvest_state.record(package, dataset)
+                if delta_harvest:
+                    if previous_id is not None:
+                        replacements[previous_id] = dataset
+                    elif dataset is not None:
+                        additions.append(dataset)
+            for sink in output_sinks:
+                sink.write(package, resolution, dataset)
+            if harvest_checkpoint and (position - start) % max_rows == 0:
+                # Every package up to this one is done; the harvest can resume from any offset.
+                harvest_checkpoint.save(position, num_datasets)
+    finally:
+        # Stop the worker processes also when the harvest fails, so an embedding process does not keep them.
+        if renderer:
+            renderer.close()
+
+    if multi_repository:
+        repository_harvest.report()
+
+    if quarantine:
+        quarantine.close()
+        print_stderr(f"{quarantined_count} invalid datasets written to {quarantine_file}")
+
+    if dataset_cache:
+        print_stderr(f"Rendered dataset cache: {dataset_cache.hits} hits, {dataset_cache.misses} misses")
+        metrics.count('fragment_cache_lookups', dataset_cache.hits, result='hit')
+        metrics.count('fragment_cache_lookups', dataset_cache.misses, result='miss')
+        dataset_cache.close()
+
+    if fuzzy_matching:
+        print_stderr(f"Fuzzy name matches: {metrics.counter('author_matches', method='fuzzy')}")
+    if author_cache_config:
+        print_stderr(f"Author cache: {metrics.counter('author_cache_lookups', result='hit')} hits, "
+                     f"{metrics.counter('author_cache_lookups', result='miss')} misses")
+        get_author_cache().close()
+
+    if delta_harvest:
+        with metrics.stage('serialize'):
+            print_stderr(f"Merging {len(replacements)} changed and {len(additions)} new datasets into {output_file}")
+            merged_file = output_file + '.tmp'
+            with XMLStreamWriter(use_namespaces, XML_HEADER, merged_file) as merge_writer:
+                merge_feed(output_file, merge_writer, replacements, removed_ids)
+                for dataset in additions:
+                    merge_writer.write(dataset)
+            os.replace(merged_file, output_file)
+    for sink in output_sinks:
+        sink.close()
+    if shard_dir:
+        print_stderr(f"{len(writer.shards)} shards written to {shard_dir}")
+    if manifest:
+        print_stderr("Feed difference: {new} new, {changed} changed, {unchanged} unchanged and {removed} removed "
+                     "datasets".format(**output_sinks[0].counts))
+        manifest.save(diff_manifest)
+
+    if harvest_checkpoint:
+        # The harvest is complete; move the other outputs into place and discard the checkpoint.
+        harvest_checkpoint.finish({'orcid-doi.csv': orcid_doi_file, 'datasets.jsonl': json_lines_file})
+
+    if incremental:
+        harvest_state.last_harvest = harvest_started
+        harvest_state.save(state_file)
+
+    if validate:
+        with metrics.stage('validate'):
+            validate_xml(writer.root)
+        print_stderr("\n\n  VALIDATION PASSED\n\n")
+
+    # Print out the running time.
+    running_time_secs = (time.time() - start_time)
+    cpu_time_secs = time.process_time() - start_cpu_time
+    print_stderr("--- %s seconds ---" % running_time_secs)
+    print_stderr("--- %s minutes ---" % (running_time_secs / 60))
+
+    if metrics_file:
+        metrics.write(metrics_file, metrics_format, running_time_secs, cpu_time_secs)
+    return metrics.as_dict(running_time_secs, cpu_time_secs)
+
+
+def build_snapshot(snapshot_file, *, feed_cache_dir='.pure_cache', feed_ttl=0, offline=False, http_timeout=60,
+                   http_retries=5):
+    """
+    Build or replace the Pure snapshot file used with the pure_snapshot option, from the current Pure feeds.
+    """
+    from pure_parse import build_pure_snapshot
+    from utils import print_stderr
+
+    start_harvest(1, feed_cache_dir, feed_ttl, offline, None, http_timeout, http_retries)
+    start_time = time.time()
+    build_pure_snapshot(snapshot_file)
+    print_stderr(f"Pure snapshot written to {snapshot_file} in {time.time() - start_time:.1f} seconds")
+
+
+def build_parser():
+    """ Return the parser for the command line options. """
+    programHelp = PROGRAM_DESCRIPTION + __version__
+    parser = PrintHelpOnErrorParser(description=programHelp, formatter_class=argparse.RawTextHelpFormatter)
+
+    #parser.add_argument("--username", nargs=1, required=True, help="Username for Pure support servers")
+    #parser.add_argument("--password", nargs=1, required=True, help="Password for Pure support servers")
+
+    parser.add_argument("--ckan-url", nargs='+', help="CKAN base URLs, each optionally followed by ?fq=FILTER",
+                        default=[DEFAULT_CKAN_URL])
+    parser.add_argument("--duplicate-precedence", nargs=1, choices=['first', 'newest'], default=['first'],
+                        help="Which of several packages with the same guid goes into the feed")
+    parser.add_argument("--test", help="Produce output for at most ten datasets", action='store_const', const=True)
+    parser.add_argument("--use-namespaces", help="Add qualified namespaces to elements",
+                        action='store_const', const=True)
+    parser.add_argument("--validate", help="Perform XSD validation; use with --use-namespaces.",
+                        action='store_const', const=True)
+    parser.add_argument("--add-extra", help="Add extra Pure concepts", action='store_const', const=True)
+    parser.add_argument("--orcid-doi-map", help="Write CSV file with ORCIDs and DOIs", action='store_const', const=True)
+    parser.add_argument("--json-lines", nargs=1, help="Write a JSON line per package with its resolution to a file",
+                        default=[None])
+    parser.add_argument("--extract-only", help="Write only the CSV and JSON Lines outputs, without XML",
+                        action='store_const', const=True)
+    parser.add_argument("--fetch-workers", nargs=1, type=int, default=[4],
+                        help="Number of CKAN result pages to download concurrently")
+    parser.add_argument("--page-size", nargs=1, type=int, default=[None],
+                        help="Number of packages per CKAN result page; adapts to the server by default")
+    parser.add_argument("--project-fields", help="Request only the package fields used for rendering from CKAN",
+                        action='store_const', const=True)
+    parser.add_argument("--stream", help="Write datasets incrementally instead of building the full XML tree",
+                        action='store_const', const=True)
+    parser.add_argument("--output", nargs=1, help="Write XML output to a file instead of standard output",
+                        default=[None])
+    parser.add_argument("--feed-cache-dir", nargs=1, help="Directory for cached Pure feeds", default=['.pure_cache'])
+    parser.add_argument("--feed-ttl", nargs=1, type=int, default=[0],
+                        help="Seconds a cached Pure feed is used before it is revalidated")
+    parser.add_argument("--offline", help="Use only cached Pure feeds", action='store_const', const=True)
+    parser.add_argument("--pure-snapshot", nargs=1, help="Look up Pure persons and organisations in a snapshot file",
+                        default=[None])
+    parser.add_argument("--build-snapshot", help="Build the --pure-snapshot file from the Pure feeds and exit",
+                        action='store_const', const=True)
+    parser.add_argument("--incremental", help="Merge datasets modified since the last harvest into the --output feed",
+                        action='store_const', const=True)
+    parser.add_argument("--state-file", nargs=1, help="Harvest state file for --incremental",
+                        default=['harvest_state.json'])
+    parser.add_argument("--fragment-cache", help="Reuse unchanged rendered datasets from previous runs",
+                        action='store_const', const=True)
+    parser.add_argument("--fragment-cache-size", nargs=1, type=int, default=[512],
+                        help="Maximum size of the rendered dataset cache in MB")
+    parser.add_argument("--author-cache", help="Remember author resolutions across datasets and runs",
+                        action='store_const', const=True)
+    parser.add_argument("--fuzzy-names", help="Match author names approximately when there is no exact match",
+                        action='store_const', const=True)
+    parser.add_argument("--fuzzy-threshold", nargs=1, type=float, default=[0.9],
+                        help="Lowest confidence accepted for a fuzzy name match")
+    parser.add_argument("--fuzzy-margin", nargs=1, type=float, default=[0.05],
+                        help="Confidence margin by which a fuzzy name match must beat any other")
+    parser.add_argument("--http-timeout", nargs=1, type=float, default=[60],
+                        help="Seconds to wait for a CKAN or Pure server to respond")
+    parser.add_argument("--http-retries", nargs=1, type=int, default=[5],
+                        help="Number of times a failed or rate-limited request is retried")
+    parser.add_argument("--render-workers", nargs=1, type=int, default=[1],
+                        help="Number of processes rendering datasets in parallel")
+    parser.add_argument("--validate-each", help="Validate each dataset and quarantine invalid ones",
+                        action='store_const', const=True)
+    parser.add_argument("--quarantine", nargs=1, help="Output file for datasets failing --validate-each",
+                        default=['quarantine.xml'])
+    parser.add_argument("--metrics", nargs=1, help="Write stage timings and counters to a file", default=[None])
+    parser.add_argument("--metrics-format", nargs=1, choices=['json', 'prometheus'], default=['json'],
+                        help="Format of the --metrics file")
+    parser.add_argument("--profile", nargs=1, help="Save cProfile statistics for the run to a file", default=[None])
+    parser.add_argument("--checkpoint", help="Save harvest progress after each page of results",
+                        action='store_const', const=True)
+    parser.add_argument("--resume", help="Continue an interrupted harvest from its last checkpoint",
+                        action='store_const', const=True)
+    parser.add_argument("--work-dir", nargs=1, help="Directory for harvest checkpoints", default=['.harvest_work'])
+    parser.add_argument("--shard-dir", nargs=1, help="Write the feed as shard files in a directory", default=[None])
+    parser.add_argument("--shard-size", nargs=1, type=int, default=[1000], help="Maximum number of datasets in a shard")
+    parser.add_argument("--shard-max-mb", nargs=1, type=float, default=[None], help="Maximum size of a shard in MB")
+    parser.add_argument("--compress", nargs=1, choices=['gzip', 'zstd'], default=[None], help="Compress the shards")
+    parser.add_argument("--diff-manifest", nargs=1, default=[None],
+                        help="Write only datasets changed since the run that saved this manifest file")
+    parser.add_argument("--removed-ids", nargs=1, default=['removed-ids.txt'],
+                        help="Output file for the ids of datasets removed since the --diff-manifest run")
+    parser.add_argument("--serve", help="Run as a service maintaining the --output feed",
+                        action='store_const', const=True)
+    parser.add_argument("--serve-address", nargs=1, help="Address the service listens on", default=['127.0.0.1'])
+    parser.add_argument("--serve-port", nargs=1, type=int, default=[8080], help="Port the service listens on")
+    parser.add_argument("--refresh-interval", nargs=1, type=float, default=[3600],
+                        help="Seconds between checks of the Pure feeds for changes in --serve mode")
+    parser.add_argument('--version', action='version', version="%(prog)s (" + __version__ + ")")
+    return parser
+
+
+def main(argv=None):
+    """ Run the command line program with the arguments in argv, by default those of the process. """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.build_snapshot and not args.pure_snapshot[0]:
+        parser.error("--build-snapshot writes the file given with --pure-snapshot")
+    if args.serve and len(args.ckan_url) > 1:
+        parser.error("--serve harvests a single --ckan-url repository")
+    if args.serve and not args.output[0]:
+        parser.error("--serve maintains the feed file given with --output")
+    if args.serve and (args.incremental or args.checkpoint or args.resume or args.shard_dir[0] or args.validate or
+                       args.test or args.fragment_cache or args.author_cache or args.render_workers[0] > 1 or
+                       args.json_lines[0] or args.extract_only or args.diff_manifest[0]):
+        parser.error("--serve cannot be combined with --incremental, --checkpoint, --resume, --shard-dir, "
+                     "--validate, --test, --fragment-cache, --author-cache, --render-workers, --json-lines, "
+                     "--extract-only or --diff-manifest")
+
+    profile_file = args.profile[0]
+    profiler = None
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    orcid_doi_file = ORCID_DOI_FILE if args.orcid_doi_map else None
+    try:
+        if args.build_snapshot:
+            build_snapshot(args.pure_snapshot[0], feed_cache_dir=args.feed_cache_dir[0], feed_ttl=args.feed_ttl[0],
+                           offline=bool(args.offline), http_timeout=args.http_timeout[0],
+                           http_retries=args.http_retries[0])
+            return
+        if args.serve:
+            check_harvest_options(args.page_size[0], args.fuzzy_threshold[0], args.fuzzy_margin[0])
+            from feed_service import FeedService, serve
+            from package_record import PROJECTED_FIELDS
+            start_harvest(args.fetch_workers[0], args.feed_cache_dir[0], args.feed_ttl[0], args.offline,
+                          {'threshold': args.fuzzy_threshold[0], 'margin': args.fuzzy_margin[0]}
+                          if args.fuzzy_names else None, args.http_timeout[0], args.http_retries[0],
+                          args.pure_snapshot[0])
+            service = FeedService(get_package_search_query(args.ckan_url[0]), args.output[0], XML_HEADER,
+                                  args.use_namespaces, args.add_extra, orcid_doi_file, args.fetch_workers[0],
+                                  PROJECTED_FIELDS if args.project_fields else None, args.refresh_interval[0],
+                                  args.page_size[0])
+            serve(service, args.serve_address[0], args.serve_port[0])
+            return
+        convert(args.ckan_url, args.output[0], test=bool(args.test), use_namespaces=bool(args.use_namespaces),
+                validate=bool(args.validate), add_extra=bool(args.add_extra), orcid_doi_file=orcid_doi_file,
+                json_lines_file=args.json_lines[0], extract_only=bool(args.extract_only),
+                fetch_workers=args.fetch_workers[0], page_size=args.page_size[0],
+                project_fields=bool(args.project_fields), stream=bool(args.stream),
+                feed_cache_dir=args.feed_cache_dir[0], feed_ttl=args.feed_ttl[0], offline=bool(args.offline),
+                incremental=bool(args.incremental), state_file=args.state_file[0],
+                fragment_cache=bool(args.fragment_cache), fragment_cache_size=args.fragment_cache_size[0],
+                author_cache=bool(args.author_cache), fuzzy_names=bool(args.fuzzy_names),
+                fuzzy_threshold=args.fuzzy_threshold[0], fuzzy_margin=args.fuzzy_margin[0],
+                http_timeout=args.http_timeout[0], http_retries=args.http_retries[0],
+                render_workers=args.render_workers[0], validate_each=bool(args.validate_each),
+                quarantine_file=args.quarantine[0], metrics_file=args.metrics[0],
+                metrics_format=args.metrics_format[0], checkpoint=bool(args.checkpoint), resume=bool(args.resume),
+                work_dir=args.work_dir[0], shard_dir=args.shard_dir[0], shard_size=args.shard_size[0],
+                shard_max_mb=args.shard_max_mb[0], compress=args.compress[0],
+                diff_manifest=args.diff_manifest[0], removed_ids_file=args.removed_ids[0],
+                pure_snapshot=args.pure_snapshot[0], duplicate_precedence=args.duplicate_precedence[0])
+    except OptionError as e:
+        parser.error(str(e))
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+        import pstats
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+
+
+if __name__ == '__main__':
+    main()
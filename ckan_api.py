@@ -0,0 +1,326 @@
+import codecs
+import collections
+import json
+import queue
+import sys
+import threading
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+
+from http_client import get_http_client
+from metrics import get_metrics
+
+# Bytes read from a response at a time when it is decoded incrementally.
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def package_search(query):
+    """
+    Fetch a single CKAN package_search URL and return the decoded 'result' dictionary.
+    """
+    metrics = get_metrics()
+    with metrics.stage('ckan_fetch'):
+        response = get_http_client().get(query)
+    metrics.count('ckan_pages_fetched')
+    metrics.count('bytes_received', len(response), source='ckan')
+    with metrics.stage('ckan_parse'):
+        json_data = json.loads(response.decode('utf-8'))
+    return json_data['result']
+
+
+class JSONStreamReader:
+    """
+    Decode a JSON document as it is read, e.g. from an HTTP response, one value at a time.
+
+    Objects and arrays can be walked key by key and item by item with iter_object() and iter_array(), and
+    each value is decoded with value() as soon as it is complete, so a large array is never held in memory as
+    a whole, neither as text nor decoded.  read is a function returning up to the given number of bytes, and
+    an empty result at the end of the document.
+    """
+    def __init__(self, read, chunk_size=READ_CHUNK_SIZE):
+        self.read = read
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.end_of_input = False
+
+    def fill(self, size):
+        """ Read more of the document into the buffer, dropping what has been decoded already. """
+        data = self.read(size)
+        self.end_of_input = not data
+        self.buffer = self.buffer[self.position:] + self.text_decoder.decode(data, final=self.end_of_input)
+        self.position = 0
+
+    def peek(self):
+        """ Skip whitespace and return the next character of the document. """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\n\r':
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.end_of_input:
+                raise ValueError("Unexpected end of JSON document")
+            self.fill(self.chunk_size)
+
+    def expect(self, characters):
+        """ Consume the next character, which must be one of characters, and return it. """
+        character = self.peek()
+        if character not in characters:
+            raise ValueError(f"Expected one of {characters!r} in JSON document, found {character!r}")
+        self.position += 1
+        return character
+
+    def value(self):
+        """ Decode and return the next complete value. """
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+                # A number at the end of the buffer may continue in the next chunk.
+                if end < len(self.buffer) or self.end_of_input:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.end_of_input:
+                    raise
+            # Read ahead in growing steps, so that a large value is not decoded over and over.
+            self.fill(size)
+            size *= 2
+
+    def iter_object(self):
+        """ Yield the keys of the next object; the caller must consume each key's value before continuing. """
+        self.expect('{')
+        if self.peek() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def iter_array(self):
+        """ Yield once per item of the next array; the caller must consume each item before continuing. """
+        self.expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+        while True:
+            yield
+            if self.expect(',]') == ']':
+                return
+
+
+def iter_search_results(reader):
+    """ Yield the packages of a package_search response from a JSONStreamReader, as each one is decoded. """
+    for key in reader.iter_object():
+        if key != 'result':
+            reader.value()
+            continue
+        for result_key in reader.iter_object():
+            if result_key != 'results':
+                reader.value()
+                continue
+            for _ in reader.iter_array():
+                yield reader.value()
+
+
+class PageSizer:
+    """
+    Choose the number of packages to request per package_search page from the pages received so far.
+
+    Pages should be large enough that the server's response latency, the time to the first byte, is no more
+    than a fifth of the time a page takes, and small enough to stay under target_bytes, keeping the memory and
+    the work lost to a failed request in bounds.  Observations are smoothed and the page size at most doubles
+    or halves from one page to the next.  The size always stays between min_rows and max_rows; CKAN refuses
+    pages larger than its ckan.search.rows_max setting, 1000 by default.
+    """
+    def __init__(self, rows=500, min_rows=50, max_rows=1000, target_bytes=8 * 1024 * 1024):
+        self.rows = rows
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.target_bytes = target_bytes
+        self.lock = threading.Lock()
+        self.bytes_per_row = None
+        self.transfer_seconds_per_row = None
+        self.latency = None
+
+    def observe(self, rows, num_bytes, latency, seconds):
+        """ Record a page of rows packages and num_bytes, with its time to first byte and total time. """
+        if rows == 0:
+            return
+        with self.lock:
+            observed = (num_bytes / rows, max(seconds - latency, 1e-6) / rows, latency)
+            if self.latency is None:
+                self.bytes_per_row, self.transfer_seconds_per_row, self.latency = observed
+            else:
+                self.bytes_per_row, self.transfer_seconds_per_row, self.latency = \
+                    [(old + new) / 2 for old, new in zip(
+                        (self.bytes_per_row, self.transfer_seconds_per_row, self.latency), observed)]
+            wanted = min(4 * self.latency / self.transfer_seconds_per_row,
+                         self.target_bytes / max(self.bytes_per_row, 1))
+            wanted = min(max(wanted, self.rows / 2), self.rows * 2)
+            self.rows = int(min(max(wanted, self.min_rows), self.max_rows))
+
+    def limit(self, max_rows):
+        """ Keep pages at or below max_rows packages, e.g. the server's ckan.search.rows_max. """
+        with self.lock:
+            self.max_rows = max_rows
+            self.min_rows = min(self.min_rows, max_rows)
+            self.rows = min(self.rows, max_rows)
+
+
+def fetch_package_page(package_search_query, start, rows, packages, stop, page_sizer=None, repository=None):
+    """
+    Fetch a page of rows packages from offset start of a package_search query and put each package on the
+    packages queue as soon as it has been decoded, so that the first packages can be used while the rest of
+    the page is still arriving.  If the connection fails while the page is being read, the rest of the page is
+    requested again, without repeating the packages already on the queue.  None is put on the queue at the
+    end, also if the request fails.  Stops early when the stop event is set.  Bytes received are also counted
+    for the repository, if one is named.  Returns the number of packages received.
+    """
+    metrics = get_metrics()
+    client = get_http_client()
+    count = 0
+    bytes_received = 0
+    attempt = 0
+    # Wall and CPU time spent waiting for and reading the response, as opposed to decoding it.
+    fetch_times = [0.0, 0.0]
+
+    def timed_read(size):
+        nonlocal bytes_received
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        data = response.read(size)
+        fetch_times[0] += time.perf_counter() - wall_start
+        fetch_times[1] += time.thread_time() - cpu_start
+        bytes_received += len(data)
+        return data
+
+    try:
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        while True:
+            query = package_search_query + f'&start={start + count}&rows={rows - count}'
+            request_start = time.perf_counter()
+            request_cpu_start = time.thread_time()
+            response = client.open(query, attempt=attempt)
+            if attempt == 0:
+                latency = time.perf_counter() - wall_start
+            fetch_times[0] += time.perf_counter() - request_start
+            fetch_times[1] += time.thread_time() - request_cpu_start
+            try:
+                with response:
+                    for package in iter_search_results(JSONStreamReader(timed_read)):
+                        packages.put(package)
+                        count += 1
+                        if stop.is_set():
+                            break
+                break
+            except urllib3.exceptions.HTTPError as e:
+                if attempt >= client.retries:
+                    raise urllib.error.URLError(e)
+                attempt = client.wait_to_retry(f"{e} after {count} packages", query, attempt)
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_seconds = time.thread_time() - cpu_start
+        metrics.add_stage_time('ckan_fetch', *fetch_times)
+        metrics.add_stage_time('ckan_parse', wall_seconds - fetch_times[0], cpu_seconds - fetch_times[1])
+        metrics.count('ckan_pages_fetched')
+        metrics.count('bytes_received', bytes_received, source='ckan')
+        if repository is not None:
+            metrics.count('repository_bytes_received', bytes_received, repository=repository)
+        # The timing of a page that had to be requested again says little about the server.
+        if page_sizer is not None and not stop.is_set() and attempt == 0:
+            page_sizer.observe(count, bytes_received, latency, wall_seconds)
+    finally:
+        packages.put(None)
+    return count
+
+
+def iter_package_pages(package_search_query, start, num_datasets, max_rows, fetch_workers=1, page_sizer=None,
+                       repository=None):
+    """
+    Yield an iterator over the packages of each page of a package_search query, in page order.
+
+    Pages are streamed: packages are decoded and handed to the caller while the rest of the page is still
+    being received.  Up to fetch_workers pages are requested concurrently, so the following pages are
+    downloaded while the caller is still rendering the current one, but packages are always yielded in search
+    result order.  Pages hold max_rows packages, or as many as page_sizer chooses when one is given; the rest
+    of a page the server cuts short is requested separately.  repository names the CKAN repository in the
+    metrics, see fetch_package_page().
+    """
+    pending = collections.deque()
+    stop = threading.Event()
+    next_offset = start
+
+    def submit_next(executor):
+        nonlocal next_offset
+        if next_offset < num_datasets:
+            rows = page_sizer.rows if page_sizer is not None else max_rows
+            packages = queue.Queue()
+            future = executor.submit(fetch_package_page, package_search_query, next_offset, rows, packages, stop,
+                                     page_sizer, repository)
+            pending.append((next_offset, rows, packages, future))
+            next_offset += rows
+
+    def page_packages(executor, offset, rows, packages, future):
+        while True:
+            received = 0
+            for package in iter(packages.get, None):
+                received += 1
+                yield package
+            # Raises the error of a failed request.
+            future.result()
+            rows -= received
+            offset += received
+            if rows == 0 or offset >= num_datasets:
+                return
+            if received == 0:
+                print(f"CKAN returned no packages at offset {offset}; packages may have been deleted during the "
+                      f"harvest", file=sys.stderr)
+                return
+            # A page shorter than requested is cut off by the server's ckan.search.rows_max; the rest of the
+            # page is requested on its own, and the following pages are made smaller.
+            if page_sizer is not None:
+                page_sizer.limit(received)
+            packages = queue.Queue()
+            future = executor.submit(fetch_package_page, package_search_query, offset, rows, packages, stop, None,
+                                     repository)
+
+    with ThreadPoolExecutor(max_workers=max(1, fetch_workers)) as executor:
+        try:
+            for _ in range(max(1, fetch_workers)):
+                submit_next(executor)
+            while pending:
+                page = page_packages(executor, *pending.popleft())
+                # Keep the pipeline full before handing the page to the caller.
+                submit_next(executor)
+                yield page
+                # Finish the page if the caller did not, so that the next one starts in the right place.
+                for _ in page:
+                    pass
+        finally:
+            stop.set()
+            for _, _, _, future in pending:
+                future.cancel()
+
+
+def list_package_ids(package_search_query, fetch_workers=1, max_rows=1000):
+    """
+    Return the set of CKAN package IDs matching a package_search query.
+
+    Only the 'id' field is requested, so this is much cheaper than fetching the full package dictionaries.
+    """
+    id_query = package_search_query + '&fl=id'
+    num_datasets = package_search(id_query + '&rows=0')['count']
+    package_ids = set()
+    for packages in iter_package_pages(id_query, 0, num_datasets, max_rows, fetch_workers):
+        package_ids.update(pkg['id'] for pkg in packages)
+    return package_ids
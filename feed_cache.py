@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.error
+
+from metrics import get_metrics
+
+
+class FeedCache:
+    """
+    On-disk cache for the Pure support server feeds.
+
+    Each feed is stored together with the ETag and Last-Modified headers of the response it came from.
+    Copies younger than the TTL (in seconds) are used as they are; older copies are revalidated with a
+    conditional request and downloaded again only if the server reports a change.  In offline mode the
+    server is never contacted and only cached copies are used.  A feed is revalidated at most once per run.
+    """
+    def __init__(self, cache_dir, ttl=0, offline=False):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+        self.validated = set()
+
+    def expire(self):
+        """ Let each feed be revalidated again once its TTL has passed; for long-running processes. """
+        self.validated.clear()
+
+    def feed_paths(self, feed_name):
+        """ Return the paths of the cached feed content and its metadata file. """
+        base = os.path.join(self.cache_dir, feed_name)
+        return base + '.xml', base + '.json'
+
+    def read_metadata(self, feed_name):
+        """ Return the metadata saved with a cached feed, or None if the feed is not cached. """
+        content_path, metadata_path = self.feed_paths(feed_name)
+        if not (os.path.exists(content_path) and os.path.exists(metadata_path)):
+            return None
+        with open(metadata_path) as file:
+            return json.load(file)
+
+    def write_metadata(self, feed_name, metadata):
+        _, metadata_path = self.feed_paths(feed_name)
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, delete=False) as file:
+            try:
+                json.dump(metadata, file)
+            except BaseException:
+                file.close()
+                os.unlink(file.name)
+                raise
+        os.replace(file.name, metadata_path)
+
+    def open(self, feed_name, fetch):
+        """
+        Return a binary file object with the current content of a feed.
+
+        fetch is called with a dictionary of extra request headers and must return the HTTP response
+        for the feed.  It is only called when the cached copy is missing or older than the TTL.
+        """
+        content_path, _ = self.feed_paths(feed_name)
+        metadata = self.read_metadata(feed_name)
+
+        if self.offline:
+            if metadata is None:
+                raise FileNotFoundError(f"No cached copy of the Pure '{feed_name}' feed in {self.cache_dir}; "
+                                        f"run once without --offline to populate the cache")
+            return open(content_path, 'rb')
+
+        if metadata is not None:
+            if feed_name in self.validated or time.time() - metadata['fetched'] < self.ttl:
+                return open(content_path, 'rb')
+
+        headers = {}
+        if metadata is not None:
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+
+        try:
+            response = fetch(headers)
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or metadata is None:
+                raise
+            print(f"Pure '{feed_name}' feed is unchanged, using cached copy", file=sys.stderr)
+            metadata['fetched'] = time.time()
+            self.write_metadata(feed_name, metadata)
+            self.validated.add(feed_name)
+            return open(content_path, 'rb')
+
+        # Download to a temporary file first so an interrupted transfer never replaces a good copy.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        with response, tempfile.NamedTemporaryFile('wb', dir=self.cache_dir, delete=False) as file:
+            try:
+                for block in iter(lambda: response.read(1 << 20), b''):
+                    digest.update(block)
+                    file.write(block)
+                    get_metrics().count('bytes_received', len(block), source='pure_' + feed_name)
+            except BaseException:
+                # Leave no partial download behind in the cache directory.
+                file.close()
+                os.unlink(file.name)
+                raise
+            metadata = {'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                        'sha256': digest.hexdigest(),
+                        'fetched': time.time()}
+        os.replace(file.name, content_path)
+        self.write_metadata(feed_name, metadata)
+        self.validated.add(feed_name)
+        return open(content_path, 'rb')
+
+    def fingerprint(self, feed_name, fetch):
+        """
+        Return the SHA-256 digest of the current content of a feed, revalidating the cached copy if needed.
+        """
+        self.open(feed_name, fetch).close()
+        metadata = self.read_metadata(feed_name)
+        if not metadata.get('sha256'):
+            content_path, _ = self.feed_paths(feed_name)
+            digest = hashlib.sha256()
+            with open(content_path, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(block)
+            metadata['sha256'] = digest.hexdigest()
+            self.write_metadata(feed_name, metadata)
+        return metadata['sha256']
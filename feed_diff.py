@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+from lxml import etree
+
+from metrics import get_metrics
+from sinks import XMLSink
+
+MANIFEST_VERSION = 2
+
+# An element with no content, serialized with an end tag because its text is empty rather than unset.
+EMPTY_ELEMENT_PATTERN = re.compile(rb'<([^\s/>]+)([^>]*)></\1>')
+
+
+def dataset_digest(dataset):
+    """
+    Return a short digest of a <dataset> element, which changes whenever anything in it changes.  Empty elements
+    are digested as self-closing tags, however the element was rendered.
+    """
+    canonical = EMPTY_ELEMENT_PATTERN.sub(rb'<\1\2/>', etree.tostring(dataset, with_tail=False))
+    return hashlib.blake2b(canonical, digest_size=8).hexdigest()
+
+
+class DatasetManifest:
+    """
+    The digest of every <dataset> element in the Pure feed as of the last harvest, by dataset id.
+
+    The manifest is a single JSON object, which loads quickly also for hundreds of thousands of datasets.  It
+    records the settings of the harvest, such as the CKAN repository; a manifest made with other settings is
+    treated as empty, so that every dataset is written again and none is reported as removed.
+    """
+    def __init__(self, settings=None, datasets=None):
+        self.settings = settings
+        self.datasets = datasets if datasets is not None else {}
+
+    @classmethod
+    def load(cls, manifest_file, settings):
+        if not os.path.exists(manifest_file):
+            return cls(settings)
+        with open(manifest_file) as file:
+            manifest = json.load(file)
+        if manifest.get('version') != MANIFEST_VERSION or manifest.get('settings') != settings:
+            return cls(settings)
+        return cls(settings, manifest['datasets'])
+
+    def save(self, manifest_file):
+        """ Write the manifest atomically, so an interrupted run leaves the previous one intact. """
+        manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+        with tempfile.NamedTemporaryFile('w', dir=manifest_dir, delete=False) as file:
+            json.dump({'version': MANIFEST_VERSION, 'settings': self.settings, 'datasets': self.datasets}, file,
+                      separators=(',', ':'))
+        os.replace(file.name, manifest_file)
+
+
+class DiffSink(XMLSink):
+    """
+    The Pure XML feed, reduced to the datasets that are new or changed since the harvest recorded in a
+    DatasetManifest.  The ids of datasets that are no longer in the feed are written one per line to
+    removed_ids_file when the sink is closed.  The manifest is updated with the datasets of this harvest; the
+    caller saves it once the harvest is complete.
+    """
+    def __init__(self, writer, manifest, removed_ids_file):
+        super().__init__(writer)
+        self.manifest = manifest
+        self.removed_ids_file = removed_ids_file
+        self.digests = {}
+        self.counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+
+    def write(self, package, resolution, dataset):
+        if dataset is None:
+            return
+        dataset_id = dataset.get('id')
+        digest = dataset_digest(dataset)
+        self.digests[dataset_id] = digest
+        previous_digest = self.manifest.datasets.get(dataset_id)
+        if previous_digest is None:
+            outcome = 'new'
+        elif previous_digest != digest:
+            outcome = 'changed'
+        else:
+            outcome = 'unchanged'
+        self.counts[outcome] += 1
+        get_metrics().count('datasets_diffed', outcome=outcome)
+        if outcome != 'unchanged':
+            super().write(package, resolution, dataset)
+
+    def close(self):
+        super().close()
+        removed_ids = [dataset_id for dataset_id in self.manifest.datasets if dataset_id not in self.digests]
+        self.counts['removed'] = len(removed_ids)
+        get_metrics().count('datasets_diffed', len(removed_ids), outcome='removed')
+        with open(self.removed_ids_file, 'w') as file:
+            file.writelines(dataset_id + '\n' for dataset_id in removed_ids)
+        self.manifest.datasets = self.digests
@@ -0,0 +1,324 @@
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, quote
+
+from ckan_api import package_search, iter_package_pages, PageSizer
+from fragment_cache import file_fingerprint
+from incremental import merge_feed, utc_timestamp
+from metrics import get_metrics
+from package_record import PackageRecord
+from pure_parse import load_pure_lookups, reload_pure_lookups, revalidate_pure_feeds, pure_feed_fingerprint
+from sinks import ORCIDDOISink
+from utils import render_package, render_record, print_stderr, XMLStreamWriter
+
+# CKAN package IDs and names; anything else is refused rather than put in a Solr query.
+PACKAGE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class FeedService:
+    """
+    Long-running generator of the Pure feed, for the --serve mode of ckan2pure.py.
+
+    The Pure lookups (persons, cost centers, author teams) are loaded once and kept in memory.  A background
+    thread revalidates the Pure feeds and the author team files every refresh_interval seconds, and rebuilds
+    the lookups when any of them changed.  The full feed can be regenerated into output_file, and single CKAN
+    packages can be re-rendered and merged into it, replacing, adding or removing their <dataset> elements.
+    Regenerations run one at a time.
+
+    The ORCID/DOI CSV file, if one is given, is written by full regenerations only.
+    """
+    def __init__(self, package_search_query, output_file, xml_header, use_namespaces=False,
+                 add_extra_elements=False, csv_file=None, fetch_workers=4, fields=None, refresh_interval=3600,
+                 page_size=None):
+        self.package_search_query = package_search_query
+        # Restricts the package fields returned by CKAN, see PROJECTED_FIELDS.
+        self.fields_parameter = '&fl=' + ','.join(fields) if fields else ''
+        self.output_file = output_file
+        self.xml_header = xml_header
+        self.use_namespaces = use_namespaces
+        self.add_extra_elements = add_extra_elements
+        self.csv_file = csv_file
+        self.fetch_workers = fetch_workers
+        # Packages per CKAN result page; adapted to the server when None.
+        self.page_size = page_size
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.full_regeneration_lock = threading.Lock()
+        self.stopped = threading.Event()
+        # The <dataset> id produced by each CKAN package in the feed, or None if it was filtered out.
+        self.guids = {}
+        self.input_fingerprints = None
+        # Packages updated while a full regeneration is running, merged again into its new feed; else None.
+        self.updated_during_regeneration = None
+        self.status = {'lookups_loaded': None, 'regenerating': False, 'last_full_regeneration': None,
+                       'last_update': None, 'datasets': None}
+
+    def input_fingerprint(self):
+        """ Return digests of the Pure feeds and author team files the lookups are built from. """
+        return (pure_feed_fingerprint('persons'), pure_feed_fingerprint('costcenters'),
+                file_fingerprint('author_orgs.yaml'), file_fingerprint('author_org_ids.yaml'))
+
+    def load_lookups(self):
+        load_pure_lookups()
+        self.input_fingerprints = self.input_fingerprint()
+        self.status['lookups_loaded'] = utc_timestamp()
+
+    def refresh_lookups(self):
+        """ Rebuild the lookups if the Pure feeds or author team files changed.  Returns True if they did. """
+        revalidate_pure_feeds()
+        fingerprints = self.input_fingerprint()
+        if fingerprints == self.input_fingerprints:
+            return False
+        print_stderr("Pure feeds or author team files changed, reloading the lookups")
+        reload_pure_lookups(swap_lock=self.lock)
+        self.input_fingerprints = fingerprints
+        self.status['lookups_loaded'] = utc_timestamp()
+        return True
+
+    def refresh_loop(self):
+        while not self.stopped.wait(self.refresh_interval):
+            try:
+                self.refresh_lookups()
+            except Exception as e:
+                # Keep serving with the lookups we have; the next refresh tries again.
+                print_stderr(f"Refreshing the Pure lookups failed: {e}")
+
+    def start_full_regeneration(self):
+        """ Start regenerating the full feed in the background.  Returns False if it is already running. """
+        if not self.full_regeneration_lock.acquire(blocking=False):
+            return False
+        threading.Thread(target=self.regenerate_all, daemon=True).start()
+        return True
+
+    def regenerate_all(self):
+        """
+        Harvest all CKAN packages into a new feed, and replace output_file with it.  Called by
+        start_full_regeneration(), which holds full_regeneration_lock until it is done.  Errors are reported in
+        the status, and the previous feed is kept.
+
+        The new feed is built without holding the lock, so single packages can still be updated meanwhile; those
+        packages are rendered again and merged into the new feed once it replaces the previous one.
+        """
+        with self.lock:
+            self.status['regenerating'] = True
+            self.updated_during_regeneration = set()
+        started = time.time()
+        record = {'started': utc_timestamp(), 'finished': None, 'datasets': None, 'error': None}
+        self.status['last_full_regeneration'] = record
+        try:
+            temporary_file = self.output_file + '.full.tmp'
+            count, guids = self.write_full_feed(temporary_file)
+            with self.lock:
+                os.replace(temporary_file, self.output_file)
+                if self.csv_file:
+                    os.replace(self.csv_file + '.tmp', self.csv_file)
+                self.guids = guids
+                self.status['datasets'] = count
+                if self.updated_during_regeneration:
+                    self.merge_packages(sorted(self.updated_during_regeneration))
+            record['datasets'] = count
+            print_stderr(f"Regenerated {self.output_file} with {count} datasets in {time.time() - started:.1f} "
+                         f"seconds")
+        except Exception as e:
+            record['error'] = str(e)
+            print_stderr(f"Regenerating {self.output_file} failed: {e}")
+        finally:
+            with self.lock:
+                record['finished'] = utc_timestamp()
+                self.status['regenerating'] = False
+                self.updated_during_regeneration = None
+            self.full_regeneration_lock.release()
+
+    def write_full_feed(self, output_file):
+        """
+        Write the feed of all CKAN packages to output_file, and the ORCID/DOI CSV next to its final place.
+        Returns the number of datasets written and the <dataset> id produced by each package.
+        """
+        num_datasets = package_search(self.package_search_query + '&rows=0')['count']
+        guids = {}
+        count = 0
+        # The CSV is written as by convert(), so its columns are those of the command line program.
+        orcid_doi_sink = ORCIDDOISink(open(self.csv_file + '.tmp', 'w', newline='')) if self.csv_file else None
+        try:
+            with XMLStreamWriter(self.use_namespaces, self.xml_header, output_file) as writer:
+                for packages in iter_package_pages(self.package_search_query + self.fields_parameter, 0,
+                                                   num_datasets, self.page_size or 500, self.fetch_workers,
+                                                   PageSizer() if self.page_size is None else None):
+                    for pkg_dict in packages:
+                        package = PackageRecord(pkg_dict)
+                        dataset, resolution = render_record(package, self.add_extra_elements)
+                        if orcid_doi_sink:
+                            orcid_doi_sink.write(package, resolution, dataset)
+                        guids[package.id] = dataset.get('id') if dataset is not None else None
+                        if dataset is not None:
+                            writer.write(dataset)
+                            count += 1
+        finally:
+            if orcid_doi_sink:
+                orcid_doi_sink.close()
+        return count, guids
+
+    def find_package(self, package_id):
+        """
+        Return the PackageRecord for a CKAN package ID or name, or None if the feed query does not find a package
+        with exactly that ID or name.
+        """
+        # The name is requested too, to check the match.
+        fields_parameter = self.fields_parameter + ',name' if self.fields_parameter else ''
+        query = (self.package_search_query + quote(f' AND (id:"{package_id}" OR name:"{package_id}")') +
+                 fields_parameter + '&rows=2')
+        for pkg_dict in package_search(query)['results']:
+            if pkg_dict['id'] == package_id or pkg_dict.get('name') == package_id:
+                return PackageRecord(pkg_dict)
+        return None
+
+    def update_packages(self, package_ids):
+        """
+        Re-render the given CKAN packages and merge them into output_file.  Returns the package IDs that were
+        updated, added, filtered out of the feed, removed because they are no longer found in CKAN, and not found.
+        """
+        with self.lock:
+            if not os.path.exists(self.output_file):
+                raise FileNotFoundError(f"{self.output_file} does not exist yet; regenerate the full feed first")
+            if self.updated_during_regeneration is not None:
+                self.updated_during_regeneration.update(package_ids)
+            outcome = self.merge_packages(package_ids)
+            self.status['last_update'] = dict(outcome, finished=utc_timestamp())
+        return outcome
+
+    def merge_packages(self, package_ids):
+        """ Re-render CKAN packages and merge them into output_file; the caller holds the lock. """
+        outcome = {'updated': [], 'added': [], 'filtered': [], 'removed': [], 'not_found': []}
+        replacements = {}
+        for package_id in package_ids:
+            package = self.find_package(package_id)
+            if package is None:
+                # Deleted, or no longer a dataset: drop it from the feed if it was there.
+                if package_id in self.guids:
+                    guid = self.guids.pop(package_id)
+                    if guid is not None:
+                        replacements[guid] = None
+                    outcome['removed'].append(package_id)
+                else:
+                    outcome['not_found'].append(package_id)
+                continue
+            dataset = render_package(package, None, self.add_extra_elements)
+            previous_guid = self.guids.get(package.id)
+            guid = dataset.get('id') if dataset is not None else None
+            if previous_guid is not None and previous_guid != guid:
+                replacements[previous_guid] = None
+            if dataset is not None:
+                replacements[guid] = dataset
+                outcome['updated' if previous_guid is not None else 'added'].append(package_id)
+            else:
+                if package.extra('guid'):
+                    replacements[package.extra('guid')] = None
+                outcome['filtered'].append(package_id)
+            self.guids[package.id] = guid
+
+        temporary_file = self.output_file + '.tmp'
+        with XMLStreamWriter(self.use_namespaces, self.xml_header, temporary_file) as writer:
+            replaced = merge_feed(self.output_file, writer, replacements, set())
+            for guid, dataset in replacements.items():
+                if dataset is not None and guid not in replaced:
+                    writer.write(dataset)
+        os.replace(temporary_file, self.output_file)
+        return outcome
+
+    def start(self):
+        """ Load the lookups and start the background refresh and a first full regeneration. """
+        self.load_lookups()
+        threading.Thread(target=self.refresh_loop, daemon=True).start()
+        self.start_full_regeneration()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class FeedServiceRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of a FeedService:
+
+        GET  /status                      JSON status of the lookups and the last regenerations
+        GET  /metrics                     Stage timings and counters in the Prometheus text format
+        POST /regenerate                  Start regenerating the full feed; answers 202, or 409 if one is running
+        POST /regenerate?id=ID&id=...     Re-render the given CKAN packages (IDs or names) into the feed now,
+                                          and answer with what was updated, added, filtered, removed or not found;
+                                          with 404 if any package was not found
+    """
+    def log_message(self, format, *args):
+        print_stderr("%s - %s" % (self.address_string(), format % args))
+
+    def send_json(self, status, data):
+        body = json.dumps(data, indent=2).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/status':
+            self.send_json(200, self.server.service.status)
+        elif path == '/metrics':
+            body = get_metrics().prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/regenerate':
+            self.send_json(404, {'error': 'not found'})
+            return
+        service = self.server.service
+        package_ids = parse_qs(url.query).get('id', [])
+        if not package_ids:
+            if service.start_full_regeneration():
+                self.send_json(202, {'status': 'started'})
+            else:
+                self.send_json(409, {'error': 'a full regeneration is already running'})
+            return
+        invalid = [package_id for package_id in package_ids if not PACKAGE_ID_PATTERN.match(package_id)]
+        if invalid:
+            self.send_json(400, {'error': 'invalid package IDs', 'ids': invalid})
+            return
+        started = time.time()
+        try:
+            outcome = service.update_packages(package_ids)
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        # Packages not found are reported together with those that were re-rendered.
+        self.send_json(404 if outcome['not_found'] else 200, dict(outcome, seconds=round(time.time() - started, 3)))
+
+
+class FeedServiceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service, address='127.0.0.1', port=8080):
+        super().__init__((address, port), FeedServiceRequestHandler)
+        self.service = service
+
+
+def serve(service, address='127.0.0.1', port=8080):
+    """ Start a FeedService and answer its HTTP requests until interrupted. """
+    service.start()
+    server = FeedServiceServer(service, address, port)
+    print_stderr(f"Serving on http://{address}:{server.server_port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from datetime import date
+
+from lxml import etree
+
+
+def file_fingerprint(path):
+    """ Return the SHA-256 digest of a file's content. """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Modules whose code determines the rendered <dataset> elements and their resolutions.
+RENDERING_MODULES = ('utils.py', 'package_record.py', 'pure_parse.py', 'org_resolver.py', 'name_matcher.py')
+
+
+def rendering_code_fingerprint():
+    """
+    Return a digest of the source of the RENDERING_MODULES, which changes with any change to the rendering code,
+    also one that does not change the program version.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    return hashlib.sha256(''.join(file_fingerprint(os.path.join(module_dir, module))
+                                  for module in RENDERING_MODULES).encode('ascii')).hexdigest()
+
+
+class FragmentCache:
+    """
+    Persistent SQLite cache of rendered <dataset> elements.
+
+    Entries are keyed by a hash of the package fields used by render_package, the add_extra_elements flag and
+    a context fingerprint covering the rendering code, the Pure feeds and the author team files, so any change
+    to these inputs results in a different key.  Each entry also holds the resolution of the dataset, see
+    resolve_package(), and datasets that were filtered out are cached as well.  Once the cache grows beyond
+    max_bytes, the least recently used entries are evicted.
+    """
+    COMMIT_INTERVAL = 500
+
+    def __init__(self, cache_file, max_bytes, context_fingerprint):
+        self.context_fingerprint = context_fingerprint
+        self.max_bytes = max_bytes
+        cache_dir = os.path.dirname(os.path.abspath(cache_file))
+        os.makedirs(cache_dir, exist_ok=True)
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS datasets '
+                                '(key TEXT PRIMARY KEY, fragment BLOB, resolution TEXT, size INTEGER, last_used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS datasets_last_used ON datasets (last_used)')
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM datasets').fetchone()[0]
+        self.pending_writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, package, add_extra_elements):
+        """ Return the cache key for a PackageRecord. """
+        fields = package.rendered_fields()
+        fields['add_extra'] = bool(add_extra_elements)
+        fields['context'] = self.context_fingerprint
+        # Open-ended temporal extents are rendered with the current date.
+        if add_extra_elements and (package.extra('extent_range') or '').endswith('*]'):
+            fields['today'] = date.today().isoformat()
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Return (found, dataset, resolution) for a cache key.  dataset is None for a dataset that was filtered out.
+        """
+        row = self.connection.execute('SELECT fragment, resolution FROM datasets WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None, None
+        self.hits += 1
+        self.connection.execute('UPDATE datasets SET last_used = ? WHERE key = ?', (time.time(), key))
+        fragment, resolution = row
+        dataset = etree.fromstring(fragment) if fragment is not None else None
+        return True, dataset, json.loads(resolution)
+
+    def put(self, key, dataset, resolution):
+        fragment = etree.tostring(dataset) if dataset is not None else None
+        resolution = json.dumps(resolution)
+        size = len(key) + len(resolution) + (len(fragment) if fragment is not None else 0)
+        # An entry replaced under the same key no longer counts towards the size.
+        row = self.connection.execute('SELECT size FROM datasets WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.total_bytes -= row[0]
+        self.connection.execute('INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?)',
+                                (key, fragment, resolution, size, time.time()))
+        self.total_bytes += size
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        self.pending_writes += 1
+        if self.pending_writes >= self.COMMIT_INTERVAL:
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache is at 90% of its size limit. """
+        target = self.max_bytes * 0.9
+        cursor = self.connection.execute('SELECT key, size FROM datasets ORDER BY last_used')
+        evicted = []
+        for key, size in cursor:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany('DELETE FROM datasets WHERE key = ?', evicted)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
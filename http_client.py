@@ -0,0 +1,148 @@
+import sys
+import threading
+import time
+import urllib.error
+from email.utils import parsedate_to_datetime
+
+import urllib3
+
+# Responses that indicate the server is overloaded or rate limiting us; these are retried after a pause.
+THROTTLE_STATUSES = {429, 503}
+RETRY_STATUSES = {500, 502, 504} | THROTTLE_STATUSES
+# Longest pause before a retry, in seconds, also when a server asks for a longer one with Retry-After.
+MAX_RETRY_PAUSE = 60.0
+
+
+class HTTPClient:
+    """
+    HTTP client shared by the CKAN and Pure requests.
+
+    Connections are pooled and kept alive between requests, and responses are requested with gzip transfer
+    encoding.  Failed requests (network errors, server errors and rate limiting) are retried with exponential
+    backoff.  When the server asks us to slow down, with status 429 or 503, a delay is inserted between all
+    subsequent requests; it honours Retry-After, up to MAX_RETRY_PAUSE, and shrinks again as requests succeed.
+
+    Errors are reported as urllib.error.HTTPError and urllib.error.URLError, like urllib.request.urlopen.
+    """
+    def __init__(self, timeout=60, retries=5, backoff_factor=1.0, max_connections=10):
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool = urllib3.PoolManager(maxsize=max_connections,
+                                        timeout=urllib3.Timeout(connect=timeout, read=timeout),
+                                        retries=urllib3.Retry(total=None, connect=0, read=0, status=0, other=0,
+                                                              redirect=5))
+        self.lock = threading.Lock()
+        self.request_delay = 0.0
+        self.next_request_time = 0.0
+
+    def wait_for_turn(self):
+        """ Space out requests by the current throttling delay. """
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request_time)
+            self.next_request_time = start + self.request_delay
+        if start > now:
+            time.sleep(start - now)
+
+    def slow_down(self, retry_after):
+        """ Double the delay between requests, and hold back all requests for the Retry-After period. """
+        with self.lock:
+            self.request_delay = min(max(self.request_delay * 2, 0.25), 30.0)
+            self.next_request_time = max(self.next_request_time, time.monotonic() + (retry_after or 0))
+
+    def speed_up(self):
+        """ Halve the delay between requests after a successful request. """
+        with self.lock:
+            self.request_delay = self.request_delay / 2 if self.request_delay > 0.05 else 0.0
+
+    def wait_to_retry(self, error, url, attempt, retry_after=None):
+        """ Report a failed attempt and sleep before the next one; returns the number of the next attempt. """
+        pause = retry_after if retry_after is not None else min(self.backoff_factor * 2 ** attempt, MAX_RETRY_PAUSE)
+        attempt += 1
+        print(f"{error} for {url}; retry {attempt} of {self.retries} in {pause:.1f} seconds", file=sys.stderr)
+        time.sleep(pause)
+        return attempt
+
+    def open(self, url, headers=None, basic_auth=None, attempt=0):
+        """
+        Send a GET request and return the response, with the body not yet read.  The response is file-like
+        and can be read incrementally; the body is decompressed as it is read.  Errors while reading it are
+        urllib3 exceptions; attempt is the number of attempts already made, by callers that retry those.
+        """
+        request_headers = {'Accept-Encoding': 'gzip'}
+        request_headers.update(headers or {})
+        if basic_auth:
+            request_headers.update(urllib3.util.make_headers(basic_auth='%s:%s' % basic_auth))
+
+        while True:
+            self.wait_for_turn()
+            try:
+                response = self.pool.request('GET', url, headers=request_headers, preload_content=False)
+            except urllib3.exceptions.HTTPError as e:
+                if attempt >= self.retries:
+                    raise urllib.error.URLError(e)
+                error = str(e)
+                retry_after = None
+            else:
+                if response.status < 300:
+                    self.speed_up()
+                    return response
+                response.drain_conn()
+                response.release_conn()
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+                error = f"HTTP {response.status} {response.reason}"
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                # A far-off or invalid (infinite) Retry-After would hold up the harvest indefinitely.
+                if retry_after is not None and not retry_after <= MAX_RETRY_PAUSE:
+                    print(f"Retry-After of {response.headers.get('Retry-After')} for {url} is limited to "
+                          f"{MAX_RETRY_PAUSE:.0f} seconds", file=sys.stderr)
+                    retry_after = MAX_RETRY_PAUSE
+                if response.status in THROTTLE_STATUSES:
+                    self.slow_down(retry_after)
+            attempt = self.wait_to_retry(error, url, attempt, retry_after)
+
+    def get(self, url, headers=None, basic_auth=None):
+        """
+        Send a GET request and return the complete response body as bytes.  The request is retried also if
+        the connection fails while the body is read.
+        """
+        attempt = 0
+        while True:
+            response = self.open(url, headers, basic_auth, attempt)
+            try:
+                with response:
+                    return response.read()
+            except urllib3.exceptions.HTTPError as e:
+                if attempt >= self.retries:
+                    raise urllib.error.URLError(e)
+                attempt = self.wait_to_retry(str(e), url, attempt)
+
+
+def parse_retry_after(value):
+    """ Return the number of seconds given by a Retry-After header, which is either a delay or an HTTP date. """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+HTTP_CLIENT = None
+
+
+def configure_http_client(timeout=60, retries=5, max_connections=10):
+    global HTTP_CLIENT
+    HTTP_CLIENT = HTTPClient(timeout=timeout, retries=retries, max_connections=max_connections)
+
+
+def get_http_client():
+    """ Return the shared HTTPClient, creating one with default settings if none is configured. """
+    if HTTP_CLIENT is None:
+        configure_http_client()
+    return HTTP_CLIENT
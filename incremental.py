@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+from pure_parse import iterparse_elements
+from utils import PURE
+
+# Seconds taken off the start of a harvest when it becomes the metadata_modified lower bound of the next one,
+# so that packages are not missed when the CKAN server's clock is ahead of ours.  Packages found again that
+# have not changed are skipped, see HarvestState.is_unchanged().
+CLOCK_SKEW_MARGIN = 15 * 60
+
+
+def utc_timestamp(seconds_ago=0):
+    """
+    Return the current UTC time, or the time seconds_ago seconds before it, in the Solr date format used for
+    CKAN metadata_modified queries.
+    """
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds_ago)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class HarvestState:
+    """
+    Record of the last successful harvest, used to re-render only datasets that changed since then.
+
+    For each CKAN package ID the state keeps its metadata_modified value and the id of the <dataset> element
+    it produced in the Pure feed, or None if the dataset was filtered out.  context is a fingerprint of the
+    other inputs of the feed, such as the Pure feeds and the author team files; when it changes, every dataset
+    has to be rendered again.
+    """
+    def __init__(self, last_harvest=None, datasets=None, context=None):
+        self.last_harvest = last_harvest
+        self.datasets = datasets if datasets is not None else {}
+        self.context = context
+
+    @classmethod
+    def load(cls, state_file):
+        if not os.path.exists(state_file):
+            return cls()
+        with open(state_file) as file:
+            state = json.load(file)
+        return cls(state['last_harvest'], state['datasets'], state.get('context'))
+
+    def save(self, state_file):
+        """ Write the state atomically, so an interrupted run leaves the previous state intact. """
+        state_dir = os.path.dirname(os.path.abspath(state_file))
+        with tempfile.NamedTemporaryFile('w', dir=state_dir, delete=False) as file:
+            json.dump({'last_harvest': self.last_harvest, 'datasets': self.datasets, 'context': self.context}, file)
+        os.replace(file.name, state_file)
+
+    def is_unchanged(self, package):
+        entry = self.datasets.get(package.id)
+        return entry is not None and entry['modified'] == package.metadata_modified
+
+    def record(self, package, dataset):
+        dataset_id = dataset.get('id') if dataset is not None else None
+        self.datasets[package.id] = {'modified': package.metadata_modified, 'guid': dataset_id}
+
+    def guid(self, package_id):
+        entry = self.datasets.get(package_id)
+        return entry['guid'] if entry is not None else None
+
+
+def merge_feed(previous_file, writer, replacements, removed_ids):
+    """
+    Copy the datasets of a previously generated feed to writer, applying an incremental update.
+
+    replacements maps the id of an existing <dataset> element to its newly rendered element, or to None if
+    the dataset no longer belongs in the feed.  Datasets whose id is in removed_ids are dropped.  Replaced
+    datasets keep their position in the feed; new datasets are left for the caller to append.  Returns the ids
+    of the replacements that were found in the feed.  The other datasets are parsed and written out again, which
+    gives the same bytes since rendered datasets have no empty text, so a feed without changes stays the same.
+    """
+    replaced = set()
+    for dataset in iterparse_elements(previous_file, PURE + 'dataset'):
+        dataset_id = dataset.get('id')
+        if dataset_id in removed_ids:
+            continue
+        if dataset_id in replacements:
+            replaced.add(dataset_id)
+            replacement = replacements[dataset_id]
+            if replacement is not None:
+                writer.write(replacement)
+            continue
+        writer.write(dataset)
+    return replaced
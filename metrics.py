@@ -0,0 +1,122 @@
+import contextlib
+import json
+import threading
+import time
+
+# Prefix for metric names in the Prometheus text format.
+PROMETHEUS_PREFIX = 'ckan2pure_'
+
+
+class Metrics:
+    """
+    Wall and CPU timers for the stages of a harvest, and event counters.
+
+    Stage CPU time is measured per thread, so stages running in the page fetching threads are charged only
+    for their own work.  Stages may run concurrently, e.g. CKAN pages are fetched while datasets are rendered,
+    so stage times can add up to more than the total run time.  Counters carry optional labels, such as the
+    reason a dataset was filtered out.  All updates are thread-safe.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Time the enclosed block as one call of a stage. """
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+    def add_stage_time(self, name, wall_seconds, cpu_seconds, calls=1):
+        with self.lock:
+            totals = self.stages.setdefault(name, [0.0, 0.0, 0])
+            totals[0] += wall_seconds
+            totals[1] += cpu_seconds
+            totals[2] += calls
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def counter(self, name, **labels):
+        """ Return the current value of a counter. """
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def drain(self):
+        """
+        Return the timers and counters recorded so far as plain data, and start again from zero.
+        Used to send the measurements of a worker process to the parent.
+        """
+        with self.lock:
+            state = (self.stages, self.counters)
+            self.stages = {}
+            self.counters = {}
+        return state
+
+    def merge(self, state):
+        """ Add timers and counters returned by drain() in another process. """
+        stages, counters = state
+        for name, (wall_seconds, cpu_seconds, calls) in stages.items():
+            self.add_stage_time(name, wall_seconds, cpu_seconds, calls)
+        for (name, labels), amount in counters.items():
+            self.count(name, amount, **dict(labels))
+
+    def as_dict(self, total_wall_seconds=None, total_cpu_seconds=None):
+        return {'total': {'wall_seconds': total_wall_seconds, 'cpu_seconds': total_cpu_seconds},
+                'stages': {name: {'wall_seconds': wall_seconds, 'cpu_seconds': cpu_seconds, 'calls': calls}
+                           for name, (wall_seconds, cpu_seconds, calls) in sorted(self.stages.items())},
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())]}
+
+    def prometheus_text(self, total_wall_seconds=None, total_cpu_seconds=None):
+        """ Return the timers and counters in the Prometheus text exposition format. """
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f'# HELP {PROMETHEUS_PREFIX}{name} {help_text}')
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name} {metric_type}')
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % (key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for key, label in labels)
+                lines.append(f'{PROMETHEUS_PREFIX}{name}{{{label_text}}} {value}' if label_text else
+                             f'{PROMETHEUS_PREFIX}{name} {value}')
+
+        if total_wall_seconds is not None:
+            metric('run_wall_seconds', 'gauge', 'Wall time of the harvest.', [((), total_wall_seconds)])
+        if total_cpu_seconds is not None:
+            metric('run_cpu_seconds', 'gauge', 'CPU time of the harvest process.', [((), total_cpu_seconds)])
+        stages = sorted(self.stages.items())
+        metric('stage_wall_seconds_total', 'counter', 'Wall time spent in each stage.',
+               [((('stage', name),), totals[0]) for name, totals in stages])
+        metric('stage_cpu_seconds_total', 'counter', 'CPU time spent in each stage.',
+               [((('stage', name),), totals[1]) for name, totals in stages])
+        metric('stage_calls_total', 'counter', 'Number of times each stage ran.',
+               [((('stage', name),), totals[2]) for name, totals in stages])
+        counters = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            counters.setdefault(name, []).append((labels, value))
+        for name, samples in counters.items():
+            metric(name + '_total', 'counter', name.replace('_', ' ').capitalize() + '.', samples)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, output_file, output_format='json', total_wall_seconds=None, total_cpu_seconds=None):
+        """ Write the timers and counters to a file, as JSON or in the Prometheus text format. """
+        with open(output_file, 'w') as file:
+            if output_format == 'prometheus':
+                file.write(self.prometheus_text(total_wall_seconds, total_cpu_seconds))
+            else:
+                json.dump(self.as_dict(total_wall_seconds, total_cpu_seconds), file, indent=2)
+                file.write('\n')
+
+
+METRICS = Metrics()
+
+
+def get_metrics():
+    """ Return the Metrics instance shared by all modules of this process. """
+    return METRICS
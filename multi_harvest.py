@@ -0,0 +1,213 @@
+import queue
+import threading
+import time
+
+from ckan_api import package_search, iter_package_pages, PageSizer
+from metrics import get_metrics
+from package_record import PackageRecord
+from utils import print_stderr
+
+# Rules for choosing among packages with the same guid, see MultiRepositoryHarvest.
+DUPLICATE_PRECEDENCE_RULES = ('first', 'newest')
+
+# Package fields fetched to choose the newest of packages with the same guid.
+INDEX_FIELDS = 'id,metadata_modified,extras_guid'
+
+# Packages buffered per repository, a few pages' worth; a repository's thread waits while its queue is full.
+QUEUE_SIZE = 2000
+
+# Marks the end of a repository's packages in its queue.
+_END = object()
+
+
+class RepositoryHarvest:
+    """ Progress and statistics of one repository of a MultiRepositoryHarvest. """
+    def __init__(self, name, package_search_query):
+        self.name = name
+        self.package_search_query = package_search_query
+        self.packages = queue.Queue(QUEUE_SIZE)
+        self.error = None
+        self.num_datasets = 0
+        self.received = 0
+        self.delivered = 0
+        self.duplicates = 0
+        self.fetch_seconds = 0.0
+
+
+class MultiRepositoryHarvest:
+    """
+    Harvest several CKAN repositories concurrently into one stream of PackageRecords.
+
+    repositories is a list of (name, package_search_query) pairs.  Each repository is fetched by its own
+    thread, with up to fetch_workers pages in flight and its own page sizer.  Packages are delivered in
+    repository order, and in search result order within a repository, so the feed does not depend on which
+    server answers first.  Each thread fetches up to QUEUE_SIZE packages ahead of the ones delivered and then
+    waits, so the later repositories' first pages are ready when their turn comes while memory use stays flat.
+
+    Packages with the same 'guid' extra would produce the same Pure dataset, so only one of them is delivered.
+    With the 'first' precedence it is the first one in delivery order, i.e. from the repository listed first.
+    With 'newest' it is the most recently modified one, ties going to the first; the winners are chosen
+    from a light pass over all repositories, fetching only the fields in INDEX_FIELDS, that runs alongside
+    the harvest.  If a winner has been deleted, or has lost its guid, by the time it is fetched, the next most
+    recent package in a later repository takes its place.
+    """
+    def __init__(self, repositories, fetch_workers=4, page_size=None, fields_parameter='', test=False,
+                 precedence='first'):
+        self.repositories = [RepositoryHarvest(name, query) for name, query in repositories]
+        self.fetch_workers = fetch_workers
+        self.page_size = page_size
+        self.fields_parameter = fields_parameter
+        self.test = test
+        self.precedence = precedence
+        self.stopped = threading.Event()
+        # The (repository index, package ID) of the packages with each guid, most recently modified first, with
+        # the 'newest' precedence; the first one still in its repository is delivered.
+        self.candidates = None
+
+    def page_range(self, query):
+        """ Return the start offset and the number of results of a repository query. """
+        num_datasets = package_search(query + '&rows=0')['count']
+        return num_datasets - 10 if self.test else 0, num_datasets
+
+    def iter_repository(self, repository, query, max_rows, page_sizer):
+        """ Yield the package dictionaries of a repository's query, in search result order. """
+        start, num_datasets = self.page_range(query)
+        repository.num_datasets = num_datasets
+        for packages in iter_package_pages(query, start, num_datasets, max_rows, self.fetch_workers, page_sizer,
+                                           repository.name):
+            for pkg_dict in packages:
+                if self.stopped.is_set():
+                    return
+                yield pkg_dict
+
+    def fetch(self, repository):
+        """ Fetch all packages of a repository into its queue; runs in the repository's thread. """
+        started = time.perf_counter()
+        page_sizer = PageSizer() if self.page_size is None else None
+        query = repository.package_search_query + self.fields_parameter
+        try:
+            for pkg_dict in self.iter_repository(repository, query, self.page_size or 500, page_sizer):
+                if not self.put(repository, pkg_dict):
+                    return
+                repository.received += 1
+        except Exception as e:
+            repository.error = e
+        finally:
+            repository.fetch_seconds = time.perf_counter() - started
+            self.put(repository, _END)
+
+    def put(self, repository, item):
+        """ Wait for room in a repository's queue and add item; returns False if the harvest was stopped. """
+        while not self.stopped.is_set():
+            try:
+                repository.packages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def index_repository(self, repository_index, index):
+        """
+        Set index[repository_index] to the (guid, modification time, package ID) of each package with a guid in
+        a repository, or to the error that prevented it.
+        """
+        repository = self.repositories[repository_index]
+        query = repository.package_search_query + '&fl=' + INDEX_FIELDS
+        try:
+            index[repository_index] = [(pkg_dict['extras_guid'], pkg_dict['metadata_modified'], pkg_dict['id'])
+                                       for pkg_dict in self.iter_repository(repository, query, 1000, None)
+                                       if pkg_dict.get('extras_guid')]
+        except Exception as e:
+            index[repository_index] = e
+
+    def choose_winners(self):
+        """ Rank the packages with each guid, across all repositories, by modification time. """
+        index = [None] * len(self.repositories)
+        threads = [threading.Thread(target=self.index_repository, args=(repository_index, index), daemon=True)
+                   for repository_index in range(len(self.repositories))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        entries_by_guid = {}
+        for repository_index, entries in enumerate(index):
+            if isinstance(entries, Exception):
+                raise entries
+            for guid, modified, package_id in entries:
+                entries_by_guid.setdefault(guid, []).append((modified, repository_index, package_id))
+        # The sort is stable, so ties go to the repository listed first.
+        self.candidates = {guid: [(repository_index, package_id) for _, repository_index, package_id
+                                  in sorted(entries, key=lambda entry: entry[0], reverse=True)]
+                           for guid, entries in entries_by_guid.items()}
+
+    def is_delivered(self, repository_index, package, guid, delivered_guids):
+        if guid in delivered_guids:
+            return False
+        if self.candidates is not None and guid in self.candidates:
+            return self.candidates[guid][0] == (repository_index, package.id)
+        return True
+
+    def fall_back(self, repository_index, delivered_guids):
+        """
+        After a repository has been delivered, pass each guid whose chosen package was not in it, because the
+        package was deleted or lost its guid since the index pass, on to the next most recent package in a later
+        repository.  Guids with no such package left are reported.
+        """
+        repository = self.repositories[repository_index]
+        for guid, candidates in self.candidates.items():
+            if candidates[0][0] != repository_index or guid in delivered_guids:
+                continue
+            later = [candidate for candidate in candidates if candidate[0] > repository_index]
+            if later:
+                self.candidates[guid] = later
+            else:
+                print_stderr(f"#### The package with guid {guid} chosen from {repository.name} is no longer "
+                             f"there, and no other repository has one left; it is left out of the feed")
+                get_metrics().count('datasets_duplicate_lost', repository=repository.name)
+
+    def __iter__(self):
+        threads = [threading.Thread(target=self.fetch, args=(repository,), daemon=True)
+                   for repository in self.repositories]
+        for thread in threads:
+            thread.start()
+        # The packages are already being fetched while the winners are chosen.
+        if self.precedence == 'newest':
+            self.choose_winners()
+        metrics = get_metrics()
+        delivered_guids = set()
+        try:
+            for repository_index, repository in enumerate(self.repositories):
+                for pkg_dict in iter(repository.packages.get, _END):
+                    package = PackageRecord(pkg_dict)
+                    guid = package.extra('guid')
+                    if guid is not None:
+                        if not self.is_delivered(repository_index, package, guid, delivered_guids):
+                            print_stderr(f"#### Skipping '{package.title}' from {repository.name}, a package with "
+                                         f"the same guid {guid} takes precedence")
+                            repository.duplicates += 1
+                            metrics.count('datasets_duplicate', repository=repository.name)
+                            continue
+                        delivered_guids.add(guid)
+                    repository.delivered += 1
+                    yield package
+                if repository.error is not None:
+                    raise repository.error
+                if self.candidates is not None:
+                    self.fall_back(repository_index, delivered_guids)
+        finally:
+            # Stop the other repositories' threads if the harvest ends early.
+            self.stopped.set()
+
+    def report(self):
+        """ Print the throughput of each repository, and add it to the metrics. """
+        metrics = get_metrics()
+        for repository in self.repositories:
+            seconds = repository.fetch_seconds
+            received_bytes = metrics.counter('repository_bytes_received', repository=repository.name)
+            print_stderr(f"{repository.name}: {repository.received} of {repository.num_datasets} packages in "
+                         f"{seconds:.1f} seconds ({repository.received / max(seconds, 1e-6):.1f} packages/s, "
+                         f"{received_bytes / max(seconds, 1e-6) / 1e6:.2f} MB/s), "
+                         f"{repository.duplicates} duplicates skipped")
+            metrics.count('repository_packages_received', repository.received, repository=repository.name)
+            metrics.count('repository_packages_delivered', repository.delivered, repository=repository.name)
+            metrics.count('repository_fetch_seconds', seconds, repository=repository.name)
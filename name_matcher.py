@@ -0,0 +1,154 @@
+import collections
+import difflib
+import functools
+import re
+import unicodedata
+
+NON_WORD_CHARACTERS = re.compile(r'[\W_]+')
+REPEATED_DIGITS = re.compile(r'(\d)\1+')
+# Soundex digits by letter; vowels become 0 and are dropped after repeated digits are merged, and 'h' and 'w'
+# are dropped before, so that equal digits on either side of them are merged too.
+SOUNDEX_DIGITS = str.maketrans({**{letter: str(code) for code, letters in enumerate(
+    ['aeiouy', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r']) for letter in letters}, 'h': None, 'w': None})
+
+
+@functools.lru_cache(maxsize=None)
+def normalize_name(name):
+    """
+    Return a name in lower case without accents, with every run of other characters than letters and digits,
+    such as hyphens, apostrophes and periods, replaced by a single space.
+    """
+    name = name or ''
+    if not name.isascii():
+        decomposed = unicodedata.normalize('NFKD', name)
+        name = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return NON_WORD_CHARACTERS.sub(' ', name.casefold()).strip()
+
+
+@functools.lru_cache(maxsize=None)
+def soundex(word):
+    """ Return the American Soundex code of a word, e.g. 'r163' for 'Robert' and 'Rupert'. """
+    if not word.isalpha() or not word.isascii():
+        return word
+    digits = REPEATED_DIGITS.sub(r'\1', word.translate(SOUNDEX_DIGITS))
+    if word[0] not in 'hw':
+        # The first letter is kept as it is, in place of its digit.
+        digits = digits[1:]
+    return (word[0] + digits.replace('0', '') + '000')[:4]
+
+
+def blocking_keys(first_name, last_name_parts):
+    """
+    Return the index buckets for a normalized first name and the words of a normalized last name: the
+    complete last name and each of its words, both as written and by sound, combined with the first initial.
+    """
+    initial = first_name[:1]
+    surnames = {''.join(last_name_parts)}
+    surnames.update(part for part in last_name_parts if len(part) > 2)
+    keys = set()
+    for surname in surnames:
+        keys.add(('name', surname, initial))
+        keys.add(('sound', soundex(surname), initial))
+    return keys
+
+
+def index_entries(names):
+    """
+    Yield a (blocking key, entry) pair for each bucket of each ((first_name, last_name), person_id) pair in
+    names, where the entry is the (person_id, normalized first name, normalized last name words) compared with
+    the authors that fall into the bucket.
+    """
+    for (first_name, last_name), person_id in names:
+        first_name = normalize_name(first_name)
+        last_name_parts = tuple(normalize_name(last_name).split())
+        if not first_name or not last_name_parts:
+            continue
+        entry = (person_id, first_name, last_name_parts)
+        for key in blocking_keys(first_name, last_name_parts):
+            yield key, entry
+
+
+def similarity(a, b):
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def last_name_score(parts, other_parts):
+    if parts == other_parts:
+        return 1.0
+    # One name is part of a double-barrelled one, e.g. "Garcia" and "Garcia-Lopez".
+    if set(parts) <= set(other_parts) or set(other_parts) <= set(parts):
+        return 0.95
+    return similarity(''.join(parts), ''.join(other_parts))
+
+
+def first_name_score(first_name, other_first_name):
+    if first_name == other_first_name:
+        return 1.0
+    # An initial matches any name with that initial.
+    if len(first_name) == 1 or len(other_first_name) == 1:
+        return 0.9 if first_name[0] == other_first_name[0] else 0.0
+    first_word, other_first_word = first_name.split()[0], other_first_name.split()[0]
+    if first_word == other_first_word:
+        return 1.0
+    # A short form, e.g. "Chris" and "Christopher".
+    if len(first_word) >= 3 and len(other_first_word) >= 3 and \
+            (first_word.startswith(other_first_word) or other_first_word.startswith(first_word)):
+        return 0.9
+    return similarity(first_word, other_first_word)
+
+
+class FuzzyNameMatcher:
+    """
+    Approximate matching of author names against the names in the Pure persons feed.
+
+    Names are compared without accents, case and punctuation, and initials, short forms of first names and
+    parts of double-barrelled last names are accepted.  To stay fast on a feed with hundreds of thousands of
+    persons, names are indexed in buckets by last name, by the Soundex code of the last name and by first
+    initial, and an author is scored only against the persons in the buckets it falls into.  The confidence
+    of a match is a weighted average of the last and first name similarities, between 0 and 1.  A match is
+    accepted if its confidence reaches the threshold, and no other person comes within margin of it.
+    """
+    LAST_NAME_WEIGHT = 0.6
+
+    def __init__(self, names=(), threshold=0.9, margin=0.05, buckets=None):
+        """
+        names is an iterable of ((first_name, last_name), person_id) pairs, indexed in memory.  Alternatively,
+        buckets is an index built beforehand: a mapping with a get(key, default) method, from blocking key to the
+        entries of index_entries(), such as the one of a PureSnapshot.
+        """
+        self.threshold = threshold
+        self.margin = margin
+        if buckets is None:
+            buckets = collections.defaultdict(list)
+            for key, entry in index_entries(names):
+                buckets[key].append(entry)
+        self.buckets = buckets
+
+    def candidates(self, first_name, last_name_parts):
+        found = set()
+        for key in blocking_keys(first_name, last_name_parts):
+            found.update(self.buckets.get(key, ()))
+        return found
+
+    def match(self, first_name, last_name):
+        """
+        Return (person_id, confidence) for the best match of an author's first and last name, or None if no
+        person matches well enough, or several do.
+        """
+        first_name = normalize_name(first_name)
+        last_name_parts = tuple(normalize_name(last_name).split())
+        if not first_name or not last_name_parts:
+            return None
+        best = {}
+        for person_id, candidate_first_name, candidate_last_name_parts in \
+                self.candidates(first_name, last_name_parts):
+            confidence = (self.LAST_NAME_WEIGHT * last_name_score(last_name_parts, candidate_last_name_parts) +
+                          (1 - self.LAST_NAME_WEIGHT) * first_name_score(first_name, candidate_first_name))
+            if confidence > best.get(person_id, 0.0):
+                best[person_id] = confidence
+        ranked = sorted(best.items(), key=lambda item: (-item[1], item[0]))
+        if not ranked or ranked[0][1] < self.threshold:
+            return None
+        if len(ranked) > 1 and ranked[0][1] - ranked[1][1] < self.margin:
+            return None
+        return ranked[0]
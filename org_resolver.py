@@ -0,0 +1,83 @@
+import re
+
+# Publishers are hard-coded strings
+PUBLISHER_MAPPING = {
+    'ACOM': "ucarncar-publisher-acom",
+    'CGD': "ucarncar-publisher-cgd",
+    'CISL': "ucarncar-publisher-cisl",
+    'RDA': "ucarncar-publisher-cisl-isd",  # Map to CISL-ISD
+    'GDEX': "ucarncar-publisher-cisl-isd",  # Map to CISL-ISD
+    'EOL': "ucarncar-publisher-eol",
+    'HAO': "ucarncar-publisher-hao",
+    'Library': "ucarncar-publisher-ncar-library",
+    'RAL': "ucarncar-publisher-ral",
+    'UCP': "ucarncar-publisher-ucp",
+    'NCAR': "ucarncar-publisher-ncar",  # Always place at the end of this list
+}
+
+
+class SubstringMatcher:
+    """
+    Find the first entry of a mapping whose key is a substring of a given string, and return its value.
+
+    "First" refers to the order of the mapping, not the position in the string, matching a linear scan
+    with 'key in string'.  All keys are found in a single pass with one compiled regular expression,
+    and results are memoized because the same organization strings occur over and over.
+    """
+    def __init__(self, mapping):
+        self.keys = list(mapping)
+        self.values = list(mapping.values())
+        self.memo = {}
+        if self.keys:
+            # The lookahead finds a match at every position, not just non-overlapping ones.  At each position the
+            # alternation picks the earliest key in mapping order, so the smallest index found is the first key
+            # of the mapping that occurs anywhere in the string.
+            alternatives = '|'.join(f'(?P<k{index}>{re.escape(key)})' for index, key in enumerate(self.keys))
+            self.pattern = re.compile(f'(?=(?:{alternatives}))')
+        else:
+            self.pattern = None
+
+    def match(self, string):
+        if string in self.memo:
+            return self.memo[string]
+        value = None
+        if self.pattern is not None:
+            indexes = [int(match.lastgroup[1:]) for match in self.pattern.finditer(string)]
+            if indexes:
+                value = self.values[min(indexes)]
+        self.memo[string] = value
+        return value
+
+
+class OrganizationResolver:
+    """
+    Precompiled resolver for publisher strings, Workday organization IDs and NCAR author team IDs.
+
+    Publisher and Workday lookups return the value of the first mapping key contained in the organization
+    string.  Team lookups use a reverse index from team name to lab; as with the scan over author_orgs.yaml,
+    a team listed under several labs resolves to the last one.  The Workday mapping is loaded on first use
+    by calling workday_mapping_loader, since it requires a query to the Pure API.
+    """
+    def __init__(self, publisher_mapping, org_authors, org_author_ids, workday_mapping_loader):
+        self.publisher_matcher = SubstringMatcher(publisher_mapping)
+        self.workday_mapping_loader = workday_mapping_loader
+        self.workday_matcher = None
+        self.org_author_ids = org_author_ids
+        self.team_labs = {}
+        for org, teams in org_authors.items():
+            for team in teams or []:
+                self.team_labs[team] = org
+
+    def publisher_string(self, org_string):
+        return self.publisher_matcher.match(org_string)
+
+    def organization_id(self, org_string):
+        if self.workday_matcher is None:
+            self.workday_matcher = SubstringMatcher(self.workday_mapping_loader())
+        return self.workday_matcher.match(org_string)
+
+    def author_organization_id(self, org_author_string):
+        org = self.team_labs.get(org_author_string)
+        if org is None:
+            return None
+        return str(self.org_author_ids[org])
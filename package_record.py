@@ -0,0 +1,96 @@
+import json
+
+# Package extras that influence the rendered <dataset> element.
+RENDERED_EXTRAS = ('publisher-standard', 'publisher', 'guid', 'extent_range', 'resource-url',
+                   'publication_date', 'harvest-author-with-url')
+
+# Package fields requested with the package_search 'fl' parameter when only the fields used for rendering are
+# wanted.  CKAN's Solr index holds extras as 'extras_<key>' fields; Solr does not accept hyphens in 'fl' field
+# names, so the extras with hyphenated keys are selected with wildcards.  The package type is indexed as
+# 'dataset_type'.
+PROJECTED_FIELDS = ('id', 'type', 'dataset_type', 'state', 'title', 'notes', 'metadata_modified',
+                    'extras_guid', 'extras_extent_range', 'extras_publication_date', 'extras_publisher*',
+                    'extras_resource*', 'extras_harvest*')
+
+_NOT_DECODED = object()
+
+
+class PackageRecord:
+    """
+    Wrapper around a CKAN package dictionary from a package_search result.
+
+    The extras list is indexed into a dictionary once, so each extra is found without scanning the list.
+    As with get_extras_value, the last entry wins if a key occurs more than once.  The JSON-valued extras
+    (publishers and authors) are decoded on first access and then kept.
+
+    Results projected to PROJECTED_FIELDS have no extras list.  Their extras are taken from the 'extras_<key>'
+    fields, or from the package itself, where CKAN merges them into it.
+    """
+    __slots__ = ('pkg_dict', 'extras', '_publishers', '_publishers_standard', '_authors')
+
+    def __init__(self, pkg_dict):
+        self.pkg_dict = pkg_dict
+        if 'extras' in pkg_dict:
+            self.extras = {extra['key']: extra['value'] for extra in pkg_dict['extras']}
+        else:
+            self.extras = {key: pkg_dict[key] for key in RENDERED_EXTRAS if key in pkg_dict}
+            self.extras.update((key[len('extras_'):], value) for key, value in pkg_dict.items()
+                               if key.startswith('extras_'))
+        self._publishers = _NOT_DECODED
+        self._publishers_standard = _NOT_DECODED
+        self._authors = _NOT_DECODED
+
+    @property
+    def id(self):
+        return self.pkg_dict['id']
+
+    @property
+    def type(self):
+        return self.pkg_dict['type'] if 'type' in self.pkg_dict else self.pkg_dict['dataset_type']
+
+    @property
+    def state(self):
+        return self.pkg_dict['state']
+
+    # Solr leaves out empty fields, which are empty strings in the complete package dictionary.
+    @property
+    def title(self):
+        return self.pkg_dict.get('title') or ''
+
+    @property
+    def notes(self):
+        return self.pkg_dict.get('notes') or ''
+
+    @property
+    def metadata_modified(self):
+        return self.pkg_dict['metadata_modified']
+
+    def extra(self, key):
+        """ Return the value of a package extra, or None if the package does not have it. """
+        return self.extras.get(key)
+
+    @property
+    def publishers(self):
+        if self._publishers is _NOT_DECODED:
+            self._publishers = json.loads(self.extra('publisher'))
+        return self._publishers
+
+    @property
+    def publishers_standard(self):
+        if self._publishers_standard is _NOT_DECODED:
+            self._publishers_standard = json.loads(self.extra('publisher-standard'))
+        return self._publishers_standard
+
+    @property
+    def authors(self):
+        """ The list of author dictionaries with 'name' and 'orcid_url', or None if the package has no authors. """
+        if self._authors is _NOT_DECODED:
+            authors_json = self.extra('harvest-author-with-url')
+            self._authors = json.loads(authors_json) if authors_json else None
+        return self._authors
+
+    def rendered_fields(self):
+        """ Return the package fields used to render its <dataset> element and its resolution. """
+        extras = {key: self.extras[key] for key in RENDERED_EXTRAS if key in self.extras}
+        return {'id': self.id, 'type': self.type, 'state': self.state, 'title': self.title, 'notes': self.notes,
+                'extras': extras}
@@ -0,0 +1,141 @@
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+from metrics import get_metrics
+from package_record import PackageRecord
+from pure_parse import configure_feed_cache, configure_author_cache, get_author_cache, load_pure_lookups, \
+    configure_fuzzy_matching, configure_pure_snapshot
+from utils import render_record, report_cached_dataset
+
+# Set in each worker process by init_worker().
+ADD_EXTRA_ELEMENTS = False
+EXTRACT = None
+
+
+def init_worker(feed_cache_dir, add_extra_elements, author_cache=None, fuzzy_matching=None, extract=None,
+                pure_snapshot=None):
+    """
+    Prepare a worker process: load the person and organization lookups once, from the feed cache that the
+    parent process has already refreshed, or from the parent's pure_snapshot file.  author_cache is the
+    (cache_file, context_fingerprint) of the parent's author cache, if it uses one; the worker only reads it,
+    and sends new entries to the parent.  fuzzy_matching holds the arguments of configure_fuzzy_matching(), if
+    the parent matches names fuzzily, and extract is passed on to render_record().
+    """
+    global ADD_EXTRA_ELEMENTS, EXTRACT
+    ADD_EXTRA_ELEMENTS = add_extra_elements
+    EXTRACT = extract
+    # Only report the worker's own measurements.
+    get_metrics().drain()
+    if feed_cache_dir:
+        configure_feed_cache(feed_cache_dir, offline=True)
+    if author_cache:
+        configure_author_cache(*author_cache)
+    if fuzzy_matching:
+        configure_fuzzy_matching(**fuzzy_matching)
+    if pure_snapshot:
+        configure_pure_snapshot(pure_snapshot)
+    load_pure_lookups()
+
+
+def render_batch(pkg_dicts):
+    """
+    Render a list of CKAN package dictionaries in a worker process.  Returns a (fragment, resolution) tuple for
+    each package, where fragment is the serialized <dataset> element or None if the dataset was filtered out,
+    the timers and counters recorded by the worker since its previous batch, and the new author cache entries.
+    """
+    metrics = get_metrics()
+    results = []
+    for pkg_dict in pkg_dicts:
+        with metrics.stage('render'):
+            dataset, resolution = render_record(PackageRecord(pkg_dict), ADD_EXTRA_ELEMENTS, EXTRACT)
+            fragment = etree.tostring(dataset) if dataset is not None else None
+        results.append((fragment, resolution))
+    author_cache = get_author_cache()
+    return results, metrics.drain(), author_cache.drain() if author_cache is not None else {}
+
+
+class ParallelRenderer:
+    """
+    Render packages in a pool of worker processes, and hand the results back in input order.
+
+    Packages are sent to the workers in batches, and a bounded number of batches is kept in flight so that
+    memory use does not depend on the number of packages.  If a FragmentCache is given, cached datasets are
+    taken from it and only the misses are sent to the workers.  If the parent uses an author cache, given as
+    its (cache_file, context_fingerprint), the workers share its entries, and fuzzy_matching, extract and
+    pure_snapshot pass the parent's fuzzy name matching settings, render_record() mode and Pure snapshot file
+    on to them.
+    """
+    def __init__(self, workers, feed_cache_dir, add_extra_elements, fragment_cache=None, batch_size=25,
+                 author_cache=None, fuzzy_matching=None, extract=None, pure_snapshot=None):
+        self.workers = workers
+        self.add_extra_elements = add_extra_elements
+        self.fragment_cache = fragment_cache
+        self.batch_size = batch_size
+        # Workers are spawned rather than forked: the parent is fetching pages in other threads, and a fork
+        # could copy a lock one of them holds, e.g. that of the metrics.
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=init_worker,
+                                            initargs=(feed_cache_dir, add_extra_elements, author_cache,
+                                                      fuzzy_matching, extract, pure_snapshot))
+
+    def submit(self, packages):
+        """
+        Start rendering a batch of packages.  Returns a list with a [dataset, resolution] entry per package,
+        filled in already for cache hits, the cache keys of the misses, and the future for the misses.
+        """
+        results = []
+        misses = []
+        for index, package in enumerate(packages):
+            if self.fragment_cache is not None:
+                key = self.fragment_cache.key(package, self.add_extra_elements)
+                found, dataset, resolution = self.fragment_cache.get(key)
+                if found:
+                    report_cached_dataset(package, dataset, resolution)
+                    results.append([dataset, resolution])
+                    continue
+            else:
+                key = None
+            results.append(None)
+            misses.append((index, key, package.pkg_dict))
+        future = None
+        if misses:
+            future = self.executor.submit(render_batch, [pkg_dict for _, _, pkg_dict in misses])
+        return packages, results, misses, future
+
+    def complete(self, packages, results, misses, future):
+        """ Wait for a batch to finish and yield its (package, dataset, resolution) tuples in order. """
+        if future is not None:
+            batch_results, worker_metrics, author_cache_entries = future.result()
+            get_metrics().merge(worker_metrics)
+            if author_cache_entries:
+                get_author_cache().merge(author_cache_entries)
+            for (index, key, _), (fragment, resolution) in zip(misses, batch_results):
+                dataset = etree.fromstring(fragment) if fragment is not None else None
+                if self.fragment_cache is not None:
+                    self.fragment_cache.put(key, dataset, resolution)
+                results[index] = [dataset, resolution]
+        for package, (dataset, resolution) in zip(packages, results):
+            yield package, dataset, resolution
+
+    def render(self, packages):
+        """ Yield a (package, dataset, resolution) tuple for each PackageRecord, in input order. """
+        pending = collections.deque()
+        batch = []
+        for package in packages:
+            batch.append(package)
+            if len(batch) == self.batch_size:
+                pending.append(self.submit(batch))
+                batch = []
+                # Keep every worker busy, with one batch queued behind the one it is rendering.
+                while len(pending) > 2 * self.workers:
+                    yield from self.complete(*pending.popleft())
+        if batch:
+            pending.append(self.submit(batch))
+        while pending:
+            yield from self.complete(*pending.popleft())
+
+    def close(self):
+        self.executor.shutdown()
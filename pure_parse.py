@@ -1,65 +1,47 @@
-import urllib.request
+import contextlib
+import sys
 import urllib.error
-from lxml import etree as ET
-import os
-import yaml
+from collections import namedtuple
 
-from lxml.etree import XPathEvalError
+from author_cache import AuthorCache
+from feed_cache import FeedCache
+from http_client import get_http_client
+from metrics import get_metrics
+from name_matcher import FuzzyNameMatcher
+from org_resolver import OrganizationResolver, PUBLISHER_MAPPING
+from pure_snapshot import PureSnapshot, SnapshotTable, build_snapshot
 
 
-def urlopen_with_basic_auth(url, username, password):
+def urlopen_with_basic_auth(url, username, password, headers=None):
     """
-    Opens a URL using urllib.request.urlopen with basic HTTP authentication.
+    Opens a URL with basic HTTP authentication, using the shared HTTP client.
 
     Args:
         url (str): The URL to open.
         username (str): The username for authentication.
         password (str): The password for authentication.
+        headers (dict): Optional extra request headers, e.g. for conditional requests.
 
     Returns:
-        http.client.HTTPResponse: The response object from the URL.
+        urllib3.response.HTTPResponse: The file-like response object, with the body not yet read.
 
     Raises:
         urllib.error.URLError: If there is an issue with the URL or network.
         urllib.error.HTTPError: If the server returns an HTTP error (e.g., 401).
     """
     try:
-        # Create a password manager
-        password_manager = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        password_manager.add_password(None, url, username, password)
-
-        # Create an authentication handler
-        auth_handler = urllib.request.HTTPBasicAuthHandler(password_manager)
-
-        # Build an opener with the authentication handler
-        opener = urllib.request.build_opener(auth_handler)
-
-        # Install the opener globally (optional, but convenient for subsequent urlopen calls)
-        urllib.request.install_opener(opener)
-
-        # Open the URL using the installed opener
-        response = urllib.request.urlopen(url)
-        return response
+        return get_http_client().open(url, headers, basic_auth=(username, password))
 
     except urllib.error.HTTPError as e:
-        print(f"HTTP Error: {e.code} - {e.reason}")
+        # "Not Modified" is the expected answer to a conditional request for an unchanged feed.
+        if e.code != 304:
+            print(f"HTTP Error: {e.code} - {e.reason}")
         raise
     except urllib.error.URLError as e:
         print(f"URL Error: {e.reason}")
         raise
 
 
-def getXMLTree(xml_string):
-    root = None
-    try:
-        root = ET.fromstring(xml_string)
-    except ET.XMLSyntaxError as e:
-        print(f"XML Syntax Error: {e.msg}")
-        print(f"Line: {e.lineno}, Column: {e.column}")
-    except ET.ParserError as e:
-        print(f"Parser Error: {e}")
-    return root
-
 ORG_NAMESPACES = {'d': 'v1.organisation-sync.pure.atira.dk',
                   'cmns': 'v3.commons.pure.atira.dk',
                   'f': 'http://myCustomFunctions.com',
@@ -70,31 +52,230 @@ PERSON_NAMESPACES = {'d': 'v1.unified-person-sync.pure.atira.dk',
                      'f': 'http://myCustomFunctions.com',
                      'xs': 'http://www.w3.org/2001/XMLSchema'}
 
-def populate_workday_mapping():
+# Compact records holding only the Pure feed fields used for author and organization lookups.
+PurePerson = namedtuple('PurePerson', ['person_id', 'orcids', 'names'])
+PureOrganisation = namedtuple('PureOrganisation', ['organisation_id', 'name_variants'])
+
+
+# Optional FeedCache used for the Pure feeds; set with configure_feed_cache().
+FEED_CACHE = None
+
+
+def configure_feed_cache(cache_dir, ttl=0, offline=False):
+    """
+    Keep local copies of the Pure feeds in cache_dir, revalidating them once they are older than ttl seconds.
+    In offline mode, only the cached copies are used.
+    """
+    global FEED_CACHE
+    FEED_CACHE = FeedCache(cache_dir, ttl, offline)
+
+
+# Optional snapshot of the Pure feeds, queried instead of parsing the feeds; set with configure_pure_snapshot().
+PURE_SNAPSHOT_FILE = None
+PURE_SNAPSHOT = None
+
+
+def configure_pure_snapshot(snapshot_file):
+    """
+    Look up persons and organisations in the PureSnapshot in snapshot_file, see build_pure_snapshot(), instead
+    of downloading and parsing the Pure feeds.  Lookup tables already loaded are dropped.
+    """
+    global PURE_SNAPSHOT_FILE, PURE_SNAPSHOT, PERSONS_BY_ORCID, PERSONS_BY_NAME
+    PURE_SNAPSHOT_FILE = snapshot_file
+    # A worker process must not use a connection inherited from its parent.
+    PURE_SNAPSHOT = None
+    PERSONS_BY_ORCID = PERSONS_BY_NAME = None
+
+
+def get_pure_snapshot():
+    global PURE_SNAPSHOT
+    if PURE_SNAPSHOT is None:
+        PURE_SNAPSHOT = PureSnapshot(PURE_SNAPSHOT_FILE)
+    return PURE_SNAPSHOT
+
+
+def build_pure_snapshot(snapshot_file):
+    """
+    Parse the current Pure persons and cost-center feeds into a PureSnapshot in snapshot_file, replacing any
+    previous snapshot.  Requires a feed cache, see configure_feed_cache().
+    """
+    fingerprints = {feed_name: FEED_CACHE.fingerprint(feed_name, pure_feed_fetcher(feed_name))
+                    for feed_name in ('persons', 'costcenters')}
+    with open_pure_feed('persons') as persons_feed, open_pure_feed('costcenters') as cost_centers, \
+            get_metrics().stage('pure_feed_parse'):
+        build_snapshot(snapshot_file, iter_persons(persons_feed), iter_organisations(cost_centers), fingerprints)
+
+
+# Optional AuthorCache used by get_pure_author_id; set with configure_author_cache().
+AUTHOR_CACHE = None
+
+
+def configure_author_cache(cache_file, context_fingerprint):
+    """
+    Remember author resolutions in cache_file, for as long as context_fingerprint stays the same.
+    """
+    global AUTHOR_CACHE
+    AUTHOR_CACHE = AuthorCache(cache_file, context_fingerprint)
+
+
+def get_author_cache():
+    return AUTHOR_CACHE
+
+
+# Settings for fuzzy name matching of authors, or None to match names exactly; set with
+# configure_fuzzy_matching().  The matcher is built from the persons feed on first use, or uses the index of
+# the snapshot the name lookups come from.
+FUZZY_MATCHING = None
+FUZZY_MATCHER = None
+
+
+def configure_fuzzy_matching(threshold, margin):
+    """
+    Match author names not found exactly in the persons feed approximately, accepting the best match if its
+    confidence is at least threshold and no other person comes within margin of it.
+    """
+    global FUZZY_MATCHING, FUZZY_MATCHER
+    FUZZY_MATCHING = {'threshold': threshold, 'margin': margin}
+    FUZZY_MATCHER = None
+
+
+def get_fuzzy_matcher():
+    global FUZZY_MATCHER
+    if FUZZY_MATCHER is None:
+        with get_metrics().stage('fuzzy_index'):
+            if isinstance(PERSONS_BY_NAME, SnapshotTable):
+                FUZZY_MATCHER = FuzzyNameMatcher(buckets=PERSONS_BY_NAME.snapshot.name_buckets, **FUZZY_MATCHING)
+            else:
+                FUZZY_MATCHER = FuzzyNameMatcher(PERSONS_BY_NAME.items(), **FUZZY_MATCHING)
+    return FUZZY_MATCHER
+
+
+def pure_feed_fetcher(feed_name):
+    """
+    Return a function that requests one of the Pure support server feeds, e.g. 'persons' or 'costcenters',
+    using the credentials stored in the ".auth_tokens" file.  The function takes optional extra request headers.
+    """
+    def fetch(headers=None):
+        auth_file = '.auth_tokens'
+        with open(auth_file) as f:
+            URL = f.readline().strip()
+            username = f.readline().strip()
+            password = f.readline().strip()
+        return urlopen_with_basic_auth(URL + feed_name, username, password, headers)
+    return fetch
+
+
+def open_pure_feed(feed_name):
+    """
+    Open one of the Pure support server feeds, through the feed cache if one is configured.
+    Returns a readable binary file-like object.
+    """
+    with get_metrics().stage('pure_feed_download'):
+        if FEED_CACHE is None:
+            return pure_feed_fetcher(feed_name)()
+        return FEED_CACHE.open(feed_name, pure_feed_fetcher(feed_name))
+
+
+def pure_feed_fingerprint(feed_name):
+    """
+    Return a digest of the current content of a Pure feed, or of the feed a configured snapshot was built from.
+    Requires a feed cache, see configure_feed_cache().
+    """
+    if PURE_SNAPSHOT_FILE is not None:
+        # Read the snapshot file anew, so that a long-running process notices when it is replaced.
+        snapshot = PureSnapshot(PURE_SNAPSHOT_FILE)
+        try:
+            return snapshot.fingerprint(feed_name)
+        finally:
+            snapshot.close()
+    return FEED_CACHE.fingerprint(feed_name, pure_feed_fetcher(feed_name))
+
+
+def iterparse_elements(source, tag):
+    """
+    Incrementally parse an XML stream and yield each completed element with the given tag.
+
+    Elements are cleared after the caller has processed them, along with any preceding siblings,
+    so only a small part of the document is held in memory at any time.
+    """
+    # lxml and yaml are imported where they are used, so importing this module stays cheap.
+    from lxml import etree as ET
+    try:
+        for _, element in ET.iterparse(source, events=('end',), tag=tag):
+            yield element
+            element.clear()
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+    except ET.XMLSyntaxError as e:
+        print(f"XML Syntax Error: {e.msg}", file=sys.stderr)
+        print(f"Line: {e.lineno}, Column: {e.position[1]}", file=sys.stderr)
+        raise
+
+
+def element_string(element):
+    """ Return the XPath string-value of an element, i.e. all of its text content. """
+    return ''.join(element.itertext())
+
+
+def iter_persons(source):
+    """
+    Yield a PurePerson record for each person in a Pure persons feed, in document order.
+    """
+    person_tag = '{%s}person' % PERSON_NAMESPACES['d']
+    for person_element in iterparse_elements(source, person_tag):
+        orcids = tuple(orcid_element.text for orcid_element in person_element.iterfind('d:orcId', PERSON_NAMESPACES)
+                       if orcid_element.text is not None)
+        names = []
+        for name_element in person_element.iterfind('d:name', PERSON_NAMESPACES):
+            first_names = [element_string(e) for e in name_element.iterfind('cmns:firstname', PERSON_NAMESPACES)]
+            last_names = [element_string(e) for e in name_element.iterfind('cmns:lastname', PERSON_NAMESPACES)]
+            names.extend((first_name, last_name) for first_name in first_names for last_name in last_names)
+        yield PurePerson(person_element.get("id"), orcids, tuple(names))
+
+
+def iter_organisations(source):
+    """
+    Yield a PureOrganisation record for each organisation in a Pure cost-center feed, in document order.
+    """
+    organisation_tag = '{%s}organisation' % ORG_NAMESPACES['d']
+    orgname_path = 'd:nameVariants/d:nameVariant/d:name/cmns:text'
+    for organisation_element in iterparse_elements(source, organisation_tag):
+        organisation_id = organisation_element.findtext('.//d:organisationId', namespaces=ORG_NAMESPACES)
+        name_variants = tuple(e.text for e in organisation_element.iterfind(orgname_path, ORG_NAMESPACES)
+                              if e.text is not None)
+        yield PureOrganisation(organisation_id, name_variants)
+
+
+def load_organisation_ids(snapshot=None):
+    """
+    Return the ID of the first organisation with each name variant in the cost-center feed, from the snapshot
+    if one is given.
+    """
+    if snapshot is not None:
+        return snapshot.organisation_ids
+
+    # Stream the PURE XML feed, keeping the first organisation found for each name variant.
+    with open_pure_feed('costcenters') as cost_centers, get_metrics().stage('pure_feed_parse'):
+        organisation_ids = {}
+        for organisation in iter_organisations(cost_centers):
+            for name in organisation.name_variants:
+                organisation_ids.setdefault(name, organisation.organisation_id)
+    return organisation_ids
+
+
+def populate_workday_mapping(snapshot=None):
     """
         Query the PURE API to populate the workday mapping for organization IDs.
     """
     mapping = {}
-    orgname_xpath = './/d:organisation/d:nameVariants/d:nameVariant/d:name/cmns:text'
-
-    # Get PURE XML feed data
-    auth_file = '.auth_tokens'
-    with open(auth_file) as f:
-        URL = f.readline().strip()
-        username = f.readline().strip()
-        password = f.readline().strip()
-    cost_centers = urlopen_with_basic_auth(URL + 'costcenters', username, password)
-    cost_centers = cost_centers.read()
-    xml_tree = getXMLTree(cost_centers)
+    organisation_ids = load_organisation_ids(snapshot)
 
     # Search for labs and extract their IDs
     labs = ['ACOM', 'CGD', 'CISL', 'ISD', 'EOL', 'HAO', 'NCARLIB', 'RAL', 'UCP', 'NCAR']
     for lab in labs:
-        xpath = f"{orgname_xpath}[text()=\"{lab}\"]"
-        matching_elements = xml_tree.xpath(xpath, namespaces=ORG_NAMESPACES)
-        organisation_element = matching_elements[0].getparent().getparent().getparent().getparent()
-        organisation_id_element = organisation_element.xpath('.//d:organisationId', namespaces=ORG_NAMESPACES)
-        organisation_id = organisation_id_element[0].text.strip()
+        organisation_id = organisation_ids[lab].strip()
 
         # Rename keys for a few Orgs to match DASH Search entries
         if lab == "ISD":
@@ -110,6 +291,48 @@ def populate_workday_mapping():
 
 # Organization IDs get populated with Pure API queries
 WORKDAY_ORG_MAPPING = {}
+def load_workday_mapping():
+    global WORKDAY_ORG_MAPPING
+    if not WORKDAY_ORG_MAPPING:
+        WORKDAY_ORG_MAPPING = populate_workday_mapping(get_pure_snapshot() if PURE_SNAPSHOT_FILE else None)
+    return WORKDAY_ORG_MAPPING
+
+
+ORG_AUTHORS = None
+ORG_AUTHOR_IDS = None
+def read_author_teams():
+    """ Return the NCAR author teams with their NCAR Lab, and the Lab author IDs, from the YAML files. """
+    import yaml
+    with open('author_orgs.yaml', 'r') as file:
+        org_authors = yaml.safe_load(file)
+    with open('author_org_ids.yaml', 'r') as file:
+        org_author_ids = yaml.safe_load(file)
+    return org_authors, org_author_ids
+
+
+def load_author_teams():
+    """
+    Load YAML data with NCAR author teams, their mapped NCAR Lab, and
+    Lab author IDs.
+    """
+    global ORG_AUTHORS, ORG_AUTHOR_IDS
+    if ORG_AUTHORS is None or ORG_AUTHOR_IDS is None:
+        ORG_AUTHORS, ORG_AUTHOR_IDS = read_author_teams()
+
+
+ORGANIZATION_RESOLVER = None
+def get_organization_resolver():
+    """
+    Return the OrganizationResolver for publishers, Workday IDs and author teams, building it on first use.
+    """
+    global ORGANIZATION_RESOLVER
+    if ORGANIZATION_RESOLVER is None:
+        load_author_teams()
+        ORGANIZATION_RESOLVER = OrganizationResolver(PUBLISHER_MAPPING, ORG_AUTHORS, ORG_AUTHOR_IDS,
+                                                     load_workday_mapping)
+    return ORGANIZATION_RESOLVER
+
+
 def get_organization_id(org_string):
     """
     Given a string representing an NCAR organization, find the first mapping entry with a partial match and
@@ -117,39 +340,14 @@ def get_organization_id(org_string):
 
     The partial string match test is case-sensitive.
     """
-    global WORKDAY_ORG_MAPPING
-    if not WORKDAY_ORG_MAPPING:
-        WORKDAY_ORG_MAPPING = populate_workday_mapping()
-    workday_id = None
-    for key, value in WORKDAY_ORG_MAPPING.items():
-        if key in org_string:
-            workday_id = value
-            break
-    return workday_id
+    return get_organization_resolver().organization_id(org_string)
 
 
-ORG_AUTHORS = None
-ORG_AUTHOR_IDS = None
 def get_author_organization_id(org_author_string):
     """
-    Load YAML data with NCAR author teams, their mapped NCAR Lab, and
-    Lab author IDs.
-
-    Return the NCAR Lab Id if the team name is found.
+    Return the NCAR Lab Id if the team name is found in the NCAR author teams.
     """
-    org_author_id = None
-    global ORG_AUTHORS
-    if ORG_AUTHORS is None:
-        with open('author_orgs.yaml', 'r') as file:
-            ORG_AUTHORS = yaml.safe_load(file)
-    global ORG_AUTHOR_IDS
-    if ORG_AUTHOR_IDS is None:
-        with open('author_org_ids.yaml', 'r') as file:
-            ORG_AUTHOR_IDS = yaml.safe_load(file)
-    for org in ORG_AUTHORS:
-        if org_author_string in ORG_AUTHORS[org]:
-            org_author_id = str(ORG_AUTHOR_IDS[org])
-    return org_author_id
+    return get_organization_resolver().author_organization_id(org_author_string)
 
 
 def is_middle_initial(word_string):
@@ -192,62 +390,196 @@ def split_name_string(name_string):
     return first_name, last_name
 
 
-PERSONS_XML_FEED = None
+# Person IDs from the Pure persons feed, indexed by ORCID and by (first name, last name).
+PERSONS_BY_ORCID = None
+PERSONS_BY_NAME = None
+
+
+def index_persons(persons):
+    """
+    Build the ORCID and name lookup tables from an iterable of PurePerson records.
+
+    Keys hold the exact element text used by the original XPath lookups, and when several persons share a key
+    the first one in document order is kept, so lookups return the same person as the XPath queries did.
+    """
+    by_orcid = {}
+    by_name = {}
+    for person in persons:
+        for orcid in person.orcids:
+            by_orcid.setdefault(orcid, person.person_id)
+        for name in person.names:
+            by_name.setdefault(name, person.person_id)
+    return by_orcid, by_name
+
+
+def load_persons_tables(snapshot=None):
+    """
+    Return the ORCID and name lookup tables of the persons feed, see index_persons(), or those of the snapshot
+    if one is given.
+    """
+    if snapshot is not None:
+        return snapshot.persons_by_orcid, snapshot.persons_by_name
+    with open_pure_feed('persons') as persons_feed, get_metrics().stage('pure_feed_parse'):
+        return index_persons(iter_persons(persons_feed))
+
+
+def load_persons_feed():
+    """
+    Stream the latest Workday persons data from the Pure API into the lookup tables, or open them in the
+    configured snapshot.
+    """
+    global PERSONS_BY_ORCID, PERSONS_BY_NAME, FUZZY_MATCHER
+    PERSONS_BY_ORCID, PERSONS_BY_NAME = load_persons_tables(get_pure_snapshot() if PURE_SNAPSHOT_FILE else None)
+    FUZZY_MATCHER = None
+
+
+def revalidate_pure_feeds():
+    """
+    Let the feed cache check the Pure feeds for changes again, once their TTL has passed, in a long-running
+    process; normally each feed is checked at most once.
+    """
+    if FEED_CACHE is not None:
+        FEED_CACHE.expire()
+
+
+def refresh_pure_feeds():
+    """
+    Make sure the feed cache holds current copies of the Pure feeds, without parsing them.  Nothing is needed
+    when the lookups come from a snapshot.
+    """
+    if PURE_SNAPSHOT_FILE is not None:
+        return
+    for feed_name in ('persons', 'costcenters'):
+        open_pure_feed(feed_name).close()
+
+
+def load_pure_lookups():
+    """
+    Load all person and organization lookup tables now, rather than on first use.  With an author cache, the
+    persons feed is still left until an author is not found in the cache.
+    """
+    if PERSONS_BY_ORCID is None and AUTHOR_CACHE is None:
+        load_persons_feed()
+    get_organization_resolver()
+    load_workday_mapping()
+
+
+def reload_pure_lookups(swap_lock=None):
+    """
+    Rebuild all person and organization lookup tables from the current Pure feeds and author team files, for a
+    long-running process.  The new tables are built first and then replaced all at once, holding swap_lock if
+    given, so lookups made meanwhile keep using the old tables.
+    """
+    global PERSONS_BY_ORCID, PERSONS_BY_NAME, FUZZY_MATCHER, WORKDAY_ORG_MAPPING, ORG_AUTHORS, ORG_AUTHOR_IDS, \
+        ORGANIZATION_RESOLVER, PURE_SNAPSHOT
+    # A snapshot is opened anew, in case the file has been replaced with a newer one.
+    snapshot = PureSnapshot(PURE_SNAPSHOT_FILE) if PURE_SNAPSHOT_FILE else None
+    persons_by_orcid, persons_by_name = load_persons_tables(snapshot)
+    workday_mapping = populate_workday_mapping(snapshot)
+    org_authors, org_author_ids = read_author_teams()
+    organization_resolver = OrganizationResolver(PUBLISHER_MAPPING, org_authors, org_author_ids,
+                                                 lambda: workday_mapping)
+    with swap_lock or contextlib.nullcontext():
+        PERSONS_BY_ORCID, PERSONS_BY_NAME = persons_by_orcid, persons_by_name
+        FUZZY_MATCHER = None
+        WORKDAY_ORG_MAPPING = workday_mapping
+        ORG_AUTHORS, ORG_AUTHOR_IDS = org_authors, org_author_ids
+        ORGANIZATION_RESOLVER = organization_resolver
+        if snapshot is not None:
+            PURE_SNAPSHOT = snapshot
+
+
+def reset_pure_lookups():
+    """
+    Forget the lookup tables, the author cache, the snapshot and the fuzzy matching settings, so that another
+    harvest in the same process starts from its own configuration and the current Pure feeds and author team
+    files.
+    """
+    global PERSONS_BY_ORCID, PERSONS_BY_NAME, FUZZY_MATCHING, FUZZY_MATCHER, WORKDAY_ORG_MAPPING, ORG_AUTHORS, \
+        ORG_AUTHOR_IDS, ORGANIZATION_RESOLVER, AUTHOR_CACHE, PURE_SNAPSHOT_FILE, PURE_SNAPSHOT
+    PERSONS_BY_ORCID = PERSONS_BY_NAME = None
+    FUZZY_MATCHING = FUZZY_MATCHER = None
+    WORKDAY_ORG_MAPPING = {}
+    ORG_AUTHORS = ORG_AUTHOR_IDS = None
+    ORGANIZATION_RESOLVER = None
+    AUTHOR_CACHE = None
+    PURE_SNAPSHOT_FILE = PURE_SNAPSHOT = None
+
+
+def get_orcid_id(author):
+    """ Return the ORCID iD of an author dictionary, from its 'orcid_url' field, or None if there is none. """
+    if author['orcid_url'] and 'orcid' in author['orcid_url']:
+        return author['orcid_url'].split('/')[-1]
+    return None
+
 
 def get_pure_author_id(author):
     """Given a list of author dictionaries with the fields 'name' and 'orcid', find the Workday IDs
        using the PURE API.   Also return the ORCID id, or None if it is not found.
     """
-    author_id = None
-    orcid_id = None
-    orcid_xpath = ".//d:person/d:orcId"
+    author_id, orcid_id, _ = resolve_pure_author(author)
+    return author_id, orcid_id
 
-    global PERSONS_XML_FEED
-    if PERSONS_XML_FEED is None:
-        # Always get the latest Workday persons data
-        auth_file = '.auth_tokens'
-        with open(auth_file) as f:
-            URL = f.readline().strip()
-            username = f.readline().strip()
-            password = f.readline().strip()
-        PERSONS_XML_FEED = urlopen_with_basic_auth(URL + 'persons', username, password)
-        PERSONS_XML_FEED = PERSONS_XML_FEED.read()
 
-        # Create a local file with persons content for debugging purposes
-        if not os.path.exists("/tmp/persons.txt"):
-            persons_text = PERSONS_XML_FEED.decode('utf-8')
-            with open("/tmp/persons.txt", 'w') as file:
-                file.write(persons_text)
-        PERSONS_XML_FEED = getXMLTree(PERSONS_XML_FEED)
+def resolve_pure_author(author):
+    """
+    Like get_pure_author_id, but also return the method that found the Workday ID, see resolve_author().
+    """
+    orcid_id = get_orcid_id(author)
+
+    if AUTHOR_CACHE is not None:
+        cached = AUTHOR_CACHE.get(author['name'], orcid_id)
+        if cached is not None:
+            author_id, method = cached
+            get_metrics().count('author_matches', method=method)
+            return author_id, orcid_id, method
+
+    author_id, method = resolve_author(author['name'], orcid_id)
+    get_metrics().count('author_matches', method=method)
+    if AUTHOR_CACHE is not None:
+        AUTHOR_CACHE.put(author['name'], orcid_id, author_id, method)
+    return author_id, orcid_id, method
+
+
+def resolve_author(name, orcid_id):
+    """
+    Find the Workday ID for an author from the ORCID, the NCAR team names or the person's name, in that order.
+    Returns the ID, or None if none is found, and the method that found it.
+    """
+    if PERSONS_BY_ORCID is None:
+        # Always get the latest Workday persons data
+        load_persons_feed()
 
     # First, check if there is an ORCID and it's in Workday
-    if author['orcid_url'] and 'orcid' in author['orcid_url']:
-        orcid_id = author['orcid_url'].split('/')[-1]
-        xpath = f"{orcid_xpath}[text()=\"{orcid_id}\"]"
-        matchingOrcidElements = PERSONS_XML_FEED.xpath(xpath, namespaces=PERSON_NAMESPACES)
-        if matchingOrcidElements:
-            personElement = matchingOrcidElements[0].getparent()
-            author_id = personElement.get("id")
-            return author_id, orcid_id
-        #else:
-        #    # Library wants ORCID-to-dataset mappings for all available ORCID ids
-        #    return None, orcid_id
+    if orcid_id in PERSONS_BY_ORCID:
+        return PERSONS_BY_ORCID[orcid_id], 'orcid'
+    #else:
+    #    # Library wants ORCID-to-dataset mappings for all available ORCID ids
+    #    return None, orcid_id
 
     # If author is an NCAR team, return the associated Lab ID.
-    author_id = get_author_organization_id(author['name'])
+    author_id = get_author_organization_id(name)
     if author_id:
-        return author_id, orcid_id
+        return author_id, 'team'
 
     # Try name matching if ORCID matching and organization author search fails.
-    first_name, last_name = split_name_string(author['name'])
-    name_xpath = f".//d:person/d:name[cmns:firstname=\"{first_name}\"][cmns:lastname=\"{last_name}\"]"
-    try:
-        matchingNameElements = PERSONS_XML_FEED.xpath(name_xpath, namespaces=PERSON_NAMESPACES)
-    except XPathEvalError as e:
-        print(f"XPathEvalError: {e.reason}")
-        raise
-    if matchingNameElements:
-        personElement = matchingNameElements[0].getparent()
-        author_id = personElement.get("id")
-
-    return author_id, orcid_id
+    first_name, last_name = split_name_string(name)
+    author_id = PERSONS_BY_NAME.get((first_name, last_name))
+    if author_id:
+        return author_id, 'name'
+
+    # Finally, look for a close match of the name, unless it is an organization name.
+    if FUZZY_MATCHING is not None and first_name is not None:
+        match = get_fuzzy_matcher().match(first_name, last_name)
+        if match is not None:
+            author_id, confidence = match
+            get_metrics().count('fuzzy_match_confidence', range=confidence_range(confidence))
+            print(f"Fuzzy name match: '{name}' -> {author_id} (confidence {confidence:.2f})", file=sys.stderr)
+            return author_id, 'fuzzy'
+    return None, 'none'
+
+
+def confidence_range(confidence):
+    """ Return the 0.05-wide range a match confidence falls into, e.g. '0.90-0.95', for the metrics. """
+    lower = min(int(confidence * 20), 19) / 20
+    return f'{lower:.2f}-{lower + 0.05:.2f}'
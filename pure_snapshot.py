@@ -0,0 +1,167 @@
+import os
+import pathlib
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+from name_matcher import index_entries
+
+SNAPSHOT_VERSION = 2
+# Rows inserted at a time while a snapshot is built.
+INSERT_BATCH_SIZE = 10000
+
+SNAPSHOT_SCHEMA = '''
+CREATE TABLE snapshot_info (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE person_orcids (orcid TEXT PRIMARY KEY, person_id TEXT) WITHOUT ROWID;
+CREATE TABLE person_names (first_name TEXT, last_name TEXT, person_id TEXT,
+                           PRIMARY KEY (first_name, last_name)) WITHOUT ROWID;
+CREATE TABLE organisation_names (name TEXT PRIMARY KEY, organisation_id TEXT) WITHOUT ROWID;
+CREATE TABLE person_name_buckets (kind TEXT, key TEXT, initial TEXT, person_id TEXT, first_name TEXT,
+                                  last_name TEXT,
+                                  PRIMARY KEY (kind, key, initial, person_id, first_name, last_name)) WITHOUT ROWID;
+'''
+
+
+def build_snapshot(snapshot_file, persons, organisations, fingerprints):
+    """
+    Write a snapshot of the Pure feeds from iterables of PurePerson and PureOrganisation records, in feed
+    order.  fingerprints holds the digest of each feed, by feed name.  The file is written next to its final
+    place and then replaced atomically, so processes reading the previous snapshot are not disturbed.
+    """
+    snapshot_dir = os.path.dirname(os.path.abspath(snapshot_file))
+    os.makedirs(snapshot_dir, exist_ok=True)
+    temporary_file = snapshot_file + '.tmp'
+    if os.path.exists(temporary_file):
+        os.remove(temporary_file)
+    connection = sqlite3.connect(temporary_file)
+    try:
+        # Nothing reads the temporary file, so it needs no journal.
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.executescript(SNAPSHOT_SCHEMA)
+        # As in the in-memory tables, the first person or organisation in feed order is kept for each key.
+        orcid_rows = []
+        name_rows = []
+        for person in persons:
+            orcid_rows.extend((orcid, person.person_id) for orcid in person.orcids)
+            name_rows.extend(name + (person.person_id,) for name in person.names)
+            if len(name_rows) >= INSERT_BATCH_SIZE:
+                connection.executemany('INSERT OR IGNORE INTO person_orcids VALUES (?, ?)', orcid_rows)
+                connection.executemany('INSERT OR IGNORE INTO person_names VALUES (?, ?, ?)', name_rows)
+                orcid_rows.clear()
+                name_rows.clear()
+        connection.executemany('INSERT OR IGNORE INTO person_orcids VALUES (?, ?)', orcid_rows)
+        connection.executemany('INSERT OR IGNORE INTO person_names VALUES (?, ?, ?)', name_rows)
+        # The fuzzy name matching index, built from the names that exact matching finds, as in memory.
+        names = (((first_name, last_name), person_id) for first_name, last_name, person_id in
+                 connection.execute('SELECT first_name, last_name, person_id FROM person_names').fetchall())
+        bucket_rows = []
+        for (kind, key, initial), (person_id, first_name, last_name_parts) in index_entries(names):
+            bucket_rows.append((kind, key, initial, person_id, first_name, ' '.join(last_name_parts)))
+            if len(bucket_rows) >= INSERT_BATCH_SIZE:
+                connection.executemany('INSERT OR IGNORE INTO person_name_buckets VALUES (?, ?, ?, ?, ?, ?)',
+                                       bucket_rows)
+                bucket_rows.clear()
+        connection.executemany('INSERT OR IGNORE INTO person_name_buckets VALUES (?, ?, ?, ?, ?, ?)', bucket_rows)
+        for organisation in organisations:
+            connection.executemany('INSERT OR IGNORE INTO organisation_names VALUES (?, ?)',
+                                   [(name, organisation.organisation_id) for name in organisation.name_variants])
+        info = {'version': str(SNAPSHOT_VERSION)}
+        info.update((feed_name + '_sha256', fingerprint) for feed_name, fingerprint in fingerprints.items())
+        connection.executemany('INSERT INTO snapshot_info VALUES (?, ?)', info.items())
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temporary_file, snapshot_file)
+
+
+class SnapshotTable(Mapping):
+    """
+    Read-only mapping over a table of a PureSnapshot, e.g. person IDs by ORCID.  Keys are single values, or
+    tuples for tables keyed by several columns.  Each lookup is a query on the table's primary key index.
+    """
+    def __init__(self, snapshot, table, key_columns, value_column):
+        self.snapshot = snapshot
+        self.key_columns = key_columns
+        condition = ' AND '.join(f'{column} = ?' for column in key_columns)
+        self.get_query = f'SELECT {value_column} FROM {table} WHERE {condition}'
+        self.items_query = f'SELECT {", ".join(key_columns)}, {value_column} FROM {table}'
+        self.count_query = f'SELECT COUNT(*) FROM {table}'
+
+    def key_values(self, key):
+        return key if len(self.key_columns) > 1 else (key,)
+
+    def __getitem__(self, key):
+        if key is None or len(self.key_columns) > 1 and (not isinstance(key, tuple) or None in key):
+            # None never matches, as in a dictionary built from the feeds.
+            raise KeyError(key)
+        rows = self.snapshot.query(self.get_query, self.key_values(key))
+        if not rows:
+            raise KeyError(key)
+        return rows[0][0]
+
+    def items(self):
+        if len(self.key_columns) > 1:
+            return [(tuple(row[:-1]), row[-1]) for row in self.snapshot.query(self.items_query)]
+        return self.snapshot.query(self.items_query)
+
+    def __iter__(self):
+        return iter([key for key, _ in self.items()])
+
+    def __len__(self):
+        return self.snapshot.query(self.count_query)[0][0]
+
+
+class SnapshotBuckets:
+    """
+    The fuzzy name matching index of a PureSnapshot, for FuzzyNameMatcher: the entries in the bucket of each
+    blocking key, looked up in the index of the person_name_buckets table.
+    """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def get(self, key, default=None):
+        rows = self.snapshot.query('SELECT person_id, first_name, last_name FROM person_name_buckets '
+                                   'WHERE kind = ? AND key = ? AND initial = ?', key)
+        if not rows:
+            return default
+        return [(person_id, first_name, tuple(last_name.split())) for person_id, first_name, last_name in rows]
+
+
+class PureSnapshot:
+    """
+    Indexed, read-only SQLite snapshot of the Pure persons and cost-center feeds, written by build_snapshot().
+
+    It holds the tables that author and organization resolution otherwise build by parsing the feeds: person
+    IDs by ORCID and by exact (first name, last name), and organisation IDs by name variant, each with the
+    first entry in feed order, and the blocking index of fuzzy name matching.  Opening a snapshot reads nothing
+    up front, so many processes can share one without each parsing the feeds, and a snapshot can be replaced with
+    a newer one while it is in use.
+    """
+    def __init__(self, snapshot_file):
+        if not os.path.exists(snapshot_file):
+            raise FileNotFoundError(f"No Pure snapshot at {snapshot_file}; create it with --build-snapshot")
+        # Snapshots are replaced, never changed in place, so SQLite can skip locking.
+        uri = pathlib.Path(snapshot_file).absolute().as_uri() + '?mode=ro&immutable=1'
+        self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.info = dict(self.query('SELECT key, value FROM snapshot_info'))
+        if self.info.get('version') != str(SNAPSHOT_VERSION):
+            raise ValueError(f"{snapshot_file} was made by another version of ckan2pure; rebuild it with "
+                             f"--build-snapshot")
+        self.persons_by_orcid = SnapshotTable(self, 'person_orcids', ['orcid'], 'person_id')
+        self.persons_by_name = SnapshotTable(self, 'person_names', ['first_name', 'last_name'], 'person_id')
+        self.organisation_ids = SnapshotTable(self, 'organisation_names', ['name'], 'organisation_id')
+        self.name_buckets = SnapshotBuckets(self)
+
+    def query(self, sql, parameters=()):
+        """ Return all rows of a query.  The HTTP service looks up authors from several threads. """
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def fingerprint(self, feed_name):
+        """ Return the digest of the feed the snapshot was built from. """
+        return self.info[feed_name + '_sha256']
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,125 @@
+import collections
+import glob
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import XMLStreamWriter
+
+SHARD_SUFFIXES = {None: '.xml', 'gzip': '.xml.gz', 'zstd': '.xml.zst'}
+MANIFEST_FILE = 'manifest.json'
+
+
+def get_compressor(compression):
+    """ Return a function that compresses bytes with the given method, or None for no compression. """
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        # A fixed timestamp makes the output, and so its checksum, the same for the same datasets.
+        return lambda data: gzip.compress(data, compresslevel=6, mtime=0)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        return lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f"Unknown compression method '{compression}'")
+
+
+class ShardedWriter(XMLStreamWriter):
+    """
+    Write the <datasets> document as a directory of shards, each a complete <datasets> document.
+
+    A shard is closed when it holds max_datasets datasets, or when the next dataset would take it past
+    max_bytes before compression.  Datasets are serialized as they arrive, like XMLStreamWriter does, and full
+    shards are compressed and written in a pool of threads while the following datasets are rendered.  When
+    the writer is closed, a manifest is written with the file name, size, SHA-256 checksum and dataset IDs of
+    each shard.  Shards and a manifest left in the directory by an earlier run are removed first.
+    """
+    def __init__(self, use_namespaces, xml_header, output_dir, max_datasets=None, max_bytes=None,
+                 compression=None, workers=4):
+        self.prepare_root(use_namespaces)
+        self.output_dir = output_dir
+        self.max_datasets = max_datasets
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.compress = get_compressor(compression)
+        self.workers = workers
+        self.document_start = ((xml_header or '') + self.start_tag).encode('utf-8')
+        self.document_end = self.end_tag.encode('utf-8')
+
+        os.makedirs(output_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(output_dir, 'datasets-*.xml*')) + [self.manifest_path()]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = collections.deque()
+        self.shards = []
+        self.shard_count = 0
+        self.entries = []
+        self.dataset_ids = []
+        self.size = len(self.document_start) + len(self.document_end)
+
+    def manifest_path(self):
+        return os.path.join(self.output_dir, MANIFEST_FILE)
+
+    def write(self, dataset, comment=None):
+        entry = self.entry_text(dataset, comment).encode('utf-8')
+        if self.dataset_ids:
+            shard_full = self.max_datasets and len(self.dataset_ids) >= self.max_datasets
+            too_large = self.max_bytes and self.size + len(entry) > self.max_bytes
+            if shard_full or too_large:
+                self.finish_shard()
+        self.entries.append(entry)
+        self.dataset_ids.append(dataset.get('id'))
+        self.size += len(entry)
+
+    def finish_shard(self):
+        """ Hand the current shard to the writing threads and start a new one. """
+        self.shard_count += 1
+        file_name = 'datasets-%05d%s' % (self.shard_count, SHARD_SUFFIXES[self.compression])
+        document = b''.join([self.document_start] + self.entries + [self.document_end])
+        shard = {'file': file_name, 'datasets': len(self.dataset_ids), 'uncompressed_bytes': len(document),
+                 'ids': self.dataset_ids}
+        self.pending.append(self.executor.submit(self.write_shard, document, shard))
+        self.entries = []
+        self.dataset_ids = []
+        self.size = len(self.document_start) + len(self.document_end)
+        # Limit the number of finished shards held in memory.
+        while len(self.pending) > 2 * self.workers:
+            self.shards.append(self.pending.popleft().result())
+
+    def write_shard(self, document, shard):
+        """ Compress and write one shard; runs in a writing thread.  Returns its manifest entry. """
+        data = self.compress(document) if self.compress else document
+        path = os.path.join(self.output_dir, shard['file'])
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(path + '.tmp', path)
+        shard['bytes'] = len(data)
+        shard['sha256'] = hashlib.sha256(data).hexdigest()
+        return shard
+
+    def close(self):
+        if self.dataset_ids:
+            self.finish_shard()
+        while self.pending:
+            self.shards.append(self.pending.popleft().result())
+        self.executor.shutdown()
+        manifest = {'compression': self.compression,
+                    'datasets': sum(shard['datasets'] for shard in self.shards),
+                    'shards': self.shards}
+        with tempfile.NamedTemporaryFile('w', dir=self.output_dir, delete=False) as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(file.name, self.manifest_path())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Without a manifest, a failed run is not mistaken for a complete feed.
+            self.executor.shutdown()
@@ -0,0 +1,68 @@
+import csv
+import json
+
+from metrics import get_metrics
+from utils import orcid_doi_rows, ORCID_DOI_FIELDS
+
+
+class Sink:
+    """
+    An output of a harvest.  Every CKAN package of the harvest is passed to write(), in search result order,
+    with its resolution, see resolve_package(), and its <dataset> element, which is None if the dataset is left
+    out of the feed or no XML is built.  A single pass over the packages can feed any number of sinks.
+    """
+    def write(self, package, resolution, dataset):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class XMLSink(Sink):
+    """
+    The Pure XML feed, written with an XMLTreeWriter, XMLStreamWriter or ShardedWriter.  Written datasets are
+    also saved in the harvest checkpoint, if one is given.
+    """
+    def __init__(self, writer, checkpoint=None):
+        self.writer = writer
+        self.checkpoint = checkpoint
+
+    def write(self, package, resolution, dataset):
+        if dataset is None:
+            return
+        with get_metrics().stage('serialize'):
+            self.writer.write(dataset)
+        if self.checkpoint:
+            self.checkpoint.add_dataset(dataset)
+
+    def close(self):
+        with get_metrics().stage('serialize'):
+            self.writer.close()
+
+
+class ORCIDDOISink(Sink):
+    """ The ORCID/DOI CSV, with a row for each author with an ORCID iD, written to an open text file. """
+    def __init__(self, file):
+        self.file = file
+        self.csv_writer = csv.DictWriter(file, fieldnames=ORCID_DOI_FIELDS)
+
+    def write(self, package, resolution, dataset):
+        self.csv_writer.writerows(orcid_doi_rows(resolution))
+
+    def close(self):
+        self.file.close()
+
+
+class JSONLinesSink(Sink):
+    """
+    A line of JSON per package with its resolution, i.e. whether and why it is in the feed, written to an open
+    text file.
+    """
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, package, resolution, dataset):
+        self.file.write(json.dumps(resolution) + '\n')
+
+    def close(self):
+        self.file.close()
@@ -1,4 +1,3 @@
-import json
 import sys
 import time
 from datetime import datetime
@@ -6,7 +5,10 @@ import pathlib
 import re
 
 from lxml import etree
-from pure_parse import get_pure_author_id, split_name_string, get_organization_id
+from metrics import get_metrics
+from org_resolver import PUBLISHER_MAPPING  # Kept importable from utils
+from pure_parse import get_orcid_id, resolve_pure_author, split_name_string, get_organization_id, \
+    get_organization_resolver
 
 PURE_NS = "v1.dataset.pure.atira.dk"
 PURE = "{%s}" % PURE_NS
@@ -15,22 +17,6 @@ PURE_CMNS = "v3.commons.pure.atira.dk"
 CMNS = "{%s}" % PURE_CMNS
 
 
-# Publishers are hard-coded strings
-PUBLISHER_MAPPING = {
-    'ACOM': "ucarncar-publisher-acom",
-    'CGD': "ucarncar-publisher-cgd",
-    'CISL': "ucarncar-publisher-cisl",
-    'RDA': "ucarncar-publisher-cisl-isd",  # Map to CISL-ISD
-    'GDEX': "ucarncar-publisher-cisl-isd",  # Map to CISL-ISD
-    'EOL': "ucarncar-publisher-eol",
-    'HAO': "ucarncar-publisher-hao",
-    'Library': "ucarncar-publisher-ncar-library",
-    'RAL': "ucarncar-publisher-ral",
-    'UCP': "ucarncar-publisher-ucp",
-    'NCAR': "ucarncar-publisher-ncar",  # Always place at the end of this list
-}
-
-
 def get_publisher_string(org_string):
     """
     Given a string representing an NCAR organization, find the first PUBLISHER_MAPPING entry with a partial match and
@@ -38,12 +24,7 @@ def get_publisher_string(org_string):
 
     The partial string match test is case-sensitive.
     """
-    publisher_string = None
-    for key, value in PUBLISHER_MAPPING.items():
-        if key in org_string:
-            publisher_string = value
-            break
-    return publisher_string
+    return get_organization_resolver().publisher_string(org_string)
 
 
 def print_stderr(msg):
@@ -69,12 +50,142 @@ def write_xml(root, xml_header=None, output_file=None):
         file.close()
 
 
+class DatasetSerializer:
+    """
+    Serialize <dataset> elements one at a time, exactly as they appear in the complete <datasets> document.
+    """
+    def __init__(self, use_namespaces):
+        self.prepare_root(use_namespaces)
+
+    def prepare_root(self, use_namespaces):
+        """ Set up the root element that datasets are serialized in, and the document's start and end tags. """
+        # Datasets are serialized inside a root element with the feed namespaces, so that they use the same
+        # prefixes as in the complete document instead of declaring their own.
+        self.holder = xml_init(use_namespaces)
+        empty_root = xml_init(use_namespaces)
+        empty_root.text = ''
+        root_string = etree.tostring(empty_root, encoding='unicode')
+        split_index = root_string.rindex('</')
+        self.start_tag = root_string[:split_index] + '\n'
+        self.end_tag = root_string[split_index:] + '\n'
+
+    def serialize(self, dataset):
+        """ Return the pretty-printed text of a <dataset> element as it appears in the full document. """
+        # Trailing whitespace from a parsed document would turn off pretty printing of the root.
+        dataset.tail = None
+        self.holder.append(dataset)
+        content = etree.tostring(self.holder, pretty_print=True, encoding='unicode')
+        self.holder.remove(dataset)
+        return content[len(self.start_tag):-len(self.end_tag)]
+
+
+class XMLStreamWriter(DatasetSerializer):
+    """
+    Write the <datasets> document incrementally, one <dataset> element at a time.
+
+    Each dataset is serialized as soon as it is written and then released, so memory use stays flat regardless
+    of the number of datasets.  The output matches what write_xml() produces for the equivalent tree.
+    """
+    def __init__(self, use_namespaces, xml_header=None, output_file=None):
+        self.prepare_root(use_namespaces)
+        if output_file:
+            self.file = open(output_file, 'w', encoding='utf-8')
+        else:
+            self.file = sys.stdout
+        if xml_header:
+            self.file.write(xml_header)
+        self.file.write(self.start_tag)
+
+    def entry_text(self, dataset, comment=None):
+        """ Return the text written for a <dataset> element, optionally preceded by an XML comment. """
+        content = self.serialize(dataset)
+        if comment:
+            # "--" is not allowed inside XML comments.
+            comment = comment.replace('--', '- -')
+            content = f'  <!-- {comment} -->\n' + content
+        return content
+
+    def write(self, dataset, comment=None):
+        """ Write a <dataset> element, optionally preceded by an XML comment. """
+        self.file.write(self.entry_text(dataset, comment))
+
+    def close(self):
+        self.file.write(self.end_tag)
+        self.file.flush()
+        if self.file is not sys.stdout:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.file is not sys.stdout:
+            # Leave the document unterminated so a failed run is not mistaken for a complete feed.
+            self.file.close()
+
+
+class XMLTreeWriter:
+    """
+    Collect <dataset> elements in the complete XML tree, which is written with write_xml() when the writer is
+    closed.  Has the interface of XMLStreamWriter, but keeps the tree in root, e.g. for validate_xml().
+    """
+    def __init__(self, use_namespaces, xml_header=None, output_file=None):
+        self.root = xml_init(use_namespaces)
+        self.xml_header = xml_header
+        self.output_file = output_file
+
+    def write(self, dataset):
+        self.root.append(dataset)
+
+    def close(self):
+        write_xml(self.root, self.xml_header, self.output_file)
+
+
+XML_SCHEMA = None
+def get_xml_schema():
+    """
+    Return the compiled Pure dataset XSD schema, loading it on first use.
+    """
+    global XML_SCHEMA
+    if XML_SCHEMA is None:
+        current_directory = pathlib.Path(__file__).parent.absolute().as_posix()
+        schema_file = current_directory + '/PURE_XSD/dataset.xsd'
+        xmlschema_doc = etree.parse(schema_file)
+        XML_SCHEMA = etree.XMLSchema(xmlschema_doc)
+    return XML_SCHEMA
+
+
 def validate_xml(root):
-    current_directory = pathlib.Path(__file__).parent.absolute().as_posix()
-    schema_file = current_directory + '/PURE_XSD/dataset.xsd'
-    xmlschema_doc = etree.parse(schema_file)
-    xmlschema = etree.XMLSchema(xmlschema_doc)
-    xmlschema.assertValid(root)
+    get_xml_schema().assertValid(root)
+
+
+# Prefix of each element in the schema error paths of a dataset, "prefix:" or "" (the default namespace).
+PATH_PREFIX_PATTERN = re.compile(r'(?<=/)([\w.-]+):')
+
+
+def get_dataset_validation_error(dataset, use_namespaces=False):
+    """
+    Validate a single <dataset> element against the schema.  Returns None if it is valid, or otherwise
+    the schema error messages, with their paths using the namespace prefixes of the feed, as chosen by
+    use_namespaces, instead of the ones lxml gave the element.
+    """
+    xmlschema = get_xml_schema()
+    if xmlschema.validate(dataset):
+        return None
+    feed_prefixes = {namespace: f'{prefix}:' if prefix else ''
+                     for prefix, namespace in xml_init(use_namespaces).nsmap.items()}
+    path_prefixes = {}
+    for element in dataset.iter():
+        for prefix, namespace in element.nsmap.items():
+            if prefix and namespace in feed_prefixes:
+                path_prefixes.setdefault(prefix, feed_prefixes[namespace])
+
+    def feed_path(path):
+        return PATH_PREFIX_PATTERN.sub(lambda match: path_prefixes.get(match[1], match[0]), path)
+
+    return '; '.join(f"{feed_path(error.path)}: {error.message}" for error in xmlschema.error_log)
 
 
 def fill_date_fields(element, date_parts):
@@ -141,51 +252,133 @@ def remove_html_tags(text):
     return re.sub(clean, '', text)
 
 
-def render_package(root, pkg_dict, csv_writer, add_extra_elements=False):
+# Columns of the ORCID/DOI CSV file.
+ORCID_DOI_FIELDS = ['DOI', 'dataset_id', 'ORCID', 'name']
+
+
+def new_resolution(package):
+    """
+    Return the resolution of a dataset, given as a PackageRecord, before any lookups: a JSON-serializable
+    dictionary with the dataset's Pure ID, DOI URL and publisher, and each author's name, ORCID iD, Pure person
+    ID and the method that found it.  'status' is 'included' in the feed, 'filtered' out of it with the
+    'reason', 'quarantined' by the caller, or 'unresolved' if no Pure lookups were made.
+    """
+    return {'package_id': package.id, 'dataset_id': package.extra('guid'), 'title': package.title,
+            'resource_url': package.extra('resource-url'), 'publisher': None, 'publisher_id': None,
+            'authors': [], 'status': 'unresolved', 'reason': None}
+
+
+def describe_package(package):
+    """
+    Return the resolution of a dataset with its authors and their ORCID iDs, but without any Pure lookups, so
+    that no Pure feeds are needed.
+    """
+    resolution = new_resolution(package)
+    for author in package.authors or []:
+        resolution['authors'].append({'name': author['name'], 'orcid': get_orcid_id(author), 'person_id': None,
+                                      'method': None})
+    return resolution
+
+
+def filter_message(package, reason):
+    """ Return the message reporting that a dataset, given as a PackageRecord, is left out of the feed. """
+    if reason == 'no_publisher_mapping':
+        return f"#### Filtering out '{package.title}' with publisher(s) {package.publishers}"
+    if reason == 'no_authors':
+        return "#### No authors found, skipping..."
+    return (f"Could not find a matching author for {package.title} with publisher(s) {package.publishers}, "
+            f"skipping...")
+
+
+def report_cached_dataset(package, dataset, resolution):
+    """
+    Count and report a dataset taken from a cache of rendered datasets, as rendering it would have: as rendered,
+    or as filtered out of the feed for the reason in its resolution.
     """
-    Render the metadata for a single dataset to the Pure XML feed.
+    if dataset is not None:
+        get_metrics().count('datasets_rendered')
+    elif resolution['status'] == 'filtered':
+        print_stderr(filter_message(package, resolution['reason']))
+        get_metrics().count('datasets_filtered', reason=resolution['reason'])
+
+
+def resolve_package(package, complete=False):
+    """
+    Resolve the publisher and the authors of a dataset, given as a PackageRecord, to Pure IDs, and decide
+    whether the dataset goes into the feed; see new_resolution() for the result.
+
+    Resolution stops at the first reason to leave the dataset out of the feed, unless complete is set, in which
+    case the authors are resolved anyway.
     """
-    assert(pkg_dict['type'] == 'dataset')
-    assert(pkg_dict['state'] == 'active')
+    resolution = new_resolution(package)
+    resolution['status'] = 'included'
+
+    def filter_out(reason):
+        """ Record the first reason to leave the dataset out; returns True if resolution should stop. """
+        if resolution['status'] == 'included':
+            print_stderr(filter_message(package, reason))
+            get_metrics().count('datasets_filtered', reason=reason)
+            resolution['status'] = 'filtered'
+            resolution['reason'] = reason
+        return not complete
 
     ### For the dataset to be valid in Pure, it must have a Workday mapping for Managing Organization and Publisher.
 
     # Publisher: Pure accepts only one publisher, so use the first one.
-    publishers_standard_json = get_extras_value(pkg_dict, 'publisher-standard')
-    publishers_standard = json.loads(publishers_standard_json)
-    publishers_json = get_extras_value(pkg_dict, 'publisher')
-    publishers = json.loads(publishers_json)
-    publisher_id = None
-    publisher_standard = None
-    for publisher_standard, publisher in zip(publishers_standard, publishers):
+    publishers = package.publishers
+    for publisher_standard, publisher in zip(package.publishers_standard, publishers):
         publisher_id = get_organization_id(publisher_standard)
         if publisher_id:
+            resolution['publisher'] = publisher_standard
+            resolution['publisher_id'] = publisher_id
             break
 
-
     # Filter out cases that have missing Workday mappings
-    if not publisher_id:
-        message = f"#### Filtering out '{pkg_dict['title']}' with publisher(s) {publishers}"
-        print_stderr(message)
-        return
+    if not resolution['publisher_id']:
+        if filter_out('no_publisher_mapping'):
+            return resolution
+
+    # Persons: For now, we just populate with authors.
+    authors = package.authors
+    if authors is None:
+        filter_out('no_authors')
+        return resolution
+    for author in authors:
+        with get_metrics().stage('author_resolution'):
+            person_id, orcid_id, method = resolve_pure_author(author)
+        resolution['authors'].append({'name': author['name'], 'orcid': orcid_id, 'person_id': person_id,
+                                      'method': method})
+
+    if not any(author['person_id'] for author in resolution['authors']):
+        filter_out('no_ncar_author')
+    return resolution
 
-    publisher_string = get_publisher_string(publisher_standard)
 
-    # log.error(pkg_dict)
-    dataset_id = get_extras_value(pkg_dict, 'guid')
+def orcid_doi_rows(resolution):
+    """ Return the ORCID/DOI CSV rows of a resolved dataset: one for each author with an ORCID iD. """
+    return [{'DOI': resolution['resource_url'], 'dataset_id': resolution['dataset_id'], 'ORCID': author['orcid'],
+             'name': author['name']} for author in resolution['authors'] if author['orcid']]
+
+
+def build_dataset(package, resolution, add_extra_elements=False):
+    """
+    Build the Pure XML <dataset> element of a PackageRecord, from its resolution by resolve_package().
+    """
+    # Extras that are empty strings in a complete package dictionary are missing from a projected one.
+    dataset_id = resolution['dataset_id'] or ''
     dataset = etree.Element(PURE + 'dataset', attrib={'id': dataset_id, 'type': 'dataset'})
 
     # Title
     title = etree.SubElement(dataset, PURE + 'title')
-    title.text = pkg_dict['title']
+    title.text = package.title
 
     # Description
     description = etree.SubElement(dataset, PURE + 'description')
-    description.text = remove_html_tags(pkg_dict['notes'])
+    description.text = remove_html_tags(package.notes)
 
     # Temporal Coverage:  Use only if it's defined
     if add_extra_elements:
-        extent_range = get_extras_value(pkg_dict, 'extent_range')
+        extent_range = package.extra('extent_range')
         if extent_range:
             (start_date, end_date) = get_extent_parts(extent_range)
             temporal_coverage = etree.SubElement(dataset, PURE + 'temporalCoverage')
@@ -198,33 +391,22 @@ def render_package(root, pkg_dict, csv_writer, add_extra_elements=False):
     # Example would be nice; punt for now.
 
     # DOI
-    resource_url = get_extras_value(pkg_dict, 'resource-url')
+    resource_url = resolution['resource_url'] or ''
     if is_doi(resource_url):
         doi = etree.SubElement(dataset, PURE + 'DOI')
         doi.text = get_doi_suffix(resource_url)
 
     # Available Date:  Could be just year, or year+month
-    pub_date = get_extras_value(pkg_dict, 'publication_date')
+    pub_date = package.extra('publication_date') or ''
     date_parts = get_date_parts(pub_date)
     avail_date = etree.SubElement(dataset, PURE + 'availableDate')
     fill_date_fields(avail_date, date_parts)
 
-    # Persons: For now, we just populate with authors.
-    authors = get_extras_value(pkg_dict, 'harvest-author-with-url')
-    if not authors:
-        print_stderr("#### No authors found, skipping...")
-        return
-    authors = json.loads(authors)
     persons = etree.SubElement(dataset, PURE + 'persons')
     author_index = 0
-    found_ncar_author = False
-    for author in authors:
+    for author in resolution['authors']:
         author_index += 1
-        person_id, orcid_id = get_pure_author_id(author)
-        if csv_writer and orcid_id:
-            data = {'DOI': resource_url, 'dataset_id': dataset_id, 'ORCID': orcid_id, 'name':  author['name']}
-            csv_writer.writerow(data)
-
+        person_id = author['person_id']
         person = etree.SubElement(persons, PURE + 'person', attrib={"id": "personAssoc" + str(author_index), "contactPerson": "false"})
         if not person_id:
             # non-NCAR author found; create "external author" XML structure
@@ -242,21 +424,14 @@ def render_package(root, pkg_dict, csv_writer, add_extra_elements=False):
             #continue
         else:
             # NCAR author found; create "internal author" XML structure
-            found_ncar_author = True
             person_inner = etree.SubElement(person, PURE + 'person', attrib={"lookupId": person_id})
             role = etree.SubElement(person, PURE + 'role')
             role.text = 'creator'
 
-    if not found_ncar_author:
-        print_stderr(f"Could not find a matching author for {pkg_dict['title']} with publisher(s) {publishers}, skipping...")
-        return
-
-    org = etree.SubElement(dataset, PURE + 'managingOrganisation', attrib={'lookupId': publisher_id})
+    publisher_string = get_publisher_string(resolution['publisher'])
+    org = etree.SubElement(dataset, PURE + 'managingOrganisation', attrib={'lookupId': resolution['publisher_id']})
     org = etree.SubElement(dataset, PURE + 'publisher', attrib={'lookupId': publisher_string})
 
-    # Now that the dataset element is complete, append it to the output XML feed.
-    root.append(dataset)
-
     # Link to resource homepage
     if add_extra_elements:
         links = etree.SubElement(dataset, PURE + 'links')
@@ -266,3 +441,42 @@ def render_package(root, pkg_dict, csv_writer, add_extra_elements=False):
         description_text.text = 'Resource Download Homepage'
         url = etree.SubElement(link, PURE + 'url')
         url.text = resource_url
+
+    # Empty text is left unset, as in a parsed element, so the dataset serializes the same bytes (<tag/>) when
+    # it is written directly and when it is copied from a rendering worker, the fragment cache or a checkpoint.
+    for element in dataset.iter():
+        if element.text == '':
+            element.text = None
+
+    get_metrics().count('datasets_rendered')
+    return dataset
+
+
+def render_record(package, add_extra_elements=False, extract=None):
+    """
+    Return the <dataset> element and the resolution of a PackageRecord.  The element is None if the dataset is
+    left out of the feed, or if extract is set: to 'resolve' to resolve all of its authors without building
+    any XML, or to 'orcids' to only list its authors and their ORCID iDs, see describe_package().
+    """
+    assert(package.type == 'dataset')
+    assert(package.state == 'active')
+
+    if extract == 'orcids':
+        return None, describe_package(package)
+    resolution = resolve_package(package, complete=extract == 'resolve')
+    if extract or resolution['status'] != 'included':
+        return None, resolution
+    return build_dataset(package, resolution, add_extra_elements), resolution
+
+
+def render_package(package, csv_writer, add_extra_elements=False):
+    """
+    Render the metadata for a single dataset, given as a PackageRecord, as a Pure XML <dataset> element.
+
+    Returns the completed element, or None if the dataset is filtered out of the feed.  The ORCID/DOI rows of
+    the dataset are written to csv_writer, if given.
+    """
+    dataset, resolution = render_record(package, add_extra_elements)
+    if csv_writer:
+        csv_writer.writerows(orcid_doi_rows(resolution))
+    return dataset